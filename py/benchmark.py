@@ -0,0 +1,521 @@
+"""
+Offline benchmarks for the ingestion, retrieval and scoring hot paths.
+
+Everything is synthetic and deterministic for a given --seed: text corpora
+of configurable size, generated PDFs with a share of image-only pages, a
+stub LLM and the hashing embedder, so a run needs no network, API key or
+model download. Each stage reports throughput, p50/p99 latency and peak
+traced memory; the whole run is written as JSON.
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+With --compare, stages that got slower than --tolerance allows are listed
+and the exit status is 1, so a run can gate a change.
+"""
+import os
+import io
+import sys
+import gc
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+from datetime import datetime
+import numpy as np
+from PIL import Image, ImageDraw
+
+from llm_client import LLMClient, StubBackend
+from dense_index import DenseIndex, HashingEmbedder
+from text_chunker import TextChunker
+from pdf_processor import PDFProcessor
+from rag_agent_module import RAGAgent
+from tutoring_agent import TutoringAgent
+from test_analyser import TestAnalyzer
+
+STAGES = ('chunk', 'extract', 'ingest', 'retrieve', 'retrieve_many', 'tutoring', 'analyze', 'grade')
+
+
+class SyntheticCorpus:
+    """
+    Deterministic pseudo-English text: a vocabulary of made-up words drawn
+    with a Zipf-like skew, grouped into sentences, paragraphs and sections
+    with headings, so chunking and TF-IDF see realistic structure.
+    """
+
+    SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'shi', 'pra', 'den', 'gul', 'fen', 'ost', 'ri', 'um']
+
+    def __init__(self, seed=0, vocabulary_size=5000):
+        self.rng = np.random.default_rng(seed)
+        words = set()
+        while len(words) < vocabulary_size:
+            n = self.rng.integers(1, 5)
+            words.add(''.join(self.rng.choice(self.SYLLABLES, n)))
+        self.vocabulary = sorted(words)
+        weights = 1.0 / np.arange(1, vocabulary_size + 1)
+        self.weights = weights / weights.sum()
+        self.topics = [f"{self._words(2)[0].title()} {self._words(1)[0]}" for _ in range(12)]
+
+    def _words(self, n):
+        return list(self.rng.choice(self.vocabulary, n, p=self.weights))
+
+    def sentence(self):
+        words = self._words(int(self.rng.integers(8, 21)))
+        return ' '.join(words).capitalize() + '.'
+
+    def paragraph(self):
+        return ' '.join(self.sentence() for _ in range(int(self.rng.integers(3, 7))))
+
+    def page(self, number, chars=2500):
+        """One page of text with an occasional section heading"""
+        parts = []
+        if number % 4 == 1:
+            parts.append(f"SECTION {number // 4 + 1}")
+        size = 0
+        while size < chars:
+            parts.append(self.paragraph())
+            size += len(parts[-1])
+        return '\n\n'.join(parts)
+
+    def pages(self, n, chars=2500):
+        return [self.page(i + 1, chars) for i in range(n)]
+
+    def queries(self, n):
+        return [' '.join(self._words(3)) for _ in range(n)]
+
+    def questions(self, n):
+        """MCQs in the shape MCQGenerator produces"""
+        return [
+            {
+                'id': f"q{i}",
+                'question': self.sentence()[:-1] + '?',
+                'options': {key: ' '.join(self._words(3)) for key in 'ABCD'},
+                'correct_answer': str(self.rng.choice(list('ABCD'))),
+                'topic': str(self.rng.choice(self.topics)),
+                'difficulty': str(self.rng.choice(['easy', 'medium', 'hard'])),
+                'explanation': self.sentence()
+            }
+            for i in range(n)
+        ]
+
+
+def write_pdf(path, pages):
+    """
+    Write a minimal PDF. Each page is ('text', lines) for a text layer in
+    Helvetica, or ('image', PIL image) for an image-only (scanned) page.
+    """
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    pages_obj = add(None)
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    kids = []
+    for kind, content in pages:
+        resources = f"/Font << /F1 {font} 0 R >>"
+        if kind == 'text':
+            lines = [
+                line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)').encode('latin-1', 'replace')
+                for line in content
+            ]
+            stream = b"BT /F1 10 Tf 12 TL 40 760 Td " + b" ".join(b"(" + line + b") Tj T*" for line in lines) + b" ET"
+        else:
+            jpeg = io.BytesIO()
+            content.convert('L').save(jpeg, format='JPEG', quality=60)
+            image = add(
+                f"<< /Type /XObject /Subtype /Image /Width {content.width} /Height {content.height} "
+                f"/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /DCTDecode /Length {jpeg.tell()} >>\n"
+                .encode() + b"stream\n" + jpeg.getvalue() + b"\nendstream"
+            )
+            resources += f" /XObject << /Im1 {image} 0 R >>"
+            stream = b"q 612 0 0 792 0 0 cm /Im1 Do Q"
+        contents = add(f"<< /Length {len(stream)} >>\n".encode() + b"stream\n" + stream + b"\nendstream")
+        kids.append(add(
+            f"<< /Type /Page /Parent {pages_obj} 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << {resources} >> /Contents {contents} 0 R >>".encode()
+        ))
+
+    objects[catalog - 1] = f"<< /Type /Catalog /Pages {pages_obj} 0 R >>".encode()
+    objects[pages_obj - 1] = (
+        f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {len(kids)} >>".encode()
+    )
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root {catalog} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    with open(path, 'wb') as f:
+        f.write(out.getvalue())
+
+
+def scanned_page(text, width=850, height=1100):
+    """An image-only page with the text drawn on it, as a scanner would produce"""
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    y = 40
+    for line in _wrap(text, 90):
+        draw.text((40, y), line, fill=0)
+        y += 14
+        if y > height - 40:
+            break
+    return image
+
+
+def _wrap(text, width):
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split():
+            if line and len(line) + len(word) + 1 > width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+    return lines
+
+
+def summarize(latencies, units=None):
+    """Latency percentiles in ms, plus throughput when units were processed"""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total = float(latencies.sum())
+    result = {
+        'runs': len(latencies),
+        'total_seconds': round(total, 6),
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 4),
+        'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 4),
+        'mean_ms': round(float(latencies.mean()) * 1000, 4)
+    }
+    if units is not None:
+        result['units'] = units
+        result['throughput_per_second'] = round(units / total, 2) if total > 0 else None
+    return result
+
+
+def timed(fn, items):
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def peak_memory(fn):
+    """Peak traced allocation in MB while running fn once"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        return round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+    finally:
+        tracemalloc.stop()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.corpus = SyntheticCorpus(seed=args.seed)
+        random.seed(args.seed)
+        self.llm = LLMClient(StubBackend(), cache_size=0)
+        self.workdir = tempfile.mkdtemp(prefix='smartprep-bench-')
+        self.documents = [self.corpus.pages(args.doc_pages) for _ in range(args.docs)]
+        self.queries = self.corpus.queries(args.queries)
+        self.agent = None
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _agent(self):
+        dense = None
+        if self.args.backend != 'tfidf':
+            dense = DenseIndex(HashingEmbedder(), train_size=self.args.dense_train_size)
+        return RAGAgent(llm=self.llm, retrieval=self.args.backend, dense=dense)
+
+    def run(self, stages):
+        results = {}
+        for stage in stages:
+            print(f"[{stage}] running...", file=sys.stderr)
+            results[stage] = getattr(self, f"bench_{stage}")()
+            print(f"[{stage}] {json.dumps(results[stage])}", file=sys.stderr)
+        return results
+
+    def bench_chunk(self):
+        chunker = TextChunker()
+        texts = ['\n'.join(pages) for pages in self.documents]
+        latencies = timed(chunker.chunk, texts)
+        result = summarize(latencies, units=sum(len(t) for t in texts))
+        result['unit'] = 'chars'
+        result['peak_mb'] = peak_memory(lambda: chunker.chunk(texts[0]))
+        return result
+
+    def bench_extract(self):
+        args = self.args
+        n_images = int(round(args.pdf_pages * args.image_fraction))
+        image_pages = set(random.sample(range(args.pdf_pages), n_images))
+        texts = self.corpus.pages(args.pdf_pages, chars=1800)
+        layout = [
+            ('image', scanned_page(text)) if i in image_pages else ('text', _wrap(text, 100)[:60])
+            for i, text in enumerate(texts)
+        ]
+        path = os.path.join(self.workdir, 'synthetic.pdf')
+        write_pdf(path, layout)
+
+        processor = PDFProcessor(max_workers=args.pdf_workers)
+        methods = {}
+        page_latencies = []
+
+        def extract():
+            start = time.perf_counter()
+            for page in processor.iter_pages(path):
+                now = time.perf_counter()
+                page_latencies.append(now - start)
+                start = now
+                methods[page['method'] or 'none'] = methods.get(page['method'] or 'none', 0) + 1
+
+        # Without tesseract every image page logs an OCR failure; keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            documents = timed(lambda _: extract(), range(args.repeat))
+            peak = peak_memory(extract)
+
+        result = summarize(page_latencies, units=len(page_latencies))
+        result['unit'] = 'pages'
+        result['document_seconds'] = summarize(documents)
+        result['pages_by_method'] = {k: v // (args.repeat + 1) for k, v in methods.items()}
+        result['image_pages'] = n_images
+        result['ocr_available'] = shutil.which('tesseract') is not None
+        result['pdf_bytes'] = os.path.getsize(path)
+        result['peak_mb'] = peak
+        return result
+
+    def bench_ingest(self):
+        self.agent = self._agent()
+        documents = [[{'page': i + 1, 'text': t} for i, t in enumerate(pages)] for pages in self.documents]
+        latencies = timed(lambda pages: self.agent.process_pages(pages, 'synthetic.pdf'), documents)
+        result = summarize(latencies, units=self.agent.index.n_rows)
+        result['unit'] = 'chunks'
+        result['pages_per_second'] = round(sum(len(d) for d in documents) / sum(latencies), 2)
+        # What the background compaction leaves behind: one segment, dense lists trained
+        self.agent.index.compact()
+        result['backend'] = self.args.backend
+        result['peak_mb'] = peak_memory(lambda: self._agent().process_pages(documents[0], 'synthetic.pdf'))
+        return result
+
+    def _ingested(self):
+        if self.agent is None:
+            self.bench_ingest()
+        return self.agent
+
+    def bench_retrieve(self):
+        agent = self._ingested()
+        document_ids = list(agent.documents)
+        # Alternate whole-corpus and single-document queries
+        work = [(q, None if i % 2 else document_ids[i % len(document_ids)]) for i, q in enumerate(self.queries)]
+        latencies = timed(lambda item: agent.retrieve_relevant_chunks(item[0], 5, item[1]), work)
+        result = summarize(latencies, units=len(work))
+        result['unit'] = 'queries'
+        result['rows'] = agent.index.n_rows
+        result['peak_mb'] = peak_memory(lambda: agent.retrieve_relevant_chunks(self.queries[0], 5))
+        return result
+
+    def bench_retrieve_many(self):
+        agent = self._ingested()
+        batch = self.args.batch_size
+        batches = [self.queries[i:i + batch] for i in range(0, len(self.queries), batch)]
+        latencies = timed(lambda queries: agent.retrieve_many(queries, top_k=5), batches)
+        result = summarize(latencies, units=len(self.queries))
+        result['unit'] = 'queries'
+        result['batch_size'] = batch
+        result['peak_mb'] = peak_memory(lambda: agent.retrieve_many(batches[0], top_k=5))
+        return result
+
+    def bench_tutoring(self):
+        agent = self._ingested()
+        tutor = TutoringAgent(agent, llm=self.llm)
+        document_ids = list(agent.documents)
+        topics = [self.corpus.topics[:5] for _ in range(self.args.tutoring_batches)]
+        work = list(zip(document_ids * len(topics), topics))
+        latencies = timed(lambda item: tutor.generate_lessons(*item), work)
+        result = summarize(latencies, units=sum(len(t) for t in topics))
+        result['unit'] = 'lessons'
+        result['peak_mb'] = peak_memory(lambda: tutor.generate_lessons(*work[0]))
+        return result
+
+    def bench_analyze(self):
+        analyzer = TestAnalyzer(db_path=os.path.join(self.workdir, 'sessions.db'))
+        sessions = []
+        for _ in range(self.args.tests):
+            questions = self.corpus.questions(self.args.questions)
+            test_id = analyzer.create_test_session('synthetic-document', questions)
+            answers = [
+                {'question_id': q['id'], 'selected_option': random.choice('ABCD')}
+                for q in questions
+            ]
+            sessions.append((test_id, answers))
+
+        latencies = timed(lambda item: analyzer.analyze_test(*item), sessions)
+        result = summarize(latencies, units=len(sessions))
+        result['unit'] = 'tests'
+        result['questions_per_test'] = self.args.questions
+        test_id = analyzer.create_test_session('synthetic-document', self.corpus.questions(self.args.questions))
+        result['peak_mb'] = peak_memory(lambda: analyzer.analyze_test(test_id, sessions[0][1]))
+        trend_latencies = timed(lambda _: analyzer.get_performance_trends(), range(20))
+        result['trends_p50_ms'] = summarize(trend_latencies)['p50_ms']
+        return result
+
+    def bench_grade(self):
+        analyzer = TestAnalyzer(db_path=os.path.join(self.workdir, 'grading.db'))
+        questions = self.corpus.questions(self.args.questions)
+        test_id = analyzer.create_test_session('synthetic-document', questions)
+        submissions = [
+            {
+                'student_id': f"student-{i}",
+                'answers': [{'question_id': q['id'], 'selected_option': random.choice('ABCD')} for q in questions]
+            }
+            for i in range(self.args.tests)
+        ]
+
+        latencies = timed(lambda _: analyzer.grade_batch(test_id, submissions), range(self.args.repeat))
+        result = summarize(latencies, units=len(submissions) * self.args.repeat)
+        result['unit'] = 'answer sheets'
+        result['sheets_per_batch'] = len(submissions)
+        result['peak_mb'] = peak_memory(lambda: analyzer.grade_batch(test_id, submissions))
+
+        # The same sheets submitted one at a time, as separate tests
+        sessions = [
+            (analyzer.create_test_session('synthetic-document', questions, user_id=s['student_id']), s['answers'])
+            for s in submissions
+        ]
+        loop_seconds = sum(timed(lambda item: analyzer.analyze_test(*item), sessions))
+        result['one_at_a_time_seconds'] = round(loop_seconds, 6)
+        result['speedup'] = round(loop_seconds / float(np.median(latencies)), 2)
+
+        # The class report over every sheet above: built once, then served from cache
+        report_latencies = timed(lambda _: analyzer.get_class_analytics('synthetic-document'), range(21))
+        result['class_analytics_cold_ms'] = round(report_latencies[0] * 1000, 3)
+        result['class_analytics_p50_ms'] = summarize(report_latencies[1:])['p50_ms']
+        return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print per-stage changes against a baseline run. A stage regresses when
+    its throughput drops, or its p99 latency grows, by more than tolerance.
+    """
+    regressions = []
+    for stage, current in results['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if not old:
+            continue
+        changes = []
+        if current.get('throughput_per_second') and old.get('throughput_per_second'):
+            ratio = current['throughput_per_second'] / old['throughput_per_second']
+            changes.append(f"throughput x{ratio:.2f}")
+            if ratio < 1 - tolerance:
+                regressions.append(f"{stage}: throughput x{ratio:.2f}")
+        if current.get('p99_ms') and old.get('p99_ms'):
+            ratio = current['p99_ms'] / old['p99_ms']
+            changes.append(f"p99 x{ratio:.2f}")
+            if ratio > 1 + tolerance:
+                regressions.append(f"{stage}: p99 x{ratio:.2f}")
+        if current.get('peak_mb') and old.get('peak_mb'):
+            changes.append(f"peak memory x{current['peak_mb'] / old['peak_mb']:.2f}")
+        print(f"{stage:>14}: {', '.join(changes)}")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated subset of ' + ', '.join(STAGES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--docs', type=int, default=20, help='synthetic documents to ingest')
+    parser.add_argument('--doc-pages', type=int, default=40, help='pages per synthetic document')
+    parser.add_argument('--pdf-pages', type=int, default=30, help='pages in the generated PDF')
+    parser.add_argument('--image-fraction', type=float, default=0.2, help='share of image-only PDF pages')
+    parser.add_argument('--pdf-workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='PDF extraction and batch grading passes')
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--batch-size', type=int, default=10, help='queries per retrieve_many call')
+    parser.add_argument('--tutoring-batches', type=int, default=20)
+    parser.add_argument('--tests', type=int, default=500, help='test submissions to analyze, and answer sheets per graded batch')
+    parser.add_argument('--questions', type=int, default=20, help='questions per test')
+    parser.add_argument('--backend', default='tfidf', choices=['tfidf', 'dense', 'hybrid'])
+    parser.add_argument('--dense-train-size', type=int, default=4096)
+    parser.add_argument('--output', default=None, help='results file (default: benchmark-<timestamp>.json)')
+    parser.add_argument('--compare', default=None, help='baseline results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a stage is flagged')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise SystemExit(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    bench = Benchmark(args)
+    try:
+        stage_results = bench.run(stages)
+    finally:
+        bench.close()
+
+    results = {
+        'environment': environment(),
+        'config': vars(args),
+        'stages': stage_results,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Topic mastery is tracked as how many submissions scored 0-10%, 10-20%, ... 90-100% on the topic
+BANDS = 10
+
+# Point-biserial discrimination below this flags a question for review
+LOW_DISCRIMINATION = 0.2
+
+
+def tally(questions, options, percentages, submission, question, option, is_correct):
+    """
+    Additive statistics of graded submissions, computed over their answers
+    at once. Adding two tallies' rows gives the tally of both sets of
+    submissions, which is what lets SessionStore keep them up to date one
+    submission or batch at a time.
+
+    questions    (question_id, topic, difficulty, correct_answer) per question code
+    options      option label per option code
+    percentages  each submission's overall percentage
+    submission, question, option, is_correct
+                 one entry per answer: its submission index, question code,
+                 option code (-1 when unanswered) and whether it was right
+
+    Returns {'submissions', 'items', 'options', 'bands'}: rows of per-question
+    totals (question_id, topic, difficulty, correct_answer, attempts, correct,
+    score_sum, score_squares, correct_score_sum), of how often each option was
+    picked (question_id, option, chosen; '' for unanswered), and of topic
+    mastery (topic, band, submissions, percentage_sum).
+    """
+    submission = np.asarray(submission, dtype=np.int64)
+    question = np.asarray(question, dtype=np.int64)
+    option = np.asarray(option, dtype=np.int64)
+    is_correct = np.asarray(is_correct, dtype=np.float64)
+    n_submissions, n_questions, n_options = len(percentages), len(questions), len(options)
+
+    # Item totals; a submission's score is its overall fraction correct
+    score = (np.asarray(percentages, dtype=np.float64) / 100)[submission]
+    attempts = np.bincount(question, minlength=n_questions)
+    correct = np.bincount(question, weights=is_correct, minlength=n_questions)
+    score_sum = np.bincount(question, weights=score, minlength=n_questions)
+    score_squares = np.bincount(question, weights=score * score, minlength=n_questions)
+    correct_score_sum = np.bincount(question, weights=score * is_correct, minlength=n_questions)
+    items = [
+        questions[q] + (int(attempts[q]), int(correct[q]), float(score_sum[q]),
+                        float(score_squares[q]), float(correct_score_sum[q]))
+        for q in np.flatnonzero(attempts).tolist()
+    ]
+
+    # Option picks per question; column 0 counts unanswered
+    picks = np.bincount(question * (n_options + 1) + option + 1, minlength=n_questions * (n_options + 1))
+    labels = [''] + list(options)
+    nonzero = np.flatnonzero(picks)
+    picked = [
+        (questions[q][0], labels[o], int(count))
+        for q, o, count in zip(*(a.tolist() for a in np.divmod(nonzero, n_options + 1)), picks[nonzero].tolist())
+    ]
+
+    # Each submission's percentage per topic, then how many submissions fall in each band
+    topic_index = {}
+    topic_of = np.array([topic_index.setdefault(q[1], len(topic_index)) for q in questions], dtype=np.int64)
+    n_topics = len(topic_index)
+    key = submission * n_topics + topic_of[question]
+    topic_total = np.bincount(key, minlength=n_submissions * n_topics)
+    topic_correct = np.bincount(key, weights=is_correct, minlength=n_submissions * n_topics)
+    taken = np.flatnonzero(topic_total)
+    topic_percent = topic_correct[taken] / topic_total[taken] * 100
+    band = np.minimum((topic_percent // (100 / BANDS)).astype(np.int64), BANDS - 1)
+    band_key = (taken % n_topics) * BANDS + band
+    band_counts = np.bincount(band_key, minlength=n_topics * BANDS)
+    band_sums = np.bincount(band_key, weights=topic_percent, minlength=n_topics * BANDS)
+    topics = list(topic_index)
+    bands = [
+        (topics[k // BANDS], k % BANDS, int(band_counts[k]), float(band_sums[k]))
+        for k in np.flatnonzero(band_counts).tolist()
+    ]
+
+    return {'submissions': n_submissions, 'items': items, 'options': picked, 'bands': bands}
+
+
+def tally_rows(submissions):
+    """
+    tally() of submissions given as (percentage, rows), with rows of
+    (question_id, topic, difficulty, correct_answer, user_answer, is_correct)
+    """
+    question_codes, option_codes = {}, {}
+    questions, percentages = [], []
+    columns = ([], [], [], [])
+    for i, (percentage, rows) in enumerate(submissions):
+        percentages.append(percentage)
+        for question_id, topic, difficulty, correct_answer, user_answer, is_correct in rows:
+            q = question_codes.get(question_id)
+            if q is None:
+                q = question_codes[question_id] = len(questions)
+                questions.append((question_id, topic, difficulty, correct_answer))
+            columns[0].append(i)
+            columns[1].append(q)
+            columns[2].append(-1 if user_answer is None else option_codes.setdefault(user_answer, len(option_codes)))
+            columns[3].append(bool(is_correct))
+    return tally(questions, list(option_codes), percentages, *columns)
+
+
+def _level_counts(counts):
+    """Submissions per performance level, with TestAnalyzer's thresholds of 50% and 80%"""
+    return {
+        'Good': int(counts[8:].sum()),
+        'Moderate': int(counts[5:8].sum()),
+        'Needs Improvement': int(counts[:5].sum())
+    }
+
+
+class ClassAnalytics:
+    """
+    Item analysis of every submitted test on a document, for teacher
+    dashboards: per question its difficulty index (share answered
+    correctly), discrimination (point-biserial correlation between getting
+    it right and the overall score) and how often each option was picked,
+    and per topic the distribution of submissions' mastery.
+
+    The statistics behind it are running totals SessionStore updates with
+    each submission, so a report is a few hundred rows turned into arrays,
+    and it is cached per document until the next submission changes them.
+    """
+
+    def __init__(self, store, cache_size=256):
+        self.store = store
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # document_id -> (version, report)
+        self._lock = threading.Lock()
+
+    def report(self, document_id):
+        """The document's item analysis, or None if no test on it was submitted"""
+        version = self.store.class_version(document_id)
+        if version is None:
+            return None
+        with self._lock:
+            cached = self._cache.get(document_id)
+            if cached is not None and cached[0] == version:
+                self._cache.move_to_end(document_id)
+                return cached[1]
+
+        stats = self.store.class_stats(document_id)
+        if stats is None:
+            return None
+        report = self._report(document_id, stats)
+        with self._lock:
+            self._cache[document_id] = (stats['version'], report)
+            self._cache.move_to_end(document_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return report
+
+    def _report(self, document_id, stats):
+        items = stats['items']
+        attempts = np.array([row[4] for row in items], dtype=np.float64)
+        correct = np.array([row[5] for row in items], dtype=np.float64)
+        score_sum, score_squares, correct_score_sum = (
+            np.array([row[k] for row in items], dtype=np.float64) for k in (6, 7, 8)
+        )
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            difficulty = correct / attempts
+            mean_score = score_sum / attempts
+            score_variance = np.maximum(score_squares / attempts - mean_score ** 2, 0)
+            covariance = correct_score_sum / attempts - difficulty * mean_score
+            discrimination = covariance / np.sqrt(score_variance * difficulty * (1 - difficulty))
+        # Undefined when everyone, or no one, got it right, or every score was the same
+        discrimination[~np.isfinite(discrimination)] = np.nan
+
+        picks = {}
+        for question_id, option, chosen in stats['options']:
+            picks.setdefault(question_id, {})[option] = chosen
+
+        questions = []
+        for i, (question_id, topic, level, correct_answer) in enumerate(row[:4] for row in items):
+            chosen = picks.get(question_id, {})
+            rates = {
+                option or 'unanswered': round(float(count / attempts[i] * 100), 2)
+                for option, count in sorted(chosen.items())
+            }
+            distractors = {option: rate for option, rate in rates.items() if option not in (correct_answer, 'unanswered')}
+            r = None if np.isnan(discrimination[i]) else round(float(discrimination[i]), 3)
+            questions.append({
+                'question_id': question_id,
+                'topic': topic,
+                'difficulty': level,
+                'correct_answer': correct_answer,
+                'attempts': int(attempts[i]),
+                'difficulty_index': round(float(difficulty[i]), 3),
+                'discrimination': r,
+                'option_rates': rates,
+                'top_distractor': max(distractors, key=distractors.get) if distractors else None,
+                'needs_review': r is not None and r < LOW_DISCRIMINATION
+            })
+
+        counts = {}
+        sums = {}
+        for topic, band, submissions, percentage_sum in stats['bands']:
+            counts.setdefault(topic, np.zeros(BANDS, dtype=np.int64))[band] = submissions
+            sums[topic] = sums.get(topic, 0.0) + percentage_sum
+        topics = {}
+        for topic, distribution in counts.items():
+            submissions = int(distribution.sum())
+            if not submissions:
+                continue
+            topics[topic] = {
+                'submissions': submissions,
+                'average_percentage': round(sums[topic] / submissions, 2),
+                # Submissions per 10-point band: 0-10%, 10-20%, ... 90-100%
+                'distribution': distribution.tolist(),
+                'levels': _level_counts(distribution)
+            }
+
+        return {
+            'document_id': document_id,
+            'submissions': stats['submissions'],
+            'questions': questions,
+            'topic_mastery': topics
+        }
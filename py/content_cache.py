@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import threading
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover this process
+    fcntl = None
+
+
+class ContentCache:
+    """
+    Maps a SHA-256 of uploaded content (PDF bytes, or a YouTube video id) to
+    the result of ingesting it, so repeat uploads skip extraction, indexing
+    and topic extraction. Records are small JSON files, one per hash.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._records = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    @staticmethod
+    def hash_bytes(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def hash_youtube(video_id):
+        return hashlib.sha256(f"youtube:{video_id}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return the cached record for a content hash, or None
+        """
+        record = self._records.get(key)
+        if record is not None:
+            return record
+
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        self._records[key] = record
+        return record
+
+    def put(self, key, record):
+        tmp_path = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self._path(key))
+        self._records[key] = record
+
+    @contextmanager
+    def lock(self, key):
+        """
+        Per-hash lock so simultaneous uploads of the same content are
+        processed once; the others wait and then read the cached record.
+        A flock on <hash>.lock covers every worker process sharing
+        cache_dir, not just this one's threads.
+        """
+        with self._locks_guard:
+            thread_lock = self._locks.setdefault(key, threading.Lock())
+        with thread_lock, open(os.path.join(self.cache_dir, f"{key}.lock"), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
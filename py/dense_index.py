@@ -0,0 +1,331 @@
+import os
+import bisect
+import threading
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+DEFAULT_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU embedding model through sentence-transformers"""
+
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL, batch_size=64):
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        """Unit-length float32 embeddings, one row per text"""
+        return self.model.encode(
+            list(texts),
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        ).astype(np.float32)
+
+
+class HashingEmbedder:
+    """
+    Offline embedder for tests and benchmarks: a fixed random projection of
+    hashed word counts. Deterministic and needs no model download, but it
+    only captures word overlap, not meaning.
+    """
+
+    def __init__(self, dim=128, n_features=2 ** 14, seed=0):
+        self.model_name = f'hashing-{dim}'
+        self.dim = dim
+        self.hasher = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+        rng = np.random.default_rng(seed)
+        self.projection = rng.standard_normal((n_features, dim)).astype(np.float32)
+
+    def embed(self, texts):
+        vectors = np.asarray(self.hasher.transform(list(texts)) @ self.projection, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class DenseIndex:
+    """
+    Embedding vectors for every indexed chunk, searched with an IVF
+    (inverted file) index.
+
+    Vectors are stored compressed: int8 with one float32 scale per row, or
+    float16. Once train_size rows exist, compact() trains n_lists centroids
+    with spherical k-means and files every row under its nearest centroid.
+    A query then only scans the rows of the n_probe closest lists instead
+    of the whole corpus. Until then every row is scanned exactly. compact()
+    retrains with about sqrt(rows) lists once the corpus has grown
+    fourfold, so the scanned fraction keeps shrinking as it grows. Training
+    is left to compact(), which runs in the background, so no upload waits
+    for k-means while holding the index write lock.
+
+    Like VectorIndex, the state is a list of immutable segments keyed by
+    their first global row, so it can live inside an IndexSnapshot and be
+    swapped copy-on-write under the same lock as the TF-IDF rows.
+    """
+
+    def __init__(self, embedder, dtype='int8', n_lists=64, n_probe=16, train_size=4096, kmeans_iterations=10):
+        if dtype not in ('int8', 'float16'):
+            raise ValueError(f"Unsupported embedding dtype: {dtype}")
+        self.embedder = embedder
+        self.dtype = dtype
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_size = train_size
+        self.kmeans_iterations = kmeans_iterations
+
+    @property
+    def model_name(self):
+        return self.embedder.model_name
+
+    def empty_state(self):
+        return {'segments': [], 'starts': [], 'centroids': None, 'n_rows': 0, 'trained_rows': 0}
+
+    def encode(self, texts):
+        """Embed a batch of chunks and compress it: returns (codes, scales)"""
+        if not texts:
+            return self.quantize(np.zeros((0, self.embedder.dim), dtype=np.float32))
+        return self.quantize(self.embedder.embed(texts))
+
+    def embed_query(self, query):
+        return self.embedder.embed([query])[0]
+
+    def quantize(self, vectors):
+        if self.dtype == 'float16':
+            return vectors.astype(np.float16), None
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    @staticmethod
+    def decode(codes, scales):
+        vectors = np.asarray(codes, dtype=np.float32)
+        if scales is not None:
+            vectors *= np.asarray(scales)[:, None]
+        return vectors
+
+    @staticmethod
+    def _dot(codes, scales, query_vector):
+        # Scale after the product: one multiply per row instead of per value
+        scores = np.asarray(codes, dtype=np.float32) @ query_vector
+        if scales is not None:
+            scores *= scales
+        return scores
+
+    def _segment(self, start, codes, scales, centroids):
+        """
+        A segment of rows [start, start + len(codes)). With trained centroids
+        its codes are stored grouped by list, so the rows filed under list l
+        are the contiguous block offsets[l]:offsets[l + 1]; rows holds each
+        stored row's local position and inverse maps positions back.
+        """
+        segment = {
+            'start': start, 'n': len(codes), 'codes': codes, 'scales': scales,
+            'rows': None, 'inverse': None, 'offsets': None
+        }
+        if centroids is not None and len(codes):
+            lists = np.argmax(self.decode(codes, scales) @ centroids.T, axis=1)
+            order = np.argsort(lists, kind='stable')
+            segment.update(
+                codes=np.ascontiguousarray(codes[order]),
+                scales=None if scales is None else scales[order],
+                rows=order,
+                inverse=np.argsort(order),
+                offsets=np.concatenate(([0], np.cumsum(np.bincount(lists, minlength=len(centroids)))))
+            )
+        return segment
+
+    @staticmethod
+    def _row_order(segment):
+        """A segment's (codes, scales) back in row order"""
+        if segment['inverse'] is None:
+            return segment['codes'], segment['scales']
+        inverse = segment['inverse']
+        scales = None if segment['scales'] is None else segment['scales'][inverse]
+        return segment['codes'][inverse], scales
+
+    def append(self, state, start, codes, scales):
+        """New state with rows [start, start + len(codes)) added"""
+        segments = state['segments'] + [self._segment(start, codes, scales, state['centroids'])]
+        new_state = dict(
+            state,
+            segments=segments,
+            starts=state['starts'] + [start],
+            n_rows=state['n_rows'] + len(codes)
+        )
+        return new_state
+
+    def merge_range(self, state, start, stop):
+        """Fold the segments that exactly cover rows [start, stop) into one"""
+        first = bisect.bisect_left(state['starts'], start)
+        last = bisect.bisect_left(state['starts'], stop)
+        if last - first < 2 or state['starts'][first] != start:
+            return state
+        if state['starts'][last - 1] + state['segments'][last - 1]['n'] != stop:
+            return state
+
+        parts = [self._row_order(p) for p in state['segments'][first:last]]
+        codes = np.concatenate([p[0] for p in parts])
+        scales = None if self.dtype == 'float16' else np.concatenate([p[1] for p in parts])
+        merged = self._segment(start, codes, scales, state['centroids'])
+        return dict(
+            state,
+            segments=state['segments'][:first] + [merged] + state['segments'][last:],
+            starts=state['starts'][:first] + [start] + state['starts'][last:]
+        )
+
+    def compact(self, state):
+        """
+        Fold every segment into one, training the lists first once there
+        are train_size rows, or retraining them if the corpus has grown
+        fourfold since they were trained
+        """
+        if self.needs_retraining(state):
+            state = self._trained(state)
+        return self.merge_range(state, 0, state['n_rows'])
+
+    def _trained(self, state):
+        """Train IVF centroids on a sample of the rows and file every segment"""
+        n_lists = max(self.n_lists, int(np.sqrt(state['n_rows'])))
+        vectors = np.concatenate([self.decode(s['codes'], s['scales']) for s in state['segments']])
+        rng = np.random.default_rng(0)
+        sample_size = min(len(vectors), max(self.train_size, 40 * n_lists))
+        sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+
+        n_lists = min(n_lists, len(sample))
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(self.kmeans_iterations):
+            lists = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, lists, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty lists keep their old centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        return dict(
+            state,
+            centroids=centroids,
+            trained_rows=state['n_rows'],
+            segments=[self._segment(s['start'], *self._row_order(s), centroids) for s in state['segments']]
+        )
+
+    @staticmethod
+    def _in_ranges(rows, ranges):
+        """Mask of rows falling inside any of the sorted, disjoint (start, stop) ranges"""
+        starts = np.array([r[0] for r in ranges])
+        stops = np.array([r[1] for r in ranges])
+        pos = np.searchsorted(starts, rows, side='right') - 1
+        return (pos >= 0) & (rows < stops[np.maximum(pos, 0)])
+
+    def search(self, state, query_vector, ranges, k=0):
+        """
+        Cosine scores of the candidate rows for a query: every row in the
+        n_probe nearest lists, or every row before the index is trained.
+        ranges limits the search to those global row ranges. A scope of at
+        most train_size rows (e.g. one document) is scored exactly, and
+        otherwise more lists are probed until at least k rows inside the
+        ranges were found, since the nearest lists may hold few of them.
+        Returns (row_ids, scores).
+        """
+        if state['centroids'] is None:
+            return self._scan(state, query_vector, ranges, None)
+
+        if sum(stop - start for start, stop in ranges) <= self.train_size:
+            rows = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+            return rows, self.score_rows(state, query_vector, rows)
+
+        order = np.argsort(state['centroids'] @ query_vector)[::-1]
+        n_probe = self.n_probe
+        while True:
+            row_ids, scores = self._scan(state, query_vector, ranges, np.sort(order[:n_probe]))
+            if len(row_ids) >= k or n_probe >= len(order):
+                return row_ids, scores
+            n_probe *= 2
+
+    def needs_retraining(self, state):
+        """
+        Whether compact() would (re)train the lists: train_size rows exist
+        but were never trained on, or the corpus grew fourfold since training
+        """
+        if state['centroids'] is None:
+            return state['n_rows'] >= self.train_size
+        return state['n_rows'] >= 4 * state['trained_rows']
+
+    def _scan(self, state, query_vector, ranges, probed):
+        """Scores of the rows in the probed lists (all rows if None) within ranges"""
+        row_ids = []
+        scores = []
+        for segment in state['segments']:
+            seg_start, seg_stop = segment['start'], segment['start'] + segment['n']
+            if not any(start < seg_stop and seg_start < stop for start, stop in ranges):
+                continue
+
+            codes, scales = segment['codes'], segment['scales']
+            if probed is None or segment['rows'] is None:
+                rows = np.arange(seg_start, seg_stop)
+            else:
+                # Each probed list is a contiguous block of the segment
+                offsets = segment['offsets']
+                blocks = [(offsets[l], offsets[l + 1]) for l in probed if offsets[l + 1] > offsets[l]]
+                codes = np.concatenate([codes[a:b] for a, b in blocks]) if blocks else codes[:0]
+                if scales is not None:
+                    scales = np.concatenate([scales[a:b] for a, b in blocks]) if blocks else scales[:0]
+                rows = np.concatenate([segment['rows'][a:b] for a, b in blocks] or [np.zeros(0, dtype=np.int64)]) + seg_start
+
+            if not any(start <= seg_start and seg_stop <= stop for start, stop in ranges):
+                keep = self._in_ranges(rows, ranges)
+                rows, codes = rows[keep], codes[keep]
+                scales = None if scales is None else scales[keep]
+
+            row_ids.append(rows)
+            scores.append(self._dot(codes, scales, query_vector))
+
+        if not row_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return np.concatenate(row_ids), np.concatenate(scores)
+
+    def score_rows(self, state, query_vector, rows):
+        """Exact cosine scores for specific global rows"""
+        scores = np.zeros(len(rows), dtype=np.float32)
+        seg_pos = np.searchsorted(state['starts'], rows, side='right') - 1
+        for pos in np.unique(seg_pos):
+            segment = state['segments'][pos]
+            mask = seg_pos == pos
+            local = rows[mask] - segment['start']
+            if segment['inverse'] is not None:
+                local = segment['inverse'][local]
+            scales = None if segment['scales'] is None else segment['scales'][local]
+            scores[mask] = self._dot(segment['codes'][local], scales, query_vector)
+        return scores
+
+
+_default_dense = None
+_default_lock = threading.Lock()
+
+
+def get_dense_index():
+    """
+    Process-wide dense index configuration. EMBEDDING_MODEL=hashing selects
+    the offline embedder; EMBEDDING_DTYPE is int8 (default) or float16.
+    """
+    global _default_dense
+    with _default_lock:
+        if _default_dense is None:
+            model_name = os.environ.get('EMBEDDING_MODEL', DEFAULT_EMBEDDING_MODEL)
+            if model_name == 'hashing':
+                embedder = HashingEmbedder()
+            else:
+                embedder = SentenceTransformerEmbedder(model_name)
+            _default_dense = DenseIndex(
+                embedder,
+                dtype=os.environ.get('EMBEDDING_DTYPE', 'int8'),
+                n_lists=int(os.environ.get('DENSE_N_LISTS', 64)),
+                n_probe=int(os.environ.get('DENSE_N_PROBE', 16)),
+                train_size=int(os.environ.get('DENSE_TRAIN_SIZE', 4096))
+            )
+        return _default_dense
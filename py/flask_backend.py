@@ -1,8 +1,11 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, current_app, g, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
+import time
+import threading
 from werkzeug.utils import secure_filename
 import json
+import uuid
 from datetime import datetime
 from tutoring_agent import TutoringAgent
 
@@ -12,35 +15,326 @@ from youtube_processor import YouTubeProcessor
 from rag_agent_module import RAGAgent
 from mcq_generator import MCQGenerator
 from test_analyser import TestAnalyzer
-
-app = Flask(__name__)
-CORS(app)
+from content_cache import ContentCache
+from question_bank import QuestionBank
+from job_queue import JobQueue, QueueFull
+from index_store import PatchConflict
+from metrics import get_metrics, start_trace, finish_trace, server_timing
 
 # Configuration
-UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
-
-# Ensure upload folder exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Initialize processors
-pdf_processor = PDFProcessor()
-youtube_processor = YouTubeProcessor()
-rag_agent = RAGAgent()
-tutoring_agent = TutoringAgent(rag_agent)
-mcq_generator = MCQGenerator()
-test_analyzer = TestAnalyzer()
+# Shared services, built once per process by create_app()
+pdf_processor = None
+youtube_processor = None
+rag_agent = None
+tutoring_agent = None
+mcq_generator = None
+test_analyzer = None
+content_cache = None
+job_queue = None
+_init_lock = threading.Lock()
+
+api = Blueprint('api', __name__)
+
+def load_config():
+    """
+    Settings from the environment. State that every worker process must see
+    (index, question banks, test sessions) lives under INDEX_FOLDER.
+    """
+    return {
+        'UPLOAD_FOLDER': os.environ.get('SMARTPREP_UPLOAD_DIR', 'uploads'),
+        'INDEX_FOLDER': os.environ.get('SMARTPREP_INDEX_DIR', 'index'),
+        'MAX_CONTENT_LENGTH': 50 * 1024 * 1024,  # 50MB max file size
+        # Gunicorn worker processes (see gunicorn.conf.py). Every process has
+        # its own PDF process pool and job threads, so the server-wide sizes
+        # below are split between them
+        'WEB_CONCURRENCY': int(os.environ.get('WEB_CONCURRENCY', 1)),
+        # OCR processes per worker; by default the cores are shared out
+        'PDF_WORKERS': int(os.environ.get('PDF_WORKERS', 0)) or None,
+        'QUESTION_BANK_SIZE': int(os.environ.get('QUESTION_BANK_SIZE', 60)),
+        'JOB_QUEUE_DB': os.environ.get('JOB_QUEUE_DB') or None,
+        # Test sessions and results; defaults to sessions.db in INDEX_FOLDER
+        'SESSION_DB': os.environ.get('SESSION_DB') or None,
+        'SESSION_CACHE_TTL': int(os.environ.get('SESSION_CACHE_TTL', 3600)),
+        'SESSION_RETENTION': int(os.environ.get('SESSION_RETENTION', 7 * 24 * 3600)),
+        # Requests sending this header with "1" get a Server-Timing breakdown back
+        'TRACE_HEADER': os.environ.get('TRACE_HEADER', 'X-SmartPrep-Trace')
+    }
+
+def init_services(config):
+    """
+    Initialize processors, agents and the job queue. Runs once per process;
+    later calls (e.g. a second create_app()) reuse the same instances.
+    """
+    global pdf_processor, youtube_processor, rag_agent, tutoring_agent
+    global mcq_generator, test_analyzer, content_cache, job_queue
+
+    with _init_lock:
+        if job_queue is not None:
+            return
+
+        index_folder = config['INDEX_FOLDER']
+        processes = max(1, config['WEB_CONCURRENCY'])
+        pdf_processor = PDFProcessor(
+            max_workers=config['PDF_WORKERS'] or max(1, (os.cpu_count() or 1) // processes)
+        )
+        youtube_processor = YouTubeProcessor()
+        rag_agent = RAGAgent(index_dir=index_folder)
+        tutoring_agent = TutoringAgent(rag_agent)
+        mcq_generator = MCQGenerator(
+            bank=QuestionBank(os.path.join(index_folder, 'question_bank')),
+            bank_target_size=config['QUESTION_BANK_SIZE']
+        )
+        test_analyzer = TestAnalyzer(
+            db_path=config['SESSION_DB'] or os.path.join(index_folder, 'sessions.db'),
+            cache_ttl=config['SESSION_CACHE_TTL'],
+            retention_seconds=config['SESSION_RETENTION']
+        )
+        content_cache = ContentCache(os.path.join(index_folder, 'content_cache'))
+
+        # Worker threads start here, so only once the services above exist.
+        # With a shared JOB_QUEUE_DB every process drains the same queue, so
+        # <TYPE>_WORKERS is a server-wide count split between the processes
+        queue = JobQueue(db_path=config['JOB_QUEUE_DB'])
+        share = processes if config['JOB_QUEUE_DB'] else 1
+        for job_type, (handler, env_name, workers, max_queued) in JOB_TYPES.items():
+            workers = int(os.environ.get(f'{env_name}_WORKERS', workers))
+            queue.register(
+                job_type, handler,
+                workers=max(1, -(-workers // share)),
+                max_queued=int(os.environ.get(f'{env_name}_MAX_QUEUED', max_queued))
+            )
+        job_queue = queue
+
+def create_app(config=None):
+    """
+    Application factory. config overrides settings read from the environment.
+    """
+    app = Flask(__name__)
+    CORS(app)
+    app.config.update(load_config())
+    app.config.update(config or {})
+
+    # Ensure upload folder exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    init_services(app.config)
+    app.register_blueprint(api)
+    return app
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/health', methods=['GET'])
+def cached_ingest(content_key):
+    """
+    Return a previous ingest result for this content if its document is still indexed
+    """
+    record = content_cache.get(content_key)
+    if record and rag_agent.has_document(record['document_id']):
+        return record
+    return None
+
+def no_progress(**fields):
+    pass
+
+def ingest_pdf(content_key, filepath, filename, document_id=None, progress=no_progress):
+    """
+    Stream a PDF through extraction, chunking and indexing page by page,
+    reporting progress as it goes. Returns the ingest record.
+    """
+    # Same bytes uploaded before (e.g. a whole class uploading one textbook)
+    with content_cache.lock(content_key):
+        record = cached_ingest(content_key)
+        if record:
+            progress(document_id=record['document_id'])
+            return record
+
+        page_count = pdf_processor.page_count(filepath)
+        pages_processed = 0
+        progress(document_id=document_id, page_count=page_count, pages_processed=0, chunks_indexed=0)
+
+        def on_progress(page, chunk_count):
+            nonlocal pages_processed
+            pages_processed += 1
+            progress(pages_processed=pages_processed, chunks_indexed=chunk_count)
+
+        # Chunks become searchable as soon as their page is extracted
+        document_id = rag_agent.process_pages(
+            pdf_processor.iter_pages(filepath), filename,
+            document_id=document_id, on_progress=on_progress, source_path=filepath
+        )
+        document = rag_agent.get_document(document_id)
+        progress(chunks_indexed=document['chunk_count'])
+        text_content = document['full_text']
+
+        # Extract topics/sections
+        topics = rag_agent.extract_topics(text_content)
+
+        record = {
+            'document_id': document_id,
+            'topics': topics,
+            'text_length': len(text_content)
+        }
+        content_cache.put(content_key, record)
+        schedule_bank_build(document_id)
+        return record
+
+def create_mcq_test(document_id, num_questions, session_id=None, exclude_ids=(), user_id=None):
+    # Sample MCQs from the document's question bank
+    mcqs = mcq_generator.create_test(
+        document_id, num_questions, lambda: rag_agent.get_document(document_id),
+        session_id=session_id, exclude_ids=exclude_ids
+    )
+
+    # Create test session
+    test_id = test_analyzer.create_test_session(document_id, mcqs, user_id=user_id)
+
+    # Top the bank up in the background before this session runs out
+    if mcq_generator.bank_needs_refill(document_id, session_id):
+        schedule_bank_build(document_id, mcq_generator.bank.size(document_id) + mcq_generator.bank_target_size)
+
+    return {'test_id': test_id, 'questions': mcqs}
+
+def schedule_bank_build(document_id, target_size=None):
+    try:
+        job_queue.submit('build-question-bank', {'document_id': document_id, 'target_size': target_size})
+    except QueueFull:
+        pass
+
+def upload_pdf_job(payload, progress):
+    record = ingest_pdf(
+        payload['content_key'], payload['filepath'], payload['filename'],
+        document_id=payload['document_id'], progress=progress
+    )
+    return dict(record, filename=payload['filename'])
+
+def generate_mcq_job(payload, progress):
+    return create_mcq_test(
+        payload['document_id'], payload['num_questions'],
+        session_id=payload.get('session_id'), exclude_ids=payload.get('exclude_question_ids', []),
+        user_id=payload.get('user_id')
+    )
+
+def build_bank_job(payload, progress):
+    document_id = payload['document_id']
+    size = mcq_generator.build_question_bank(
+        document_id, rag_agent.get_document(document_id), payload.get('target_size')
+    )
+    return {'document_id': document_id, 'bank_size': size}
+
+def tutoring_job(payload, progress):
+    lesson = tutoring_agent.generate_lesson(payload['document_id'], payload['topic'])
+    return {'topic': payload['topic'], 'lesson': lesson}
+
+def tutoring_batch_job(payload, progress):
+    lessons = tutoring_agent.generate_lessons(payload['document_id'], payload['topics'])
+    return {'document_id': payload['document_id'], 'lessons': lessons}
+
+def reprocess_pages(document_id, first_page, last_page, force_ocr):
+    """
+    Re-extract a page range from the document's original PDF and swap in
+    only the chunks those pages affect
+    """
+    document = rag_agent.get_document(document_id)
+    if document is None:
+        raise KeyError(f"Unknown document: {document_id}")
+    source_path = document.get('source_path')
+    if not source_path or not os.path.exists(source_path):
+        raise ValueError("The original PDF of this document is no longer available")
+    page_count = pdf_processor.page_count(source_path)
+    if last_page > page_count:
+        raise ValueError(f"The document has only {page_count} pages")
+
+    pages = pdf_processor.extract_pages(source_path, first_page, last_page, force_ocr=force_ocr)
+    result = rag_agent.reprocess_pages(document_id, pages)
+    return dict(result, document_id=document_id, first_page=first_page, last_page=last_page)
+
+def reprocess_pages_job(payload, progress):
+    return reprocess_pages(
+        payload['document_id'], payload['first_page'], payload['last_page'], payload['force_ocr']
+    )
+
+def grade_tests_job(payload, progress):
+    return test_analyzer.grade_batch(payload['test_id'], payload['submissions'])
+
+# Worker threads and queue depth per job type
+JOB_TYPES = {
+    'upload-pdf': (upload_pdf_job, 'UPLOAD_PDF', 2, 20),
+    'generate-mcq': (generate_mcq_job, 'GENERATE_MCQ', 4, 50),
+    'get-tutoring': (tutoring_job, 'GET_TUTORING', 4, 50),
+    'get-tutoring-batch': (tutoring_batch_job, 'GET_TUTORING_BATCH', 2, 20),
+    'build-question-bank': (build_bank_job, 'BUILD_QUESTION_BANK', 1, 100),
+    'reprocess-pages': (reprocess_pages_job, 'REPROCESS_PAGES', 1, 20),
+    'grade-tests': (grade_tests_job, 'GRADE_TESTS', 2, 20)
+}
+
+def enqueue(job_type, payload):
+    """
+    Queue a job and answer 202 with its id, or 503 when that queue is full
+    """
+    try:
+        job_id = job_queue.submit(job_type, payload)
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 503
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': f"/jobs/{job_id}"
+    }), 202
+
+def lesson_events(document_id, topic):
+    for piece in tutoring_agent.stream_lesson(document_id, topic):
+        yield f"data: {json.dumps({'text': piece})}\n\n"
+    yield f"event: done\ndata: {json.dumps({'topic': topic})}\n\n"
+
+def wants_async(data):
+    return str(data.get('async', '')).lower() == 'true'
+
+def server_error(e):
+    current_app.logger.exception(f"{request.method} {request.path} failed")
+    return jsonify({'error': str(e)}), 500
+
+@api.before_app_request
+def start_request():
+    g.request_start = time.perf_counter()
+    if request.headers.get(current_app.config['TRACE_HEADER'], '').lower() in ('1', 'true'):
+        g.trace_token = start_trace()
+
+@api.after_app_request
+def finish_request(response):
+    elapsed = time.perf_counter() - g.pop('request_start', time.perf_counter())
+    token = g.pop('trace_token', None)
+    if token is not None:
+        # Time spent in each instrumented stage, e.g. retrieval, llm_call
+        response.headers['Server-Timing'] = server_timing(finish_trace(token) + [('total', elapsed)])
+
+    metrics = get_metrics()
+    metrics.observe(
+        'smartprep_http_request_seconds', elapsed,
+        endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+        method=request.method, status=response.status_code
+    )
+    metrics.flush()
+    return response
+
+@api.teardown_app_request
+def end_trace(error=None):
+    # A request that never reached finish_request must not leave its trace on the thread
+    token = g.pop('trace_token', None)
+    if token is not None:
+        finish_trace(token)
+
+@api.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'message': 'Server is running'}), 200
 
-@app.route('/upload-pdf', methods=['POST'])
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(get_metrics().render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/upload-pdf', methods=['POST'])
 def upload_pdf():
     try:
         if 'file' not in request.files:
@@ -52,32 +346,52 @@ def upload_pdf():
 
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-
-            # Extract text from PDF
-            text_content = pdf_processor.extract_text(filepath)
-
-            # Process with RAG agent
-            document_id = rag_agent.process_document(text_content, filename)
-
-            # Extract topics/sections
-            topics = rag_agent.extract_topics(text_content)
+            file_bytes = file.read()
+            content_key = ContentCache.hash_bytes(file_bytes)
+
+            record = cached_ingest(content_key)
+            if not record:
+                # Prefix with the content hash so same-named uploads never clobber each other
+                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{content_key[:16]}_{filename}")
+                with open(filepath, 'wb') as f:
+                    f.write(file_bytes)
+
+                # async=true: respond right away and let the client poll /jobs/<job_id>
+                if wants_async(request.form):
+                    return enqueue('upload-pdf', {
+                        'content_key': content_key,
+                        'filepath': filepath,
+                        'filename': filename,
+                        'document_id': str(uuid.uuid4())
+                    })
+
+                record = ingest_pdf(content_key, filepath, filename)
 
             return jsonify({
                 'success': True,
-                'document_id': document_id,
+                'document_id': record['document_id'],
                 'filename': filename,
-                'topics': topics,
-                'text_length': len(text_content)
+                'topics': record['topics'],
+                'text_length': record['text_length']
             }), 200
         else:
             return jsonify({'error': 'Invalid file type'}), 400
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return server_error(e)
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify({
+        'success': True,
+        'job': job
+    }), 200
 
-@app.route('/process-youtube', methods=['POST'])
+@api.route('/process-youtube', methods=['POST'])
 def process_youtube():
     try:
         data = request.get_json()
@@ -86,61 +400,84 @@ def process_youtube():
         if not youtube_url:
             return jsonify({'error': 'No YouTube URL provided'}), 400
 
-        # Extract transcript
-        transcript = youtube_processor.get_transcript(youtube_url)
-
-        if not transcript:
+        video_id = youtube_processor.extract_video_id(youtube_url)
+        if not video_id:
             return jsonify({'error': 'Could not extract transcript'}), 400
 
-        # Process with RAG agent
-        document_id = rag_agent.process_document(transcript, f"youtube_{youtube_url}")
+        content_key = ContentCache.hash_youtube(video_id)
+        with content_cache.lock(content_key):
+            record = cached_ingest(content_key)
+            if not record:
+                # Extract transcript
+                transcript = youtube_processor.get_transcript(youtube_url)
+
+                if not transcript:
+                    return jsonify({'error': 'Could not extract transcript'}), 400
 
-        # Extract topics
-        topics = rag_agent.extract_topics(transcript)
+                # Process with RAG agent
+                document_id = rag_agent.process_document(transcript, f"youtube_{youtube_url}")
+
+                # Extract topics
+                topics = rag_agent.extract_topics(transcript)
+
+                record = {
+                    'document_id': document_id,
+                    'topics': topics,
+                    'text_length': len(transcript)
+                }
+                content_cache.put(content_key, record)
+                schedule_bank_build(document_id)
 
         return jsonify({
             'success': True,
-            'document_id': document_id,
+            'document_id': record['document_id'],
             'url': youtube_url,
-            'topics': topics,
-            'text_length': len(transcript)
+            'topics': record['topics'],
+            'text_length': record['text_length']
         }), 200
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return server_error(e)
 
-@app.route('/generate-mcq', methods=['POST'])
+@api.route('/generate-mcq', methods=['POST'])
 def generate_mcq():
     try:
         data = request.get_json()
         document_id = data.get('document_id')
         num_questions = data.get('num_questions', 10)
+        # Optional: who is taking the test, so repeat tests avoid questions they've seen
+        session_id = data.get('session_id')
+        exclude_ids = data.get('exclude_question_ids', [])
+        # Optional: whose performance history the test counts towards
+        user_id = data.get('user_id')
 
         if not document_id:
             return jsonify({'error': 'No document ID provided'}), 400
 
-        # Retrieve document content
-        document_content = rag_agent.get_document(document_id)
-
-        if not document_content:
+        if not rag_agent.has_document(document_id):
             return jsonify({'error': 'Document not found'}), 404
 
-        # Generate MCQs
-        mcqs = mcq_generator.generate_questions(document_content, num_questions)
+        if wants_async(data):
+            return enqueue('generate-mcq', {
+                'document_id': document_id,
+                'num_questions': num_questions,
+                'session_id': session_id,
+                'exclude_question_ids': exclude_ids,
+                'user_id': user_id
+            })
 
-        # Create test session
-        test_id = test_analyzer.create_test_session(document_id, mcqs)
+        test = create_mcq_test(document_id, num_questions, session_id, exclude_ids, user_id)
 
         return jsonify({
             'success': True,
-            'test_id': test_id,
-            'questions': mcqs
+            'test_id': test['test_id'],
+            'questions': test['questions']
         }), 200
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return server_error(e)
 
-@app.route('/submit-test', methods=['POST'])
+@api.route('/submit-test', methods=['POST'])
 def submit_test():
     try:
         data = request.get_json()
@@ -159,9 +496,37 @@ def submit_test():
         }), 200
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return server_error(e)
+
+@api.route('/submit-tests-bulk', methods=['POST'])
+def submit_tests_bulk():
+    try:
+        data = request.get_json()
+        test_id = data.get('test_id')
+        submissions = data.get('submissions')  # List of {student_id, answers}
+
+        if not test_id or not submissions:
+            return jsonify({'error': 'Missing test ID or submissions'}), 400
+        if any(not isinstance(s, dict) or not isinstance(s.get('answers'), list) for s in submissions):
+            return jsonify({'error': 'Each submission needs a list of answers'}), 400
+
+        payload = {'test_id': test_id, 'submissions': submissions}
+        if wants_async(data):
+            return enqueue('grade-tests', payload)
+
+        # One vectorized pass over every answer sheet
+        results = grade_tests_job(payload, no_progress)
+
+        return jsonify(dict(results, success=True)), 200
+
+    except KeyError:
+        return jsonify({'error': 'Test not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return server_error(e)
 
-@app.route('/get-analysis/<test_id>', methods=['GET'])
+@api.route('/get-analysis/<test_id>', methods=['GET'])
 def get_analysis(test_id):
     try:
         analysis = test_analyzer.get_detailed_analysis(test_id)
@@ -175,10 +540,42 @@ def get_analysis(test_id):
         }), 200
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return server_error(e)
+
+@api.route('/performance-trends', methods=['GET'])
+def performance_trends():
+    try:
+        # Without user_id: trends over every submitted test
+        trends = test_analyzer.get_performance_trends(request.args.get('user_id'))
 
+        if not trends:
+            return jsonify({'error': 'No submitted tests'}), 404
 
-@app.route('/get-tutoring', methods=['POST'])
+        return jsonify({
+            'success': True,
+            'trends': trends
+        }), 200
+
+    except Exception as e:
+        return server_error(e)
+
+@api.route('/class-analytics/<document_id>', methods=['GET'])
+def class_analytics(document_id):
+    try:
+        analytics = test_analyzer.get_class_analytics(document_id)
+
+        if not analytics:
+            return jsonify({'error': 'No submitted tests for this document'}), 404
+
+        return jsonify({
+            'success': True,
+            'analytics': analytics
+        }), 200
+
+    except Exception as e:
+        return server_error(e)
+
+@api.route('/get-tutoring', methods=['POST'])
 def get_tutoring():
     try:
         data = request.get_json()
@@ -188,6 +585,17 @@ def get_tutoring():
         if not document_id or not topic:
             return jsonify({'error': 'Missing document_id or topic'}), 400
 
+        if wants_async(data):
+            return enqueue('get-tutoring', {'document_id': document_id, 'topic': topic})
+
+        # stream=true: server-sent events with the lesson text as it is written
+        if str(data.get('stream', '')).lower() == 'true':
+            return Response(
+                stream_with_context(lesson_events(document_id, topic)),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
         lesson = tutoring_agent.generate_lesson(document_id, topic)
 
         return jsonify({
@@ -197,8 +605,83 @@ def get_tutoring():
         }), 200
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return server_error(e)
+
+@api.route('/get-tutoring-batch', methods=['POST'])
+def get_tutoring_batch():
+    try:
+        data = request.get_json()
+        test_id = data.get('test_id')
+        document_id = data.get('document_id')
+        topics = data.get('topics')
+
+        # By default: a lesson for every weak area of a submitted test
+        if test_id:
+            session = test_analyzer.get_session(test_id)
+            if not session or not session.get('results'):
+                return jsonify({'error': 'Submitted test not found'}), 404
+            document_id = session['document_id']
+            if topics is None:
+                topics = [area['topic'] for area in session['results']['weak_areas']]
+
+        if not document_id or topics is None:
+            return jsonify({'error': 'Missing test_id, or document_id and topics'}), 400
+
+        if wants_async(data):
+            return enqueue('get-tutoring-batch', {'document_id': document_id, 'topics': topics})
+
+        lessons = tutoring_agent.generate_lessons(document_id, topics)
+
+        return jsonify({
+            'success': True,
+            'document_id': document_id,
+            'lessons': lessons
+        }), 200
+
+    except Exception as e:
+        return server_error(e)
+
+@api.route('/reprocess-pages', methods=['POST'])
+def reprocess_pages_route():
+    try:
+        data = request.get_json()
+        document_id = data.get('document_id')
+        first_page = data.get('first_page')
+        last_page = data.get('last_page', first_page)
+
+        if not document_id or not first_page:
+            return jsonify({'error': 'Missing document_id or first_page'}), 400
+        first_page, last_page = int(first_page), int(last_page)
+        if first_page < 1 or last_page < first_page:
+            return jsonify({'error': 'Invalid page range'}), 400
+        if not rag_agent.has_document(document_id):
+            return jsonify({'error': 'Document not found'}), 404
+
+        # ocr=true re-runs OCR even where the PDF has a text layer
+        payload = {
+            'document_id': document_id,
+            'first_page': first_page,
+            'last_page': last_page,
+            'force_ocr': str(data.get('ocr', '')).lower() == 'true'
+        }
+        if wants_async(data):
+            return enqueue('reprocess-pages', payload)
+
+        result = reprocess_pages_job(payload, no_progress)
+        return jsonify(dict(result, success=True)), 200
+
+    except PatchConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return server_error(e)
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Development server only; production runs wsgi:app under gunicorn
+    create_app().run(
+        debug=os.environ.get('FLASK_DEBUG') == '1',
+        host='0.0.0.0',
+        port=int(os.environ.get('PORT', 5000))
+    )
@@ -0,0 +1,30 @@
+import os
+import multiprocessing
+
+# Bind address and port
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+
+# One worker process per core plus one, each with a pool of request threads.
+# Requests mostly wait on Gemini, so threads keep a worker busy while it waits.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+threads = int(os.environ.get('WEB_THREADS', 8))
+# Workers inherit this, so the app knows how many processes share the machine
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = 'gthread'
+
+# Workers build their services (and job threads, process pools) after the
+# fork rather than inheriting them from the master. Each worker gets its own,
+# so the app reads WEB_CONCURRENCY too and sizes them as a share of the
+# server: cpu_count // WEB_CONCURRENCY OCR processes per worker unless
+# PDF_WORKERS is set, and, with a shared JOB_QUEUE_DB, <TYPE>_WORKERS job
+# threads across all workers rather than in each
+preload_app = False
+
+# Synchronous lesson and MCQ requests can take a while; SSE streams keep
+# the connection open for the whole lesson
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
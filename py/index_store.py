@@ -0,0 +1,292 @@
+import os
+import json
+import mmap
+import shutil
+import sys
+import uuid
+from collections.abc import Sequence
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import scipy.sparse as sp
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-writer only
+    fcntl = None
+
+
+MMAP_OPTIONS = {'trackfd': False} if sys.version_info >= (3, 13) else {}
+
+
+class PatchConflict(Exception):
+    """The document was patched by someone else since the patch was built on it"""
+    pass
+
+
+class ChunkBlob(Sequence):
+    """
+    Read-only list of chunk strings backed by a memory-mapped UTF-8 blob and
+    an array of byte offsets. Pages are shared between processes.
+    """
+
+    def __init__(self, blob_path, offsets_path):
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        if self.offsets[-1] > 0:
+            # The mapping outlives the file, so it is closed right away. mmap
+            # keeps a duplicate descriptor of its own unless told not to (3.13+)
+            with open(blob_path, 'rb') as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ, **MMAP_OPTIONS)
+        else:
+            self._blob = b''  # mmap refuses empty files
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('chunk index out of range')
+        return self._blob[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+
+class ChunkChain(Sequence):
+    """
+    Read-only concatenation of chunk sequences, e.g. a document's stored
+    chunks followed by the chunks of its patches
+    """
+
+    def __init__(self, parts):
+        self.parts = []
+        for part in parts:
+            self.parts.extend(part.parts if isinstance(part, ChunkChain) else [part])
+        self.starts = np.cumsum([0] + [len(part) for part in self.parts])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('chunk index out of range')
+        pos = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return self.parts[pos][i - self.starts[pos]]
+
+
+class IndexStore:
+    """
+    On-disk layout for the RAG index. Each document is written once as its own
+    segment directory and never modified:
+
+        manifest.json                  document ids, filenames, chunk counts
+        segments/<id>/indptr.npy       CSR term-count matrix, loaded with mmap
+        segments/<id>/indices.npy
+        segments/<id>/data.npy
+        segments/<id>/chunks.bin       chunk text, concatenated UTF-8
+        segments/<id>/offsets.npy      byte offsets into chunks.bin
+        segments/<id>/full_text.txt
+        segments/<id>/codes.npy        optional dense embeddings (int8 or float16)
+        segments/<id>/scales.npy       per-row scales for int8 codes
+        segments/<id>/spans.npy        per chunk: start, end offset in full_text, first, last page
+        segments/<id>/pages.npy        per page: page number, start offset in full_text
+
+    Re-extracting some pages adds a patch directory, segments/<id>/<patch_id>/,
+    holding only the replacement chunks (counts, chunks, embeddings), the
+    indices of the chunks they retire (removed.npy) and the document's new
+    full_text, spans and pages. Patches are listed under their document in
+    the manifest and applied in order.
+
+    Writers hold an exclusive lock while appending to the manifest, so several
+    worker processes can share one directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.segments_dir = os.path.join(root, 'segments')
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.lock_path = os.path.join(root, '.lock')
+        os.makedirs(self.segments_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def manifest_mtime(self):
+        try:
+            return os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'documents': []}
+
+    def _write_json(self, path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def save_document(self, document_id, filename, full_text, chunks, counts,
+                      embeddings=None, embedding_model=None, spans=None, pages=None, source_path=None):
+        """
+        Write a document's segment, then publish it in the manifest.
+        embeddings is an optional (codes, scales) pair from DenseIndex.encode();
+        spans and pages are the chunk and page offset tables.
+        """
+        final_dir = os.path.join(self.segments_dir, document_id)
+        entry = self._write_segment(final_dir, full_text, chunks, counts, embeddings, embedding_model, spans, pages)
+        entry.update(document_id=document_id, filename=filename, patches=[])
+        if source_path:
+            entry['source_path'] = source_path
+
+        with self._locked():
+            manifest = self.load_manifest()
+            manifest['documents'].append(entry)
+            self._write_json(self.manifest_path, manifest)
+
+    def save_patch(self, document_id, full_text, chunks, counts, removed, spans, pages,
+                   embeddings=None, embedding_model=None, base_patches=None):
+        """
+        Write replacement chunks for some of a stored document's chunks
+        (removed holds their chunk indices), then list the patch under the
+        document in the manifest. Returns the patch id.
+
+        base_patches is how many patches the document had when this one was
+        computed. Its chunk numbering and offsets only hold on top of
+        exactly those, so PatchConflict is raised (and nothing published)
+        if another patch was listed since.
+        """
+        patch_id = f"patch-{uuid.uuid4().hex}"
+        final_dir = os.path.join(self.segments_dir, document_id, patch_id)
+        entry = self._write_segment(final_dir, full_text, chunks, counts, embeddings, embedding_model, spans, pages)
+        np.save(os.path.join(final_dir, 'removed.npy'), np.asarray(removed, dtype=np.int32))
+        entry['patch_id'] = patch_id
+        entry['base_patches'] = base_patches
+
+        with self._locked():
+            manifest = self.load_manifest()
+            for document in manifest['documents']:
+                if document['document_id'] != document_id:
+                    continue
+                patches = document.setdefault('patches', [])
+                if base_patches is not None and len(patches) != base_patches:
+                    shutil.rmtree(final_dir, ignore_errors=True)
+                    raise PatchConflict(
+                        f"Document {document_id} has {len(patches)} patches, this one was built on {base_patches}"
+                    )
+                patches.append(entry)
+            self._write_json(self.manifest_path, manifest)
+        return patch_id
+
+    def _write_segment(self, final_dir, full_text, chunks, counts, embeddings, embedding_model, spans, pages):
+        """Write one segment directory atomically; returns its manifest fields"""
+        tmp_dir = f"{final_dir}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(tmp_dir)
+
+        counts = counts.tocsr()
+        np.save(os.path.join(tmp_dir, 'indptr.npy'), counts.indptr)
+        np.save(os.path.join(tmp_dir, 'indices.npy'), counts.indices)
+        np.save(os.path.join(tmp_dir, 'data.npy'), counts.data)
+
+        encoded = [chunk.encode('utf-8') for chunk in chunks]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        with open(os.path.join(tmp_dir, 'chunks.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+
+        with open(os.path.join(tmp_dir, 'full_text.txt'), 'w', encoding='utf-8') as f:
+            f.write(full_text)
+
+        entry = {
+            'chunk_count': len(chunks),
+            'n_features': counts.shape[1],
+            'created_at': datetime.now().isoformat()
+        }
+        if spans is not None:
+            np.save(os.path.join(tmp_dir, 'spans.npy'), np.asarray(spans, dtype=np.int32).reshape(-1, 4))
+        if pages is not None:
+            np.save(os.path.join(tmp_dir, 'pages.npy'), np.asarray(pages, dtype=np.int32).reshape(-1, 2))
+        if embeddings is not None:
+            codes, scales = embeddings
+            np.save(os.path.join(tmp_dir, 'codes.npy'), codes)
+            if scales is not None:
+                np.save(os.path.join(tmp_dir, 'scales.npy'), scales)
+            entry['embedding_model'] = embedding_model
+            entry['embedding_dtype'] = str(codes.dtype)
+
+        os.replace(tmp_dir, final_dir)
+        return entry
+
+    def _segment_dir(self, document_id, patch_id=None):
+        seg_dir = os.path.join(self.segments_dir, document_id)
+        return os.path.join(seg_dir, patch_id) if patch_id else seg_dir
+
+    def load_counts(self, entry, patch=None):
+        """Memory-map a document's (or one of its patches') term-count matrix (read-only)"""
+        seg_dir = self._segment_dir(entry['document_id'], patch and patch['patch_id'])
+        entry = patch or entry
+        indptr = np.load(os.path.join(seg_dir, 'indptr.npy'), mmap_mode='r')
+        indices = np.load(os.path.join(seg_dir, 'indices.npy'), mmap_mode='r')
+        data = np.load(os.path.join(seg_dir, 'data.npy'), mmap_mode='r')
+        return sp.csr_matrix(
+            (data, indices, indptr),
+            shape=(entry['chunk_count'], entry['n_features']),
+            copy=False
+        )
+
+    def load_embeddings(self, entry, embedding_model, dtype, patch=None):
+        """
+        Memory-map a document's (or patch's) (codes, scales), or None when it
+        was stored without embeddings or with a different model or dtype
+        """
+        seg_dir = self._segment_dir(entry['document_id'], patch and patch['patch_id'])
+        entry = patch or entry
+        if entry.get('embedding_model') != embedding_model or entry.get('embedding_dtype') != dtype:
+            return None
+        codes = np.load(os.path.join(seg_dir, 'codes.npy'), mmap_mode='r')
+        scales_path = os.path.join(seg_dir, 'scales.npy')
+        scales = np.load(scales_path, mmap_mode='r') if os.path.exists(scales_path) else None
+        return codes, scales
+
+    def load_chunks(self, document_id, patch_id=None):
+        seg_dir = self._segment_dir(document_id, patch_id)
+        return ChunkBlob(os.path.join(seg_dir, 'chunks.bin'), os.path.join(seg_dir, 'offsets.npy'))
+
+    def load_full_text(self, document_id, patch_id=None):
+        """The document's full text as of its given (normally latest) patch"""
+        with open(os.path.join(self._segment_dir(document_id, patch_id), 'full_text.txt'), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def _load_array(self, document_id, patch_id, name):
+        path = os.path.join(self._segment_dir(document_id, patch_id), name)
+        return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+    def load_spans(self, document_id, patch_id=None):
+        """(n_chunks, 4) chunk spans, or None for documents stored without them"""
+        return self._load_array(document_id, patch_id, 'spans.npy')
+
+    def load_pages(self, document_id, patch_id=None):
+        """(n_pages, 2) page offset table, or None for documents stored without it"""
+        return self._load_array(document_id, patch_id, 'pages.npy')
+
+    def load_removed(self, document_id, patch_id):
+        """Chunk indices a patch retires"""
+        return self._load_array(document_id, patch_id, 'removed.npy')
@@ -0,0 +1,298 @@
+import os
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+# Finished jobs older than retention_seconds are deleted at most this often
+PRUNE_INTERVAL = 60
+
+# Owner ids of the queues created in this process
+_owners = set()
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Background jobs for slow endpoints (OCR, Gemini calls).
+
+    Each job type has its own handler, worker count and queue depth limit.
+    submit() returns a job id immediately and a bounded pool of worker
+    threads runs the handler; clients poll get() for status and result.
+
+    Jobs live in memory by default. With db_path set they are kept in a
+    local SQLite table instead, so every worker process can report status
+    for any job and can pick up queued work. A running job records the
+    process that claimed it; when a queue starts up, running jobs whose
+    process is gone (crashed or restarted) are marked failed.
+    """
+
+    def __init__(self, db_path=None, retention_seconds=3600, poll_interval=0.5):
+        self.db_path = db_path
+        self.retention_seconds = retention_seconds
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self.limits = {}
+        self._jobs = {}
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # Written to the jobs this process claims: pid plus a token, since pids get reused
+        self.owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        _owners.add(self.owner)
+        self._last_prune = 0.0
+
+        if db_path:
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        job_id TEXT PRIMARY KEY,
+                        job_type TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        payload TEXT,
+                        progress TEXT,
+                        result TEXT,
+                        error TEXT,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_type_status ON jobs (job_type, status, created_at)')
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+                if 'owner' not in columns:
+                    conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+            self._fail_orphans()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _fail_orphans(self):
+        """
+        Mark failed every running job whose claiming process no longer
+        exists; nothing else would ever finish or requeue it. They are not
+        requeued, since a job that brought its worker down could again.
+        """
+        with self._connect() as conn:
+            running = conn.execute("SELECT job_id, owner FROM jobs WHERE status = 'running'").fetchall()
+            orphans = [job_id for job_id, owner in running if not self._owner_alive(owner)]
+            conn.executemany(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE job_id = ? AND status = 'running'",
+                [('The worker running this job stopped before it finished', time.time(), job_id) for job_id in orphans]
+            )
+        for job_id in orphans:
+            print(f"Job {job_id} was left running by a stopped worker; marked failed")
+
+    def _owner_alive(self, owner):
+        if not owner:
+            return False
+        pid = int(owner.partition(':')[0])
+        if pid == os.getpid():
+            # Ours, or an earlier process that had our pid
+            return owner in _owners
+        if os.name == 'nt':
+            return True  # os.kill would terminate it, not probe it
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def register(self, job_type, handler, workers=2, max_queued=50):
+        """
+        handler(payload, progress) runs on a worker thread; progress(**fields)
+        publishes intermediate state. Its return value becomes the job result.
+        """
+        self.handlers[job_type] = handler
+        self.limits[job_type] = {'workers': workers, 'max_queued': max_queued}
+        self._queues[job_type] = queue.Queue()
+
+        for _ in range(workers):
+            threading.Thread(target=self._worker_loop, args=(job_type,), daemon=True).start()
+
+    def submit(self, job_type, payload):
+        if job_type not in self.handlers:
+            raise ValueError(f"Unknown job type: {job_type}")
+
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        max_queued = self.limits[job_type]['max_queued']
+
+        if self.db_path:
+            with self._connect() as conn:
+                depth = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE job_type = ? AND status = 'queued'", (job_type,)
+                ).fetchone()[0]
+                if depth >= max_queued:
+                    raise QueueFull(f"Too many queued {job_type} jobs")
+                conn.execute(
+                    'INSERT INTO jobs (job_id, job_type, status, payload, progress, result, error, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (job_id, job_type, 'queued', json.dumps(payload), json.dumps({}), None, None, now, now)
+                )
+            with self._wakeup:
+                self._wakeup.notify_all()
+            return job_id
+
+        with self._lock:
+            self._prune(now)
+            if self._queues[job_type].qsize() >= max_queued:
+                raise QueueFull(f"Too many queued {job_type} jobs")
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'job_type': job_type,
+                'status': 'queued',
+                'payload': payload,
+                'progress': {},
+                'result': None,
+                'error': None,
+                'created_at': now,
+                'updated_at': now
+            }
+        self._queues[job_type].put(job_id)
+        return job_id
+
+    def get(self, job_id):
+        """
+        Public view of a job: status, progress, result and error
+        """
+        self._maybe_prune()
+        if self.db_path:
+            with self._connect() as conn:
+                row = conn.execute(
+                    'SELECT job_id, job_type, status, progress, result, error, created_at, updated_at '
+                    'FROM jobs WHERE job_id = ?', (job_id,)
+                ).fetchone()
+            if not row:
+                return None
+            job = {
+                'job_id': row[0],
+                'job_type': row[1],
+                'status': row[2],
+                'progress': json.loads(row[3]) if row[3] else {},
+                'result': json.loads(row[4]) if row[4] else None,
+                'error': row[5],
+                'created_at': row[6],
+                'updated_at': row[7]
+            }
+        else:
+            with self._lock:
+                stored = self._jobs.get(job_id)
+                if not stored:
+                    return None
+                job = {k: v for k, v in stored.items() if k != 'payload'}
+                job['progress'] = dict(stored['progress'])
+
+        job['created_at'] = datetime.fromtimestamp(job['created_at']).isoformat()
+        job['updated_at'] = datetime.fromtimestamp(job['updated_at']).isoformat()
+        return job
+
+    def _update(self, job_id, **fields):
+        now = time.time()
+        if self.db_path:
+            columns = []
+            values = []
+            for key, value in fields.items():
+                columns.append(f"{key} = ?")
+                values.append(json.dumps(value) if key in ('progress', 'result') else value)
+            with self._connect() as conn:
+                conn.execute(
+                    f"UPDATE jobs SET {', '.join(columns)}, updated_at = ? WHERE job_id = ?",
+                    values + [now, job_id]
+                )
+            return
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.update(fields)
+                job['updated_at'] = now
+
+    def _maybe_prune(self):
+        """Delete expired finished jobs, at most every PRUNE_INTERVAL seconds"""
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM jobs WHERE status IN ('completed', 'failed') AND updated_at < ?",
+                    (now - self.retention_seconds,)
+                )
+            return
+        with self._lock:
+            self._prune(now)
+
+    def _prune(self, now):
+        # Finished in-memory jobs are only kept long enough to be polled
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['status'] in ('completed', 'failed') and now - job['updated_at'] > self.retention_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _claim(self, job_type):
+        """
+        Take the oldest queued job of this type. Returns (job_id, payload) or None.
+        """
+        if not self.db_path:
+            job_id = self._queues[job_type].get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if not job:
+                    return None
+                job['status'] = 'running'
+                job['updated_at'] = time.time()
+                return job_id, job['payload']
+
+        with self._connect() as conn:
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT job_id, payload FROM jobs WHERE job_type = ? AND status = 'queued' "
+                'ORDER BY created_at LIMIT 1', (job_type,)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', owner = ?, updated_at = ? WHERE job_id = ?",
+                    (self.owner, time.time(), row[0])
+                )
+            conn.execute('COMMIT')
+
+        if row:
+            return row[0], json.loads(row[1])
+
+        with self._wakeup:
+            self._wakeup.wait(self.poll_interval)
+        return None
+
+    def _worker_loop(self, job_type):
+        handler = self.handlers[job_type]
+        while True:
+            self._maybe_prune()
+            claimed = self._claim(job_type)
+            if not claimed:
+                continue
+            job_id, payload = claimed
+            progress = {}
+
+            def report(**fields):
+                progress.update(fields)
+                self._update(job_id, progress=progress)
+
+            try:
+                result = handler(payload, report)
+                self._update(job_id, status='completed', result=result)
+            except Exception as e:
+                print(f"Job {job_id} ({job_type}) failed: {e}")
+                self._update(job_id, status='failed', error=str(e))
@@ -0,0 +1,352 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from metrics import get_metrics
+
+load_dotenv()
+
+DEFAULT_MODEL = 'gemini-2.5-flash'
+
+
+class GeminiBackend:
+    """Calls Google Gemini through google.generativeai"""
+
+    def __init__(self, model_name=DEFAULT_MODEL):
+        import google.generativeai as genai
+
+        # Configure Gemini once for every agent
+        genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt, json_mode=False):
+        """Returns (text, usage) where usage holds token counts"""
+        if json_mode:
+            response = self.model.generate_content(
+                prompt,
+                generation_config={"response_mime_type": "application/json"}
+            )
+        else:
+            response = self.model.generate_content(prompt)
+
+        return response.text, self._usage(response)
+
+    def stream(self, prompt, usage):
+        """Yields text pieces as Gemini produces them; fills usage at the end"""
+        response = self.model.generate_content(prompt, stream=True)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+        usage.update(self._usage(response))
+
+    @staticmethod
+    def _usage(response):
+        usage = getattr(response, 'usage_metadata', None)
+        return {
+            'prompt_tokens': getattr(usage, 'prompt_token_count', 0) or 0,
+            'output_tokens': getattr(usage, 'candidates_token_count', 0) or 0
+        }
+
+
+class StubBackend:
+    """
+    Offline backend for tests and benchmarks. responder(prompt, json_mode)
+    returns the response text; by default JSON prompts get an empty list and
+    text prompts get a short canned reply.
+    """
+
+    def __init__(self, responder=None, latency=0.0):
+        self.model_name = 'stub'
+        self.responder = responder
+        self.latency = latency
+
+    def generate(self, prompt, json_mode=False):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.responder:
+            text = self.responder(prompt, json_mode)
+        else:
+            text = '[]' if json_mode else f"Stub response ({len(prompt)} prompt characters)"
+        return text, {'prompt_tokens': len(prompt.split()), 'output_tokens': len(text.split())}
+
+    def stream(self, prompt, usage):
+        text = self.responder(prompt, False) if self.responder else \
+            f"Stub response ({len(prompt)} prompt characters)"
+        words = text.split(' ')
+        for i, word in enumerate(words):
+            if self.latency:
+                time.sleep(self.latency / len(words))
+            yield word if i == 0 else ' ' + word
+        usage.update({'prompt_tokens': len(prompt.split()), 'output_tokens': len(words)})
+
+
+class LLMClient:
+    """
+    One LLM client shared by every agent.
+
+    Responses are cached by a hash of (model, mode, prompt): an in-memory LRU
+    first, then an optional SQLite tier with a TTL so results survive
+    restarts and are shared between workers. Identical prompts that arrive
+    while the first is still in flight wait for that call instead of making
+    their own. Every real call's latency and token counts are recorded, in
+    get_stats() and in the process metrics served at /metrics.
+    """
+
+    def __init__(self, backend, cache_size=512, cache_db=None, ttl_seconds=7 * 24 * 3600, history=1000):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.cache_db = cache_db
+        self.ttl_seconds = ttl_seconds
+
+        self._memory = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        self.calls = deque(maxlen=history)
+        self.metrics = get_metrics()
+        self.stats = {
+            'calls': 0,
+            'errors': 0,
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'coalesced': 0,
+            'latency_seconds': 0.0,
+            'prompt_tokens': 0,
+            'output_tokens': 0
+        }
+
+        if cache_db:
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS llm_cache '
+                    '(key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)'
+                )
+
+    def _connect(self):
+        return sqlite3.connect(self.cache_db, timeout=30)
+
+    def cache_key(self, prompt, json_mode=False):
+        raw = json.dumps([self.backend.model_name, bool(json_mode), prompt])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def generate(self, prompt, json_mode=False, use_cache=True, validate=None):
+        """
+        Return the model's text response for a prompt. validate(text), e.g.
+        json.loads, must not raise for a response to be cached; a response
+        that fails it is dropped from the cache and the error re-raised, so
+        the next call asks the model again instead of replaying it.
+        """
+        if not use_cache:
+            text = self._call(prompt, json_mode)
+            if validate is not None:
+                validate(text)
+            return text
+
+        key = self.cache_key(prompt, json_mode)
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                self.metrics.inc('smartprep_llm_requests_total', outcome='memory_hit')
+        if text is not None:
+            self._validate(key, text, validate)
+            return text
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.stats['coalesced'] += 1
+                self.metrics.inc('smartprep_llm_requests_total', outcome='coalesced')
+
+        if not owner:
+            return future.result()
+
+        try:
+            text = self._disk_get(key)
+            if text is None:
+                text = self._call(prompt, json_mode)
+                if validate is not None:
+                    validate(text)
+                self._disk_put(key, text)
+            else:
+                # Possibly cached by a caller that did not validate
+                self._validate(key, text, validate)
+            self._remember(key, text)
+            future.set_result(text)
+            return text
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def stream(self, prompt):
+        """
+        Yield the response text piece by piece as the model produces it. A
+        cached response is yielded whole; a completed stream fills the cache,
+        an abandoned one (client went away) does not.
+        """
+        key = self.cache_key(prompt)
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                self.metrics.inc('smartprep_llm_requests_total', outcome='memory_hit')
+        if text is None:
+            text = self._disk_get(key)
+            if text is not None:
+                self._remember(key, text)
+        if text is not None:
+            yield text
+            return
+
+        start = time.perf_counter()
+        first_piece = None
+        pieces = []
+        usage = {'prompt_tokens': 0, 'output_tokens': 0}
+        try:
+            for piece in self.backend.stream(prompt, usage):
+                if first_piece is None:
+                    first_piece = time.perf_counter() - start
+                pieces.append(piece)
+                yield piece
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+            self.metrics.inc('smartprep_llm_requests_total', outcome='error')
+            raise
+
+        text = ''.join(pieces)
+        self._record(False, time.perf_counter() - start, usage, first_piece, streamed=True)
+        self._remember(key, text)
+        self._disk_put(key, text)
+
+    def _call(self, prompt, json_mode):
+        start = time.perf_counter()
+        try:
+            text, usage = self.backend.generate(prompt, json_mode)
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+            self.metrics.inc('smartprep_llm_requests_total', outcome='error')
+            raise
+        self._record(json_mode, time.perf_counter() - start, usage)
+        return text
+
+    def _record(self, json_mode, latency, usage, first_piece=None, streamed=False):
+        mode = 'stream' if streamed else 'json' if json_mode else 'text'
+        model = self.backend.model_name
+        self.metrics.observe('smartprep_llm_call_seconds', latency, model=model, mode=mode)
+        if first_piece is not None:
+            self.metrics.observe('smartprep_llm_first_piece_seconds', first_piece, model=model)
+        self.metrics.inc('smartprep_llm_requests_total', outcome='call')
+        self.metrics.inc('smartprep_llm_tokens_total', usage['prompt_tokens'], kind='prompt')
+        self.metrics.inc('smartprep_llm_tokens_total', usage['output_tokens'], kind='output')
+        with self._lock:
+            self.stats['calls'] += 1
+            self.stats['latency_seconds'] += latency
+            self.stats['prompt_tokens'] += usage['prompt_tokens']
+            self.stats['output_tokens'] += usage['output_tokens']
+            call = {
+                'model': self.backend.model_name,
+                'json_mode': bool(json_mode),
+                'latency_seconds': round(latency, 4),
+                'prompt_tokens': usage['prompt_tokens'],
+                'output_tokens': usage['output_tokens'],
+                'timestamp': time.time()
+            }
+            if first_piece is not None:
+                call['first_piece_seconds'] = round(first_piece, 4)
+            self.calls.append(call)
+
+    def _validate(self, key, text, validate):
+        """Run validate on a cached response, evicting it if it fails"""
+        if validate is None:
+            return
+        try:
+            validate(text)
+        except Exception:
+            with self._lock:
+                self._memory.pop(key, None)
+            if self.cache_db:
+                with self._connect() as conn:
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+            raise
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._memory[key] = text
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.cache_size:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        if not self.cache_db:
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT response, created_at FROM llm_cache WHERE key = ?', (key,)
+            ).fetchone()
+        if row and time.time() - row[1] <= self.ttl_seconds:
+            with self._lock:
+                self.stats['disk_hits'] += 1
+            self.metrics.inc('smartprep_llm_requests_total', outcome='disk_hit')
+            return row[0]
+        return None
+
+    def _disk_put(self, key, text):
+        if not self.cache_db:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)', (key, text, time.time())
+            )
+            # Drop expired entries opportunistically
+            conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (time.time() - self.ttl_seconds,))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['average_latency_seconds'] = (
+            round(stats['latency_seconds'] / stats['calls'], 4) if stats['calls'] else 0.0
+        )
+        return stats
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_llm_client():
+    """
+    Process-wide client. LLM_BACKEND=stub selects the offline backend;
+    LLM_CACHE_DB enables the on-disk cache tier.
+    """
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            if os.environ.get('LLM_BACKEND', 'gemini').lower() == 'stub':
+                backend = StubBackend()
+            else:
+                backend = GeminiBackend(os.environ.get('GEMINI_MODEL', DEFAULT_MODEL))
+            _default_client = LLMClient(
+                backend,
+                cache_size=int(os.environ.get('LLM_CACHE_SIZE', 512)),
+                cache_db=os.environ.get('LLM_CACHE_DB') or None,
+                ttl_seconds=int(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600))
+            )
+        return _default_client
@@ -1,31 +1,174 @@
-import os
+import re
 import json
 import uuid
 import random
-import google.generativeai as genai
-from dotenv import load_dotenv
-
-load_dotenv()
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import get_llm_client
+from text_chunker import page_label
 
 class MCQGenerator:
-    def __init__(self):
-        # Configure Gemini
-        genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+    def __init__(self, llm=None, batch_size=10, max_workers=5, max_chars_per_batch=12000,
+                 max_rounds=3, duplicate_threshold=0.8, bank=None, bank_target_size=60,
+                 bank_refill_threshold=20, max_avoid=100):
+        # Shared, cached Gemini client
+        self.llm = llm or get_llm_client()
+
+        # Large requests are split into batches of questions generated concurrently
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_chars_per_batch = max_chars_per_batch
+        self.max_rounds = max_rounds
+        self.duplicate_threshold = duplicate_threshold
+        self.max_avoid = max_avoid
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+        # Optional per-document QuestionBank that tests are sampled from
+        self.bank = bank
+        self.bank_target_size = bank_target_size
+        self.bank_refill_threshold = bank_refill_threshold
 
     def generate_questions(self, document_content, num_questions=10):
         """
         Generate MCQ questions using Google Gemini
         """
-        text = document_content['full_text']
+        questions = self._generate_unique(document_content, num_questions)
+
+        if not questions:
+            return self._generate_fallback_questions(num_questions)
+
+        return questions
+
+    def create_test(self, document_id, num_questions, load_document, session_id=None, exclude_ids=()):
+        """
+        Assemble a test from the document's question bank, balanced by topic
+        and difficulty and skipping questions this session has already seen.
+        The LLM is only called for the shortfall when the bank runs low.
+        load_document() returns the document content and is only called then.
+        """
+        if self.bank is None:
+            return self.generate_questions(load_document(), num_questions)
+
+        missing = num_questions - self.bank.unseen_count(document_id, session_id, exclude_ids)
+        if missing > 0:
+            self._refill_bank(document_id, load_document(), missing)
+
+        questions = self.bank.sample(document_id, num_questions, session_id, exclude_ids)
+        if not questions:
+            return self._generate_fallback_questions(num_questions)
+
+        return questions
+
+    def build_question_bank(self, document_id, document_content, target_size=None):
+        """
+        Fill the document's bank up to target_size questions. Meant to run in
+        the background after ingestion; concurrent builds of one document are
+        collapsed into the first. Returns the bank size.
+        """
+        target_size = target_size or self.bank_target_size
+        with self.bank.building(document_id) as claimed:
+            # Another thread or worker process is already building it
+            if not claimed:
+                return self.bank.size(document_id)
+
+            missing = target_size - self.bank.size(document_id)
+            if missing > 0:
+                self._refill_bank(document_id, document_content, missing)
+            return self.bank.size(document_id)
+
+    def bank_needs_refill(self, document_id, session_id=None):
+        if self.bank is None:
+            return False
+        return self.bank.unseen_count(document_id, session_id) < self.bank_refill_threshold
+
+    def _refill_bank(self, document_id, document_content, num_questions):
+        existing = self.bank.questions(document_id)
+        questions = self._generate_unique(document_content, num_questions, existing)
+        if not questions:
+            return
+        # Re-read under the lock: another worker may have added questions meanwhile
+        with self.bank.locked(document_id):
+            merged = self._merge_unique(self.bank.questions(document_id), questions)
+            self.bank.replace(document_id, merged)
+
+    def _generate_unique(self, document_content, num_questions, existing=()):
+        """
+        Questions are requested in batches of batch_size, each from a
+        different slice of the document, and the batches run concurrently.
+        Near-duplicates are dropped and missing questions are topped up in
+        further rounds until num_questions is reached. Prompts list the
+        existing questions so the model doesn't repeat them.
+        """
+        questions = []
+        existing = [q['question'] for q in existing]
+
+        for _ in range(self.max_rounds):
+            missing = num_questions - len(questions)
+            if missing <= 0:
+                break
+
+            batch_counts = [self.batch_size] * (missing // self.batch_size)
+            if missing % self.batch_size:
+                batch_counts.append(missing % self.batch_size)
+            sources = self._batch_sources(document_content, len(batch_counts))
+            avoid = (existing + [q['question'] for q in questions])[-self.max_avoid:]
+
+            futures = [
+                self._pool.submit(self._generate_batch, source, count, avoid)
+                for source, count in zip(sources, batch_counts)
+            ]
+            for future in futures:
+                questions = self._merge_unique(questions, future.result())
+
+        return questions[:num_questions]
+
+    def _batch_sources(self, document_content, n_batches):
+        """
+        Split the document into n_batches source texts that together cover it,
+        each capped at max_chars_per_batch. Chunks are sampled at random so a
+        top-up round draws on different material.
+        """
         chunks = document_content['chunks']
+        text = document_content['full_text']
+        spans = document_content.get('chunk_spans')
 
-        # Sample text if too long (Gemini 1.5 has huge context, but let's be safe)
-        if len(chunks) > 15:
-            sampled_chunks = random.sample(chunks, min(15, len(chunks)))
-            text_for_generation = '\n\n'.join(sampled_chunks)
-        else:
-            text_for_generation = text[:30000] # Gemini handles large text easily
+        if len(chunks) >= n_batches and len(chunks) > 1:
+            sources = []
+            for i in range(n_batches):
+                group = range(i, len(chunks), n_batches)
+                picked = []
+                size = 0
+                for index in random.sample(group, len(group)):
+                    chunk = chunks[index]
+                    if picked and size + len(chunk) > self.max_chars_per_batch:
+                        break
+                    size += len(chunk)
+                    # Tag excerpts with their pages so explanations can cite them
+                    if spans is not None and len(spans) == len(chunks):
+                        chunk = f"[{page_label(int(spans[index][2]), int(spans[index][3]))}]\n{chunk}"
+                    picked.append(chunk)
+                sources.append('\n\n'.join(picked)[:self.max_chars_per_batch])
+            return sources
+
+        # Too few chunks to spread: cut the full text into windows instead
+        window = max(1, -(-len(text) // n_batches))
+        sources = []
+        for i in range(n_batches):
+            piece = text[i * window:(i + 1) * window]
+            if len(piece) > self.max_chars_per_batch:
+                start = random.randint(0, len(piece) - self.max_chars_per_batch)
+                piece = piece[start:start + self.max_chars_per_batch]
+            sources.append(piece)
+        return sources
+
+    def _generate_batch(self, text_for_generation, num_questions, avoid=None):
+        """
+        One Gemini call for up to batch_size questions. Returns [] on failure
+        so the other batches can still fill the test.
+        """
+        avoid_text = ""
+        if avoid:
+            avoid_text = "\n        Do NOT repeat or paraphrase any of these existing questions:\n" + \
+                "\n".join(f"        - {q}" for q in avoid)
 
         prompt = f"""
         You are an expert educational assessment creator. Generate exactly {num_questions} high-quality multiple choice questions based on the provided content.
@@ -35,6 +178,8 @@ class MCQGenerator:
         2. Cover different topics/sections.
         3. Mix difficulty levels (easy, medium, hard).
         4. Output MUST be valid JSON only, no markdown formatting.
+        5. Where the content is tagged with pages, e.g. [p. 12], list the pages each question is based on in "source_pages" and end its explanation with them, e.g. "(p. 12)". Otherwise leave "source_pages" empty.
+        {avoid_text}
 
         JSON Structure:
         [
@@ -42,14 +187,15 @@ class MCQGenerator:
             "question": "Question text?",
             "options": {{
               "A": "Option 1",
-              "B": "Option 2", 
+              "B": "Option 2",
               "C": "Option 3",
               "D": "Option 4"
             }},
             "correct_answer": "B",
             "topic": "Topic Name",
             "difficulty": "medium",
-            "explanation": "Explanation here"
+            "explanation": "Explanation here (p. 12)",
+            "source_pages": [12]
           }}
         ]
 
@@ -59,39 +205,60 @@ class MCQGenerator:
 
         try:
             # Force JSON response type
-            response = self.model.generate_content(
-                prompt,
-                generation_config={"response_mime_type": "application/json"}
-            )
+            content = self.llm.generate(prompt, json_mode=True, validate=json.loads).strip()
+            return self._parse_questions(content)[:num_questions]
 
-            content = response.text.strip()
+        except Exception as e:
+            print(f"Error generating questions with Gemini: {e}")
+            return []
 
-            # Parse JSON
-            data = json.loads(content)
+    def _parse_questions(self, content):
+        # Parse JSON
+        data = json.loads(content)
 
-            # Handle if wrapped in specific keys
+        # Handle if wrapped in specific keys
+        if isinstance(data, dict):
+            # Look for a list inside the dictionary
+            for val in data.values():
+                if isinstance(val, list):
+                    data = val
+                    break
+            # If still dict, wrap in list
             if isinstance(data, dict):
-                # Look for a list inside the dictionary
-                for val in data.values():
-                    if isinstance(val, list):
-                        data = val
-                        break
-                # If still dict, wrap in list
-                if isinstance(data, dict):
-                    data = [data]
+                data = [data]
 
-            # Add UUIDs
-            final_questions = []
-            for q in data:
-                if 'question' in q and 'options' in q:
-                    q['id'] = str(uuid.uuid4())
-                    final_questions.append(q)
+        # Add UUIDs
+        final_questions = []
+        for q in data:
+            if isinstance(q, dict) and 'question' in q and 'options' in q:
+                q['id'] = str(uuid.uuid4())
+                final_questions.append(q)
 
-            return final_questions[:num_questions]
+        return final_questions
 
-        except Exception as e:
-            print(f"Error generating questions with Gemini: {e}")
-            return self._generate_fallback_questions(num_questions)
+    @staticmethod
+    def _question_tokens(question):
+        return frozenset(re.findall(r'[a-z0-9]+', question.get('question', '').lower()))
+
+    def _merge_unique(self, questions, new_questions):
+        """
+        Append new_questions, skipping any whose wording overlaps an existing
+        question by at least duplicate_threshold (Jaccard over word sets).
+        """
+        merged = list(questions)
+        seen = [self._question_tokens(q) for q in merged]
+
+        for q in new_questions:
+            tokens = self._question_tokens(q)
+            duplicate = any(
+                len(tokens & other) / max(1, len(tokens | other)) >= self.duplicate_threshold
+                for other in seen
+            )
+            if not duplicate:
+                merged.append(q)
+                seen.append(tokens)
+
+        return merged
 
     def _generate_fallback_questions(self, num_questions):
         questions = []
@@ -105,4 +272,4 @@ class MCQGenerator:
                 'difficulty': 'easy',
                 'explanation': 'System error occurred.'
             })
-        return questions
\ No newline at end of file
+        return questions
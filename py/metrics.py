@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cheap retrieval to a slow OCR page or LLM call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name -> (type, help)
+METRICS = {
+    'smartprep_http_request_seconds': ('histogram', 'Request latency by endpoint, method and status'),
+    'smartprep_pdf_page_seconds': ('histogram', 'Extraction time of one PDF page by the method that produced its text'),
+    'smartprep_pdf_document_seconds': ('histogram', 'Extraction time of a whole PDF or page range'),
+    'smartprep_index_write_seconds': ('histogram', 'Vectorizing and publishing a batch of chunks to the index'),
+    'smartprep_index_rows_total': ('counter', 'Rows published to the vector index'),
+    'smartprep_retrieval_seconds': ('histogram', 'Chunk retrieval latency by backend'),
+    'smartprep_llm_call_seconds': ('histogram', 'Latency of LLM calls that reached the model'),
+    'smartprep_llm_first_piece_seconds': ('histogram', 'Time to the first streamed piece of an LLM response'),
+    'smartprep_llm_requests_total': ('counter', 'LLM requests by outcome: call, error or cache hit'),
+    'smartprep_llm_tokens_total': ('counter', 'LLM tokens by kind'),
+    'smartprep_analyze_test_seconds': ('histogram', 'Grading and analysing one test submission'),
+    'smartprep_grade_batch_seconds': ('histogram', 'Grading a batch of answer sheets for one test'),
+}
+
+# Spans of the request being traced, or None when tracing is off
+_trace = contextvars.ContextVar('smartprep_trace', default=None)
+
+
+class Metrics:
+    """
+    Counters and latency histograms for the hot paths, rendered in the
+    Prometheus text format.
+
+    Every worker process keeps its own values. With directory set, each
+    process also writes a snapshot of them to <directory>/<pid>.json (at
+    most every flush_interval seconds, and on exit), and render() adds up
+    the snapshots of every process, so /metrics reports the whole server
+    whichever worker answers the scrape. Snapshots of exited workers are
+    kept so totals never go backwards; clear the directory on redeploy.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counters = {}     # (name, labels) -> value
+        self._histograms = {}   # (name, labels) -> [bucket counts..., +Inf count], sum
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(self.flush, force=True)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+        span(name, seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the with-block takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [
+                    [name, dict(labels), list(counts), total]
+                    for (name, labels), (counts, total) in self._histograms.items()
+                ]
+            }
+
+    def flush(self, force=False):
+        """Write this process's snapshot for the other workers to read"""
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Metrics flush failed: {e}")
+
+    def _snapshots(self):
+        snapshots = [self.snapshot()]
+        if not self.directory:
+            return snapshots
+        own = f"{os.getpid()}.json"
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), 'r', encoding='utf-8') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """All metrics, summed over every worker, in the Prometheus text format"""
+        counters = {}
+        histograms = {}
+        for snapshot in self._snapshots():
+            for name, labels, value in snapshot['counters']:
+                key = self._key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total in snapshot['histograms']:
+                key = self._key(name, labels)
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            series = counters if kind == 'counter' else histograms
+            keys = sorted(key for key in series if key[0] == name)
+            if not keys:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind == 'counter':
+                    lines.append(f"{name}{_labels(labels)} {series[key]}")
+                    continue
+                counts, total = series[key]
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def start_trace():
+    """Start collecting spans for the current request; returns a token for finish_trace()"""
+    return _trace.set([])
+
+
+def finish_trace(token):
+    """The (name, seconds) spans recorded since start_trace(), and stop collecting"""
+    spans = _trace.get() or []
+    _trace.reset(token)
+    return spans
+
+
+def span(name, seconds):
+    """Record a span on the current trace, if one is being collected"""
+    spans = _trace.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+def server_timing(spans):
+    """
+    A Server-Timing header value with the total time and number of calls
+    per span name, e.g. retrieval;desc="2 calls";dur=3.1
+    """
+    totals = {}
+    for name, seconds in spans:
+        count, total = totals.get(name, (0, 0.0))
+        totals[name] = (count + 1, total + seconds)
+    return ', '.join(
+        f'{name.removeprefix("smartprep_").removesuffix("_seconds")};desc="{count} calls";dur={total * 1000:.1f}'
+        for name, (count, total) in totals.items()
+    )
+
+
+_default_metrics = None
+_default_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Process-wide metrics. METRICS_DIR makes /metrics cover every worker
+    process that shares the directory.
+    """
+    global _default_metrics
+    with _default_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics(
+                directory=os.environ.get('METRICS_DIR') or None,
+                flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5.0))
+            )
+        return _default_metrics
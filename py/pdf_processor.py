@@ -1,73 +1,177 @@
+import os
 import PyPDF2
 import pdfplumber
 from PIL import Image
 import pytesseract
 import io
+import time
+import multiprocessing
+from text_chunker import TextChunker
+from metrics import get_metrics
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Page-range workers. They live at module level so they can be pickled into
+# the process pool, and read the file once for every extraction method.
+
+def _extract_pages(pdf_path, start, stop, min_page_chars, force_ocr=False):
+    return list(_iter_pages(pdf_path, start, stop, min_page_chars, force_ocr))
+
+
+def _iter_pages(pdf_path, start, stop, min_page_chars, force_ocr=False):
+    """
+    Yield pages [start, stop) choosing a method per page: keep the PyPDF2
+    text layer when it has enough text, otherwise try pdfplumber, then OCR.
+    force_ocr goes straight to OCR, e.g. to redo pages whose text layer is bad.
+    Each page records the seconds it took, since pool workers can't report
+    metrics themselves.
+    """
+    with open(pdf_path, 'rb') as file:
+        data = file.read()
+
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(data))
+    stop = len(pdf_reader.pages) if stop is None else stop
+    plumber = None
+
+    try:
+        for i in range(start, stop):
+            page_start = time.perf_counter()
+            text, method = "", None
+
+            # Method 1: PyPDF2 text layer (fastest)
+            if not force_ocr:
+                try:
+                    text = pdf_reader.pages[i].extract_text() or ""
+                    if text.strip():
+                        method = 'pypdf2'
+                except Exception as e:
+                    print(f"PyPDF2 extraction failed on page {i + 1}: {e}")
+
+            if force_ocr or len(text.strip()) < min_page_chars:
+                if plumber is None:
+                    plumber = pdfplumber.open(io.BytesIO(data))
+                page = plumber.pages[i]
+
+                # Method 2: pdfplumber (better for complex layouts)
+                if not force_ocr:
+                    try:
+                        page_text = page.extract_text() or ""
+                        if len(page_text.strip()) > len(text.strip()):
+                            text, method = page_text, 'pdfplumber'
+                    except Exception as e:
+                        print(f"pdfplumber extraction failed on page {i + 1}: {e}")
+
+                # Method 3: OCR for image-only pages
+                if force_ocr or len(text.strip()) < min_page_chars:
+                    try:
+                        img = page.to_image(resolution=300)
+                        page_text = pytesseract.image_to_string(img.original)
+                        if len(page_text.strip()) > len(text.strip()):
+                            text, method = page_text, 'ocr'
+                    except Exception as e:
+                        print(f"OCR extraction failed on page {i + 1}: {e}")
+
+            yield {'page': i + 1, 'text': text, 'method': method, 'seconds': time.perf_counter() - page_start}
+    finally:
+        if plumber is not None:
+            plumber.close()
+
 
 class PDFProcessor:
-    def __init__(self):
+    def __init__(self, max_workers=None, min_pages_per_worker=8, min_page_chars=25):
         self.supported_formats = ['.pdf']
+        # Pages are fanned out to a process pool once a PDF is big enough to benefit
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.min_pages_per_worker = min_pages_per_worker
+        # Pages with less text than this fall through to pdfplumber, then OCR
+        self.min_page_chars = min_page_chars
+        self._pool = None
 
-    def extract_text(self, pdf_path):
+    def _get_pool(self):
+        if self._pool is None:
+            # Forking a threaded web worker can copy held locks into the child;
+            # a forkserver starts OCR processes from a clean single-threaded one
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self._pool
+
+    def page_count(self, pdf_path):
+        with open(pdf_path, 'rb') as file:
+            return len(PyPDF2.PdfReader(file).pages)
+
+    def _page_ranges(self, first, stop):
+        # Several ranges per worker so a cluster of scanned pages doesn't land on one core
+        page_count = stop - first
+        n_ranges = min(self.max_workers * 4, max(1, page_count // self.min_pages_per_worker))
+        step = -(-page_count // n_ranges)
+        return [(start, min(start + step, stop)) for start in range(first, stop, step)]
+
+    def iter_pages(self, pdf_path, first_page=1, last_page=None, force_ocr=False):
         """
-        Extract text from PDF using multiple methods for robustness
+        Yield every page, in page order, as a {'page', 'text', 'method'} dict
+        as soon as it (and every page before it) has been extracted. Large
+        documents are split into page ranges across the process pool.
+        first_page and last_page (1-based, inclusive) limit the pages read.
         """
-        text = ""
+        metrics = get_metrics()
+        for page in self._pages(pdf_path, first_page, last_page, force_ocr):
+            metrics.observe('smartprep_pdf_page_seconds', page['seconds'], method=page['method'] or 'none')
+            yield page
 
-        # Method 1: Try PyPDF2 first (faster)
-        try:
-            text = self._extract_with_pypdf2(pdf_path)
-            if len(text.strip()) > 100:  # If we got substantial text
-                return text
-        except Exception as e:
-            print(f"PyPDF2 extraction failed: {e}")
+    def _pages(self, pdf_path, first_page, last_page, force_ocr):
+        first = first_page - 1
+        if self.max_workers <= 1:
+            yield from _iter_pages(pdf_path, first, last_page, self.min_page_chars, force_ocr)
+            return
+
+        page_count = self.page_count(pdf_path)
+        stop = page_count if last_page is None else min(last_page, page_count)
+        ranges = self._page_ranges(first, stop) if stop > first else []
+        if len(ranges) <= 1:
+            yield from _iter_pages(pdf_path, first, stop, self.min_page_chars, force_ocr)
+            return
 
-        # Method 2: Try pdfplumber (better for complex layouts)
+        futures = [
+            self._get_pool().submit(_extract_pages, pdf_path, start, range_stop, self.min_page_chars, force_ocr)
+            for start, range_stop in ranges
+        ]
         try:
-            text = self._extract_with_pdfplumber(pdf_path)
-            if len(text.strip()) > 100:
-                return text
-        except Exception as e:
-            print(f"pdfplumber extraction failed: {e}")
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def extract_pages(self, pdf_path, first_page=1, last_page=None, force_ocr=False):
+        """Extract pages, in page order, as {'page', 'text', 'method'} dicts"""
+        with get_metrics().timer('smartprep_pdf_document_seconds'):
+            return list(self.iter_pages(pdf_path, first_page, last_page, force_ocr))
+
+    @staticmethod
+    def page_table(pages):
+        """
+        (page number, start offset) for every page, locating each page in the
+        text built by joining the pages' text with "\\n"
+        """
+        table = []
+        offset = 0
+        for page in pages:
+            table.append((page['page'], offset))
+            offset += len(page['text']) + 1
+        return table
 
-        # Method 3: OCR as fallback (for image-based PDFs)
+    def extract_text(self, pdf_path):
+        """
+        Extract text from PDF, picking the cheapest method that works for each page
+        """
         try:
-            text = self._extract_with_ocr(pdf_path)
+            pages = self.extract_pages(pdf_path)
         except Exception as e:
-            print(f"OCR extraction failed: {e}")
+            print(f"PDF extraction failed: {e}")
+            return ""
 
-        return text
-
-    def _extract_with_pypdf2(self, pdf_path):
-        """Extract text using PyPDF2"""
-        text = ""
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
-
-    def _extract_with_pdfplumber(self, pdf_path):
-        """Extract text using pdfplumber"""
-        text = ""
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        return text
-
-    def _extract_with_ocr(self, pdf_path):
-        """Extract text using OCR (for image-based PDFs)"""
-        text = ""
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                # Convert page to image
-                img = page.to_image(resolution=300)
-                # Apply OCR
-                page_text = pytesseract.image_to_string(img.original)
-                text += page_text + "\n"
-        return text
+        return "".join(page['text'] + "\n" for page in pages)
 
     def extract_metadata(self, pdf_path):
         """Extract PDF metadata"""
@@ -83,15 +187,9 @@ class PDFProcessor:
         except Exception as e:
             return {'error': str(e)}
 
-    def chunk_text(self, text, chunk_size=1000, overlap=200):
+    def chunk_text(self, text, chunk_size=1000, overlap=200, unit='tokens'):
         """
-        Split text into overlapping chunks for better context retention
+        Split text into overlapping chunks for better context retention.
+        Sizes are in tokens (roughly words) by default, or 'chars'.
         """
-        words = text.split()
-        chunks = []
-
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = ' '.join(words[i:i + chunk_size])
-            chunks.append(chunk)
-
-        return chunks
\ No newline at end of file
+        return TextChunker(chunk_size, overlap, unit).split(text)
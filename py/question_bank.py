@@ -0,0 +1,219 @@
+import os
+import json
+import random
+import sqlite3
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover this process
+    fcntl = None
+
+
+class QuestionBank:
+    """
+    Pre-generated MCQs per document, persisted as one JSON file per document
+    and indexed in memory by topic and difficulty. Tests are assembled by
+    sampling from the bank instead of calling the LLM every time.
+
+    Which questions each session has already been given is kept in
+    <bank_dir>/seen.db, so every worker process sharing bank_dir avoids
+    repeating them, whichever one served the session's earlier tests.
+    Writers of a document's bank serialize on a flock of <document_id>.lock
+    beside its JSON file (see locked() and building()).
+    """
+
+    def __init__(self, bank_dir):
+        self.bank_dir = bank_dir
+        os.makedirs(bank_dir, exist_ok=True)
+        self._questions = {}   # document_id -> list of questions
+        self._by_topic = {}    # document_id -> topic -> difficulty -> [question index]
+        self._mtimes = {}      # document_id -> mtime of the file last loaded
+        self._lock = threading.Lock()
+        self._building = set()  # document ids this process is building
+
+        # Used only under self._lock; transactions are begun explicitly
+        self._seen_db = sqlite3.connect(
+            os.path.join(bank_dir, 'seen.db'), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._seen_db.execute('PRAGMA journal_mode=WAL')
+        self._seen_db.execute(
+            'CREATE TABLE IF NOT EXISTS seen ('
+            'document_id TEXT NOT NULL, session_id TEXT NOT NULL, question_id TEXT NOT NULL, '
+            'PRIMARY KEY (document_id, session_id, question_id)) WITHOUT ROWID'
+        )
+
+    def _path(self, document_id):
+        return os.path.join(self.bank_dir, f"{document_id}.json")
+
+    def _mtime(self, document_id):
+        try:
+            return os.path.getmtime(self._path(document_id))
+        except OSError:
+            return None
+
+    def _load(self, document_id):
+        # Reload when another worker process has rewritten the file
+        mtime = self._mtime(document_id)
+        if document_id in self._questions and self._mtimes.get(document_id) == mtime:
+            return self._questions[document_id]
+
+        try:
+            with open(self._path(document_id), 'r', encoding='utf-8') as f:
+                questions = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            questions = []
+
+        self._set(document_id, questions)
+        self._mtimes[document_id] = mtime
+        return questions
+
+    def _set(self, document_id, questions):
+        by_topic = defaultdict(lambda: defaultdict(list))
+        for i, q in enumerate(questions):
+            by_topic[q.get('topic', 'General')][q.get('difficulty', 'medium')].append(i)
+        self._questions[document_id] = questions
+        self._by_topic[document_id] = by_topic
+
+    def _flock(self, document_id, suffix, blocking):
+        """Open and flock <document_id><suffix>; returns the file, or None if busy"""
+        lock_file = open(os.path.join(self.bank_dir, f"{document_id}{suffix}"), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    @contextmanager
+    def locked(self, document_id):
+        """
+        Exclusive access to a document's bank across every worker process,
+        for a re-read, merge and replace() that must not lose another
+        writer's questions
+        """
+        lock_file = self._flock(document_id, '.lock', blocking=True)
+        try:
+            yield
+        finally:
+            lock_file.close()  # closing releases the flock
+
+    @contextmanager
+    def building(self, document_id):
+        """
+        Yields True if no other thread or worker process is building this
+        document's bank, holding that claim until the block ends, else False
+        """
+        with self._lock:
+            claimed = document_id not in self._building
+            if claimed:
+                self._building.add(document_id)
+        lock_file = self._flock(document_id, '.build.lock', blocking=False) if claimed else None
+        try:
+            yield lock_file is not None
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+            if claimed:
+                with self._lock:
+                    self._building.discard(document_id)
+
+    def questions(self, document_id):
+        with self._lock:
+            return list(self._load(document_id))
+
+    def size(self, document_id):
+        with self._lock:
+            return len(self._load(document_id))
+
+    def replace(self, document_id, questions):
+        """
+        Persist the full question list for a document and rebuild its index
+        """
+        with self._lock:
+            path = self._path(document_id)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(questions, f)
+            os.replace(tmp_path, path)
+            self._set(document_id, list(questions))
+            self._mtimes[document_id] = self._mtime(document_id)
+
+    def _seen(self, document_id, session_id):
+        """Ids (as strings) of the questions session_id was already given"""
+        if not session_id:
+            return set()
+        rows = self._seen_db.execute(
+            'SELECT question_id FROM seen WHERE document_id = ? AND session_id = ?',
+            (document_id, str(session_id))
+        )
+        return {row[0] for row in rows}
+
+    def unseen_count(self, document_id, session_id=None, exclude_ids=()):
+        with self._lock:
+            questions = self._load(document_id)
+            excluded = self._seen(document_id, session_id) | {str(i) for i in exclude_ids}
+            return sum(1 for q in questions if str(q['id']) not in excluded)
+
+    def sample(self, document_id, num_questions, session_id=None, exclude_ids=()):
+        """
+        Pick up to num_questions unseen questions, balanced across topics and,
+        within each topic, across difficulties. The picks are recorded as seen
+        for session_id. Returns copies so tests never share mutable state.
+        """
+        with self._lock:
+            questions = self._load(document_id)
+            if session_id:
+                # Held until the picks are recorded, so two workers serving
+                # one session cannot hand out the same questions
+                self._seen_db.execute('BEGIN IMMEDIATE')
+            try:
+                sample = self._pick(document_id, questions, num_questions,
+                                    self._seen(document_id, session_id) | {str(i) for i in exclude_ids})
+                if session_id:
+                    self._seen_db.executemany(
+                        'INSERT OR IGNORE INTO seen (document_id, session_id, question_id) VALUES (?, ?, ?)',
+                        [(document_id, str(session_id), str(q['id'])) for q in sample]
+                    )
+                    self._seen_db.execute('COMMIT')
+            except Exception:
+                if session_id:
+                    self._seen_db.execute('ROLLBACK')
+                raise
+            return sample
+
+    def _pick(self, document_id, questions, num_questions, excluded):
+        # Shuffled pools of unseen question indices per topic and difficulty
+        pools = {}
+        for topic, by_difficulty in self._by_topic[document_id].items():
+            buckets = []
+            for indices in by_difficulty.values():
+                unseen = [i for i in indices if str(questions[i]['id']) not in excluded]
+                random.shuffle(unseen)
+                if unseen:
+                    buckets.append(unseen)
+            if buckets:
+                random.shuffle(buckets)
+                pools[topic] = buckets
+
+        # Round-robin over topics, rotating difficulty within each topic
+        picked = []
+        topics = list(pools)
+        random.shuffle(topics)
+        while len(picked) < num_questions and topics:
+            for topic in list(topics):
+                buckets = pools[topic]
+                bucket = buckets.pop(0)
+                picked.append(bucket.pop())
+                if bucket:
+                    buckets.append(bucket)
+                if not buckets:
+                    topics.remove(topic)
+                if len(picked) >= num_questions:
+                    break
+
+        return [dict(questions[i]) for i in picked]
@@ -1,100 +1,502 @@
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import scipy.sparse as sp
 import re
 import uuid
 import os
 import json
-import google.generativeai as genai
-from dotenv import load_dotenv
+import time
+import threading
+from vector_index import VectorIndex
+from text_chunker import TextChunker
+from index_store import IndexStore, ChunkChain, PatchConflict
+from dense_index import get_dense_index
+from llm_client import get_llm_client
+from metrics import get_metrics
 
-load_dotenv()
+RETRIEVAL_BACKENDS = ('tfidf', 'dense', 'hybrid')
+
+# Times reprocess_pages() redoes a patch that raced another worker's
+PATCH_ATTEMPTS = 3
 
 class RAGAgent:
-    def __init__(self):
+    def __init__(self, index_dir=None, llm=None, retrieval=None, dense=None, chunker=None):
         self.documents = {}
-        self.vectorizer = TfidfVectorizer(max_features=500, stop_words='english')
-        self.vectors = None
-        self.chunk_mapping = {}
 
-        # Configure Gemini
-        genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        # CHUNK_UNIT is chars or tokens; CHUNK_SIZE and CHUNK_OVERLAP are in that unit
+        self.chunker = chunker or TextChunker(
+            chunk_size=int(os.environ.get('CHUNK_SIZE', 1000)),
+            overlap=int(os.environ.get('CHUNK_OVERLAP', 200)),
+            unit=os.environ.get('CHUNK_UNIT', 'chars')
+        )
+
+        # tfidf (default), dense embeddings with approximate search, or a hybrid of both
+        self.retrieval = retrieval or os.environ.get('RETRIEVAL_BACKEND', 'tfidf')
+        if self.retrieval not in RETRIEVAL_BACKENDS:
+            raise ValueError(f"Unknown retrieval backend: {self.retrieval}")
+        if self.retrieval != 'tfidf':
+            dense = dense or get_dense_index()
+        else:
+            dense = None
+        self.hybrid_dense_weight = float(os.environ.get('HYBRID_DENSE_WEIGHT', 0.5))
+        self.index = VectorIndex(dense=dense)
+        self.metrics = get_metrics()
+
+        # Segments allowed to pile up before a background compaction
+        self.compact_segments = int(os.environ.get('COMPACT_SEGMENTS', 16))
+        self._compaction_lock = threading.Lock()
+        self._compaction_pending = False
+        self._compaction_running = False
+
+        # Optional on-disk index shared by every worker pointing at index_dir
+        self.store = IndexStore(index_dir) if index_dir else None
+        self._manifest_mtime = None
+        self._refresh_lock = threading.Lock()
+        self.refresh()
+
+        # Shared, cached Gemini client
+        self.llm = llm or get_llm_client()
+
+    def refresh(self, wait=True):
+        """
+        Memory-map any documents another worker has persisted since we last
+        looked. Cheap when nothing changed: a single stat() of the manifest.
+        With wait=False a caller doesn't queue up behind a refresh already
+        running in another thread and just searches what is loaded so far.
+        """
+        if not self.store:
+            return
+
+        mtime = self.store.manifest_mtime()
+        if mtime is None or mtime == self._manifest_mtime:
+            return
+
+        if not self._refresh_lock.acquire(blocking=wait):
+            return
+        try:
+            if mtime == self._manifest_mtime:
+                return
+
+            for entry in self.store.load_manifest()['documents']:
+                document_id = entry['document_id']
+                if document_id not in self.documents:
+                    self._load_document(entry)
+                # Pages re-extracted by any worker since we loaded the document
+                applied = len(self.documents[document_id].get('patches', ()))
+                for patch in entry.get('patches', [])[applied:]:
+                    self._load_patch(entry, patch)
+            self._manifest_mtime = mtime
+        finally:
+            self._refresh_lock.release()
+        self.schedule_compaction()
+
+    def _load_document(self, entry):
+        # The document goes in before its rows, so every row a query
+        # can see already has its chunk text
+        document_id = entry['document_id']
+        chunks = self.store.load_chunks(document_id)
+        self.documents[document_id] = {
+            'filename': entry['filename'],
+            'source_path': entry.get('source_path'),
+            'chunks': chunks,
+            'chunk_spans': self.store.load_spans(document_id),
+            'pages': self.store.load_pages(document_id),
+            'chunk_count': entry['chunk_count'],
+            'patches': []
+        }
+        with self.metrics.timer('smartprep_index_write_seconds', op='load'):
+            self.index.add_counts(
+                document_id, self.store.load_counts(entry), self._load_embeddings(entry, chunks)
+            )
+
+    def _load_patch(self, entry, patch):
+        document_id, patch_id = entry['document_id'], patch['patch_id']
+        chunks = self.store.load_chunks(document_id, patch_id)
+        old = self.documents[document_id]
+        # Any full text held in memory predates the patch; it is re-read on demand
+        document = {key: value for key, value in old.items() if key != 'full_text'}
+        document.update(
+            chunks=ChunkChain([old['chunks'], chunks]),
+            chunk_spans=self.store.load_spans(document_id, patch_id),
+            pages=self.store.load_pages(document_id, patch_id),
+            chunk_count=len(old['chunks']) + len(chunks),
+            patches=old.get('patches', []) + [patch_id]
+        )
+        self.documents[document_id] = document
+        with self.metrics.timer('smartprep_index_write_seconds', op='load'):
+            self.index.replace_chunks(
+                document_id, self.store.load_removed(document_id, patch_id),
+                self.store.load_counts(entry, patch), self._load_embeddings(entry, chunks, patch)
+            )
 
     def process_document(self, text, filename):
-        document_id = str(uuid.uuid4())
-        chunks = self._chunk_text(text)
+        return self.process_pages([{'text': text}], filename)
+
+    def process_pages(self, pages, filename, document_id=None, on_progress=None, source_path=None):
+        """
+        Streaming ingestion: pages flow into chunks and chunks into the index
+        as they arrive, so the first chunks are searchable before the last
+        page is extracted. pages is any iterable of {'text': ...} dicts,
+        e.g. PDFProcessor.iter_pages(). on_progress(page, chunk_count) is
+        called after each page is indexed. source_path is kept so pages can
+        be re-extracted from the original file later.
+        """
+        document_id = document_id or str(uuid.uuid4())
+        page_texts = []
 
         self.documents[document_id] = {
             'filename': filename,
-            'full_text': text,
-            'chunks': chunks,
-            'chunk_count': len(chunks)
+            'source_path': source_path,
+            'full_text': '',
+            'chunks': [],
+            'chunk_spans': [],
+            'pages': None,
+            'chunk_count': 0,
+            'patches': []
         }
 
-        for i, chunk in enumerate(chunks):
-            chunk_id = f"{document_id}_{i}"
-            self.chunk_mapping[chunk_id] = {
-                'document_id': document_id,
-                'chunk_index': i,
-                'text': chunk
-            }
+        try:
+            stream = self.chunker.stream()
+            batches = []
+            for page in pages:
+                page_texts.append(page['text'])
+                # Chunks come out once they can no longer grow with the next page
+                chunks = stream.add_page(page['text'], page.get('page'))
+                batches.append(self._update_vectors(document_id, chunks))
 
-        self._update_vectors()
+                if on_progress:
+                    on_progress(page, self.documents[document_id]['chunk_count'])
+
+            batches.append(self._update_vectors(document_id, stream.close()))
+            self.index.merge_document(document_id)
+
+            document = self.documents[document_id]
+            document['full_text'] = "\n".join(page_texts)
+            document['chunk_spans'] = np.array(document['chunk_spans'], dtype=np.int32).reshape(-1, 4)
+            document['pages'] = np.array(stream.page_table(), dtype=np.int32).reshape(-1, 2)
+            if self.store:
+                dense = self.index.dense
+                embeddings = None
+                if dense:
+                    codes = np.concatenate([e[0] for _, e in batches])
+                    scales = None if dense.dtype == 'float16' else np.concatenate([e[1] for _, e in batches])
+                    embeddings = (codes, scales)
+                self.store.save_document(
+                    document_id, filename, document['full_text'], document['chunks'],
+                    sp.vstack([counts for counts, _ in batches], format='csr'),
+                    embeddings=embeddings,
+                    embedding_model=dense.model_name if dense else None,
+                    spans=document['chunk_spans'],
+                    pages=document['pages'],
+                    source_path=source_path
+                )
+        except Exception:
+            # Nothing of a failed upload stays searchable
+            self._discard(document_id)
+            raise
+
+        self.schedule_compaction(force=len(self.index.row_ranges(document_id)) > 1)
         return document_id
 
-    def _chunk_text(self, text, chunk_size=1000, overlap=200):
-        paragraphs = text.split('\n\n')
-        chunks = []
-        current_chunk = ""
+    def _discard(self, document_id):
+        """Retire every row of a partly ingested document and forget it"""
+        document = self.documents.get(document_id)
+        if document and document['chunk_count']:
+            dense = self.index.dense
+            self.index.replace_chunks(
+                document_id, np.arange(document['chunk_count']), self.index.vectorize([]),
+                dense.encode([]) if dense else None
+            )
+        self.documents.pop(document_id, None)
+
+    def schedule_compaction(self, force=False):
+        """
+        Merge the index's segments in a background thread once there are
+        more than compact_segments of them (or right away with force, e.g.
+        when a document's page batches could not be merged because other
+        uploads were interleaved with it). Every page batch, loaded
+        document and patch adds a segment, and whole-corpus queries pay for
+        each one. At most one compaction runs per process; requests made
+        while it runs trigger one more pass afterwards.
+        """
+        snapshot = self.index.snapshot()
+        if self.index.dense and self.index.dense.needs_retraining(snapshot.dense_state):
+            # Only compaction trains the dense lists, and retrains them as the corpus grows
+            force = True
+        if not force and len(snapshot.segments) <= self.compact_segments:
+            return
+        with self._compaction_lock:
+            self._compaction_pending = True
+            if self._compaction_running:
+                return
+            self._compaction_running = True
+        threading.Thread(target=self._compact, name='index-compaction', daemon=True).start()
+
+    def _compact(self):
+        while True:
+            with self._compaction_lock:
+                if not self._compaction_pending:
+                    self._compaction_running = False
+                    return
+                self._compaction_pending = False
+            try:
+                with self.metrics.timer('smartprep_index_write_seconds', op='compact'):
+                    self.index.compact()
+            except Exception as e:
+                print(f"Index compaction failed: {e}")
 
-        for para in paragraphs:
-            para = para.strip()
-            if not para: continue
+    def reprocess_pages(self, document_id, pages):
+        """
+        Replace the text of a run of consecutive pages, e.g. after re-running
+        OCR on pages 40-60, without re-processing the rest of the document.
+        Only the chunks touching those pages are re-chunked and re-indexed;
+        every other chunk keeps its row. pages is an iterable of
+        {'page', 'text'} dicts. Returns counts of the chunks replaced.
+        """
+        new_texts = {int(page['page']): page['text'] for page in pages}
+        if not new_texts:
+            raise ValueError("No pages given")
+
+        for _ in range(PATCH_ATTEMPTS):
+            self.refresh()
+            try:
+                result = self._reprocess(document_id, new_texts)
+            except PatchConflict:
+                # Another worker patched the document first; redo on top of its patch
+                continue
+            self.schedule_compaction()
+            return result
+        raise PatchConflict(f"Document {document_id} kept changing; pages not replaced")
+
+    def _reprocess(self, document_id, new_texts):
+        first, last = min(new_texts), max(new_texts)
+        with self._refresh_lock:
+            document = self.documents.get(document_id)
+            if document is None:
+                raise KeyError(f"Unknown document: {document_id}")
+            if document.get('pages') is None or document.get('chunk_spans') is None:
+                raise ValueError("Document was indexed without page offsets")
+
+            full_text = document['full_text'] if 'full_text' in document else \
+                self.store.load_full_text(document_id, document['patches'][-1] if document['patches'] else None)
+            spans = np.array(document['chunk_spans'], dtype=np.int32)
+            page_table = np.array(document['pages'], dtype=np.int32)
+            numbers, starts = page_table[:, 0], page_table[:, 1]
+            ends = np.append(starts[1:] - 1, len(full_text))  # pages are joined with "\n"
+            positions = np.searchsorted(numbers, np.arange(first, last + 1))
+            if positions[-1] >= len(numbers) or not np.array_equal(numbers[positions], np.arange(first, last + 1)):
+                raise ValueError(f"Document has no pages {first}-{last}")
+            p0, p1 = positions[0], positions[-1]
+
+            # Re-chunk from the first affected chunk to the last one, or to the
+            # edges of the replaced pages if those reach further
+            live = spans[:, 0] >= 0
+            removed = np.flatnonzero(live & (spans[:, 2] <= last) & (spans[:, 3] >= first))
+            region_start, region_end = starts[p0], ends[p1]
+            if len(removed):
+                region_start = min(region_start, spans[removed, 0].min())
+                region_end = max(region_end, spans[removed, 1].max())
+
+            replaced = "\n".join(new_texts[n] for n in range(first, last + 1))
+            delta = len(replaced) - (ends[p1] - starts[p0])
+            full_text = full_text[:starts[p0]] + replaced + full_text[ends[p1]:]
+            starts = np.where(numbers > last, starts + delta, starts)
+            starts[p0:p1 + 1] = starts[p0] + np.cumsum([0] + [len(new_texts[n]) + 1 for n in range(first, last)])
+            ends = np.append(starts[1:] - 1, len(full_text))
+            region_end += delta
+
+            stream = self.chunker.stream()
+            chunks = []
+            for i in range(np.searchsorted(starts, region_start, 'right') - 1, len(numbers)):
+                if starts[i] >= region_end:
+                    break
+                piece_start, piece_end = max(starts[i], region_start), min(ends[i], region_end)
+                chunks += stream.add_page(full_text[piece_start:piece_end], int(numbers[i]))
+            chunks += stream.close()
+
+            # Chunks after the replaced pages keep their text but move by delta
+            spans[live & (spans[:, 2] > last), :2] += delta
+            spans[removed] = -1
+            new_spans = np.array(
+                [(c['start'] + region_start, c['end'] + region_start, c['page_start'], c['page_end']) for c in chunks],
+                dtype=np.int32
+            ).reshape(-1, 4)
+            texts = [c['text'] for c in chunks]
+            write_start = time.perf_counter()
+            counts = self.index.vectorize(texts)
+            embeddings = self.index.dense.encode(texts) if self.index.dense else None
+            chunk_spans = np.concatenate([spans, new_spans])
+            page_table = np.column_stack([numbers, starts]).astype(np.int32)
+            patches = document.get('patches', [])
 
-            if len(current_chunk) + len(para) > chunk_size and current_chunk:
-                chunks.append(current_chunk)
-                words = current_chunk.split()
-                overlap_text = ' '.join(words[-overlap:]) if len(words) > overlap else current_chunk
-                current_chunk = overlap_text + ' ' + para
+            # Published first: it is rejected if another worker's patch on
+            # the document landed since the one this is built on
+            if self.store:
+                dense = self.index.dense
+                patch_id = self.store.save_patch(
+                    document_id, full_text, texts, counts, removed, chunk_spans, page_table,
+                    embeddings=embeddings,
+                    embedding_model=dense.model_name if dense else None,
+                    base_patches=len(patches)
+                )
             else:
-                current_chunk += ('\n\n' if current_chunk else '') + para
+                patch_id = f"patch-{uuid.uuid4().hex}"
 
-        if current_chunk:
-            chunks.append(current_chunk)
-        return chunks
+            # Chunk text goes in before the rows that point at it
+            self.documents[document_id] = dict(
+                document,
+                full_text=full_text,
+                chunks=self._concat_chunks(document['chunks'], texts),
+                chunk_spans=chunk_spans,
+                pages=page_table,
+                chunk_count=len(document['chunks']) + len(texts),
+                patches=patches + [patch_id]
+            )
+            self.index.replace_chunks(document_id, removed, counts, embeddings)
+            self.metrics.observe('smartprep_index_write_seconds', time.perf_counter() - write_start, op='replace')
+            self.metrics.inc('smartprep_index_rows_total', len(texts))
+
+        return {'chunks_removed': len(removed), 'chunks_added': len(texts)}
+
+    @staticmethod
+    def _concat_chunks(chunks, new_chunks):
+        if isinstance(chunks, list):
+            return chunks + new_chunks
+        return ChunkChain([chunks, new_chunks])
+
+    def _update_vectors(self, document_id, chunks):
+        # Only the new chunks are vectorized; existing rows are left alone.
+        # Chunk text is stored before the rows are published to the index.
+        document = self.documents[document_id]
+        texts = [chunk['text'] for chunk in chunks]
+        document['chunks'].extend(texts)
+        # Character offsets into full_text and the first and last page of each chunk
+        document['chunk_spans'].extend(
+            (chunk['start'], chunk['end'], chunk['page_start'], chunk['page_end']) for chunk in chunks
+        )
+        document['chunk_count'] = len(document['chunks'])
 
-    def _update_vectors(self):
-        all_chunks = [info['text'] for info in self.chunk_mapping.values()]
-        if all_chunks:
-            self.vectors = self.vectorizer.fit_transform(all_chunks)
+        with self.metrics.timer('smartprep_index_write_seconds', op='add'):
+            counts = self.index.vectorize(texts)
+            # Embeddings are computed per batch of chunks, never one at a time
+            embeddings = self.index.dense.encode(texts) if self.index.dense else None
+            self.index.add_counts(document_id, counts, embeddings)
+        self.metrics.inc('smartprep_index_rows_total', len(texts))
+        return counts, embeddings
 
-    def retrieve_relevant_chunks(self, query, top_k=5):
-        if not self.chunk_mapping or self.vectors is None:
+    def _load_embeddings(self, entry, chunks, patch=None):
+        dense = self.index.dense
+        if not dense:
+            return None
+        embeddings = self.store.load_embeddings(entry, dense.model_name, dense.dtype, patch)
+        if embeddings is None:
+            # Stored before dense retrieval was enabled (or with another model)
+            embeddings = dense.encode(list(chunks))
+        return embeddings
+
+    def _top_k(self, snapshot, query, top_k, document_id):
+        if self.retrieval == 'dense':
+            return snapshot.dense_top_k(query, top_k, document_id)
+        if self.retrieval == 'hybrid':
+            return snapshot.hybrid_top_k(query, top_k, document_id, self.hybrid_dense_weight)
+        return snapshot.top_k(query, top_k, document_id)
+
+    def retrieve_relevant_chunks(self, query, top_k=5, document_id=None):
+        """
+        Rank chunks by similarity to the query. document_id (a single id or a
+        list of ids) limits the search to those documents' rows.
+        """
+        self.refresh(wait=False)
+
+        # Score and map rows back to chunks against one consistent view, even
+        # if an upload publishes new rows while we are working
+        snapshot = self.index.snapshot()
+        if snapshot.n_rows == 0:
             return []
 
         try:
-            query_vector = self.vectorizer.transform([query])
-            similarities = cosine_similarity(query_vector, self.vectors)[0]
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
-
-            chunk_ids = list(self.chunk_mapping.keys())
-            relevant_chunks = []
-
-            for idx in top_indices:
-                chunk_id = chunk_ids[idx]
-                chunk_info = self.chunk_mapping[chunk_id]
-                relevant_chunks.append({
-                    'text': chunk_info['text'],
-                    'similarity': float(similarities[idx]),
-                    'document_id': chunk_info['document_id']
-                })
-            return relevant_chunks
+            with self.metrics.timer('smartprep_retrieval_seconds', backend=self.retrieval, kind='single'):
+                row_ids, similarities = self._top_k(snapshot, query, top_k, document_id)
+                return self._chunks_for_rows(snapshot, row_ids, similarities)
         except:
             return []
 
+    def retrieve_many(self, queries, document_id=None, top_k=5):
+        """
+        retrieve_relevant_chunks for several queries (e.g. all weak topics of
+        a test) in one pass: with TF-IDF the queries are vectorized together
+        and scored with a single sparse matrix-matrix product. Returns one
+        list of chunks per query, in query order.
+        """
+        self.refresh(wait=False)
+
+        snapshot = self.index.snapshot()
+        if snapshot.n_rows == 0 or not queries:
+            return [[] for _ in queries]
+
+        try:
+            with self.metrics.timer('smartprep_retrieval_seconds', backend=self.retrieval, kind='batch'):
+                if self.retrieval == 'tfidf':
+                    results = snapshot.top_k_many(list(queries), top_k, document_id)
+                else:
+                    results = [self._top_k(snapshot, query, top_k, document_id) for query in queries]
+                return [
+                    self._chunks_for_rows(snapshot, row_ids, similarities)
+                    for row_ids, similarities in results
+                ]
+        except Exception as e:
+            print(f"Batch retrieval error: {e}")
+            return [[] for _ in queries]
+
+    def _chunks_for_rows(self, snapshot, row_ids, similarities):
+        relevant_chunks = []
+
+        for row, similarity in zip(row_ids, similarities):
+            owner_id, chunk_index = snapshot.locate(row)
+            document = self.documents[owner_id]
+            chunk = {
+                'text': document['chunks'][chunk_index],
+                'similarity': float(similarity),
+                'document_id': owner_id
+            }
+            # Pages the chunk came from, for citations
+            spans = document.get('chunk_spans')
+            if spans is not None and chunk_index < len(spans) and spans[chunk_index][2] >= 0:
+                chunk['page_start'] = int(spans[chunk_index][2])
+                chunk['page_end'] = int(spans[chunk_index][3])
+            relevant_chunks.append(chunk)
+        return relevant_chunks
+
+    def has_document(self, document_id):
+        self.refresh()
+        return document_id in self.documents
+
     def get_document(self, document_id):
-        return self.documents.get(document_id)
+        """
+        The document with its full text. Chunks retired by reprocess_pages()
+        stay in the stored chunk list, since older index snapshots still point
+        at them, so a re-extracted document is returned with only its live
+        chunks, in reading order.
+        """
+        self.refresh()
+        document = self.documents.get(document_id)
+        if document is None:
+            return None
+        patches = document.get('patches')
+        if 'full_text' not in document:
+            # Persisted documents keep their full text on disk until asked for
+            document = dict(document, full_text=self.store.load_full_text(document_id, patches[-1] if patches else None))
+        if patches:
+            spans = np.asarray(document['chunk_spans'])
+            live = np.flatnonzero(spans[:, 0] >= 0)
+            live = live[np.argsort(spans[live, 0], kind='stable')]
+            chunks = document['chunks']
+            document = dict(
+                document,
+                chunks=[chunks[i] for i in live],
+                chunk_spans=spans[live],
+                chunk_count=len(live)
+            )
+        return document
 
     def extract_topics(self, text):
         """
@@ -109,12 +511,9 @@ class RAGAgent:
             Content:
             {text[:10000]}"""
 
-            response = self.model.generate_content(
-                prompt,
-                generation_config={"response_mime_type": "application/json"}
-            )
+            response_text = self.llm.generate(prompt, json_mode=True, validate=json.loads)
 
-            data = json.loads(response.text)
+            data = json.loads(response_text)
 
             # Handle {"topics": [...]} or just [...]
             if isinstance(data, dict):
@@ -0,0 +1,727 @@
+import json
+import time
+import sqlite3
+import threading
+import functools
+import contextlib
+from collections import defaultdict
+from datetime import datetime
+from class_analytics import tally_rows
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        test_id TEXT PRIMARY KEY,
+        document_id TEXT NOT NULL,
+        user_id TEXT,
+        created_at REAL NOT NULL,
+        submitted_at REAL,
+        score INTEGER,
+        max_score INTEGER,
+        percentage REAL,
+        summary TEXT,
+        source_test_id TEXT,
+        sheet TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_document ON sessions (document_id, submitted_at);
+    CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id, submitted_at);
+    CREATE INDEX IF NOT EXISTS idx_sessions_submitted ON sessions (submitted_at);
+    CREATE INDEX IF NOT EXISTS idx_sessions_created ON sessions (created_at);
+
+    CREATE TABLE IF NOT EXISTS questions (
+        test_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        question_id TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        difficulty TEXT NOT NULL,
+        correct_answer TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (test_id, position)
+    );
+
+    CREATE TABLE IF NOT EXISTS answers (
+        test_id TEXT NOT NULL,
+        question_id TEXT NOT NULL,
+        selected_option TEXT,
+        PRIMARY KEY (test_id, question_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS results (
+        test_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        question_id TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        difficulty TEXT NOT NULL,
+        user_answer TEXT,
+        is_correct INTEGER NOT NULL,
+        PRIMARY KEY (test_id, position)
+    );
+    CREATE INDEX IF NOT EXISTS idx_results_question ON results (question_id);
+
+    CREATE TABLE IF NOT EXISTS performance (
+        scope TEXT NOT NULL,
+        scope_id TEXT NOT NULL,
+        tests_taken INTEGER NOT NULL,
+        percentage_sum REAL NOT NULL,
+        first_tests TEXT NOT NULL,
+        recent_tests TEXT NOT NULL,
+        PRIMARY KEY (scope, scope_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS topic_performance (
+        scope TEXT NOT NULL,
+        scope_id TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        tests INTEGER NOT NULL,
+        correct INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        PRIMARY KEY (scope, scope_id, topic)
+    );
+    CREATE INDEX IF NOT EXISTS idx_topic_performance_tests ON topic_performance (scope, scope_id, tests DESC);
+
+    CREATE TABLE IF NOT EXISTS class_stats (
+        document_id TEXT PRIMARY KEY,
+        submissions INTEGER NOT NULL,
+        version INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS item_stats (
+        document_id TEXT NOT NULL,
+        question_id TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        difficulty TEXT NOT NULL,
+        correct_answer TEXT,
+        attempts INTEGER NOT NULL,
+        correct INTEGER NOT NULL,
+        score_sum REAL NOT NULL,
+        score_squares REAL NOT NULL,
+        correct_score_sum REAL NOT NULL,
+        PRIMARY KEY (document_id, question_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS item_options (
+        document_id TEXT NOT NULL,
+        question_id TEXT NOT NULL,
+        option TEXT NOT NULL,
+        chosen INTEGER NOT NULL,
+        PRIMARY KEY (document_id, question_id, option)
+    );
+
+    CREATE TABLE IF NOT EXISTS topic_mastery (
+        document_id TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        band INTEGER NOT NULL,
+        submissions INTEGER NOT NULL,
+        percentage_sum REAL NOT NULL,
+        PRIMARY KEY (document_id, topic, band)
+    );
+"""
+
+# Tests averaged at each end of a history to measure improvement
+TREND_WINDOW = 3
+
+
+def _guarded(method):
+    # Reads of an in-memory store hold its lock; file-backed stores need none
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._guard:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class SessionStore:
+    """
+    Test sessions in SQLite, normalized into four tables:
+
+        sessions   one row per test: document, user, timestamps, score and
+                   a summary of the graded submission (per topic and
+                   difficulty, weak areas, recommendations)
+        questions  each test's questions, in order
+        answers    the option picked for each question
+        results    per-question grading: topic, difficulty, correctness
+
+    A session graded in a batch (save_batch) has no questions of its own
+    but reads those of its source_test_id, and keeps just its score and
+    its answer sheet, the option picked for each question in order: one
+    row per student, where analyze_test writes two per question. Its
+    analysis is rebuilt from the sheet when asked for (see sheet()).
+
+    Sessions are indexed by test_id, document_id, user_id and by creation
+    and submission time, so loading a test's analysis or a user's history
+    is an index lookup. db_path=None keeps the database in memory, visible
+    to this process only; a file is shared by every worker process.
+
+    Trends come from running aggregates, kept for everyone (scope 'all')
+    and per user (scope 'user'):
+
+        performance        tests taken, sum of percentages, and the first
+                           and most recent TREND_WINDOW tests
+        topic_performance  per topic: tests covering it, questions
+                           answered and answered correctly
+
+    Each submission updates them in the same transaction, touching one row
+    per scope plus one per topic, so reading trends costs the same however
+    many tests have been taken.
+
+    Per document, the same transaction adds the submission to the totals
+    ClassAnalytics reports from (see class_analytics.tally):
+
+        class_stats    submissions, and a version bumped on every change
+        item_stats     per question: attempts, correct answers and score sums
+        item_options   per question and option: times picked
+        topic_mastery  per topic and 10-point band: submissions scoring in it
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._local = threading.local()
+        if db_path:
+            # Each thread gets its own connection; SQLite serializes writers
+            self._guard = contextlib.nullcontext()
+            self._memory = None
+        else:
+            # An in-memory database is a single connection, used under a lock
+            self._guard = threading.RLock()
+            self._memory = sqlite3.connect(':memory:', check_same_thread=False)
+
+        with self._write() as conn:
+            if db_path:
+                conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(sessions)')]
+            for column in ('source_test_id', 'sheet'):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE sessions ADD COLUMN {column} TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_source ON sessions (source_test_id)')
+        with self._write(immediate=True) as conn:
+            self._backfill(conn)
+            self._backfill_classes(conn)
+
+    def _connect(self):
+        if self._memory is not None:
+            return self._memory
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _write(self, immediate=False):
+        """
+        A connection whose statements commit together, or roll back on error.
+        immediate takes the write lock up front, for read-modify-write.
+        """
+        with self._guard, self._connect() as conn:
+            if immediate:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+
+    def create(self, test_id, document_id, questions, user_id=None, created_at=None):
+        with self._write() as conn:
+            conn.execute(
+                'INSERT INTO sessions (test_id, document_id, user_id, created_at) VALUES (?, ?, ?, ?)',
+                (test_id, document_id, user_id, created_at or time.time())
+            )
+            conn.executemany(
+                'INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        test_id, position, str(q['id']), q.get('topic', 'General'),
+                        q.get('difficulty', 'medium'), q.get('correct_answer'), json.dumps(q)
+                    )
+                    for position, q in enumerate(questions)
+                ]
+            )
+
+    @_guarded
+    def questions(self, test_id):
+        rows = self._connect().execute(
+            'SELECT q.data FROM sessions s JOIN questions q ON q.test_id = COALESCE(s.source_test_id, s.test_id) '
+            'WHERE s.test_id = ? ORDER BY q.position', (test_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    @_guarded
+    def get(self, test_id):
+        """
+        The session as {'test_id', 'document_id', 'user_id', 'questions',
+        'created_at', 'submitted', 'answers', 'results'}, or None
+        """
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT document_id, user_id, created_at, submitted_at, sheet FROM sessions WHERE test_id = ?', (test_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        submitted = row[3] is not None
+        questions = self.questions(test_id)
+        answers = None
+        if row[4] is not None:
+            answers = [
+                {'question_id': q['id'], 'selected_option': selected}
+                for q, selected in zip(questions, json.loads(row[4])) if selected is not None
+            ]
+        elif submitted:
+            answers = [
+                {'question_id': question_id, 'selected_option': selected}
+                for question_id, selected in conn.execute(
+                    'SELECT question_id, selected_option FROM answers WHERE test_id = ?', (test_id,)
+                )
+            ]
+        return {
+            'test_id': test_id,
+            'document_id': row[0],
+            'user_id': row[1],
+            'questions': questions,
+            'created_at': datetime.fromtimestamp(row[2]).isoformat(),
+            'submitted': submitted,
+            'answers': answers,
+            'results': self.analysis(test_id) if submitted else None
+        }
+
+    def save_results(self, test_id, user_answers, analysis, submitted_at=None):
+        """
+        Record a graded submission, replacing any earlier one for the test.
+        analysis is the dict TestAnalyzer.analyze_test returns.
+        """
+        summary = {
+            'topic_analysis': {
+                topic: {k: v for k, v in perf.items() if k != 'questions_detail'}
+                for topic, perf in analysis['topic_analysis'].items()
+            },
+            'difficulty_breakdown': analysis['difficulty_breakdown'],
+            'weak_areas': analysis['weak_areas'],
+            'recommendations': analysis['recommendations']
+        }
+        topics = {topic: (perf['correct'], perf['total']) for topic, perf in analysis['topic_analysis'].items()}
+        rows = [
+            (str(r['question_id']), r['topic'], r['difficulty'], r['correct_answer'], r['user_answer'], r['is_correct'])
+            for r in analysis['detailed_results']
+        ]
+        with self._write(immediate=True) as conn:
+            # A resubmission replaces the earlier result in every total
+            document_id, user_id, earlier = self._submission(conn, test_id)
+            previous = None
+            if earlier is not None:
+                previous = (earlier[0], self._topic_counts(earlier[1]))
+                self._add_tally(conn, document_id, tally_rows([earlier]), sign=-1)
+            for scope in self._scopes(user_id):
+                self._aggregate(conn, scope, test_id, analysis['percentage'], topics, previous)
+            self._add_tally(conn, document_id, tally_rows([(analysis['percentage'], rows)]))
+
+            conn.execute('DELETE FROM answers WHERE test_id = ?', (test_id,))
+            conn.execute('DELETE FROM results WHERE test_id = ?', (test_id,))
+            conn.executemany(
+                'INSERT OR REPLACE INTO answers VALUES (?, ?, ?)',
+                [(test_id, str(a['question_id']), a.get('selected_option')) for a in user_answers]
+            )
+            conn.executemany(
+                'INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        test_id, position, str(r['question_id']), r['topic'], r['difficulty'],
+                        r['user_answer'], int(r['is_correct'])
+                    )
+                    for position, r in enumerate(analysis['detailed_results'])
+                ]
+            )
+            conn.execute(
+                'UPDATE sessions SET submitted_at = ?, score = ?, max_score = ?, percentage = ?, summary = ?, '
+                'sheet = NULL WHERE test_id = ?',
+                (
+                    submitted_at or time.time(), analysis['score'], analysis['max_score'],
+                    analysis['percentage'], json.dumps(summary), test_id
+                )
+            )
+
+    @_guarded
+    def analysis(self, test_id):
+        """
+        A submitted test's analysis in the shape analyze_test returned it,
+        rebuilt from the session summary and the per-question rows; None
+        for a batch-graded sheet
+        """
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT score, max_score, percentage, summary, submitted_at FROM sessions '
+            'WHERE test_id = ? AND submitted_at IS NOT NULL AND sheet IS NULL', (test_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        summary = json.loads(row[3])
+        topic_analysis = summary['topic_analysis']
+        for perf in topic_analysis.values():
+            perf['questions_detail'] = []
+
+        detailed_results = []
+        for question_id, topic, difficulty, user_answer, is_correct, data in conn.execute(
+            'SELECT r.question_id, r.topic, r.difficulty, r.user_answer, r.is_correct, q.data '
+            'FROM results r JOIN sessions s ON s.test_id = r.test_id '
+            'JOIN questions q ON q.test_id = COALESCE(s.source_test_id, s.test_id) AND q.position = r.position '
+            'WHERE r.test_id = ? ORDER BY r.position', (test_id,)
+        ):
+            question = json.loads(data)
+            is_correct = bool(is_correct)
+            detailed_results.append({
+                'question_id': question.get('id', question_id),
+                'question': question['question'],
+                'topic': topic,
+                'difficulty': difficulty,
+                'user_answer': user_answer,
+                'correct_answer': question['correct_answer'],
+                'is_correct': is_correct,
+                'explanation': question.get('explanation', 'No explanation available')
+            })
+            if topic in topic_analysis:
+                topic_analysis[topic]['questions_detail'].append({
+                    'question': question['question'],
+                    'correct': is_correct,
+                    'user_answer': user_answer,
+                    'correct_answer': question['correct_answer']
+                })
+
+        return {
+            'test_id': test_id,
+            'score': row[0],
+            'max_score': row[1],
+            'percentage': row[2],
+            'topic_analysis': topic_analysis,
+            'difficulty_breakdown': summary['difficulty_breakdown'],
+            'detailed_results': detailed_results,
+            'weak_areas': summary['weak_areas'],
+            'recommendations': summary['recommendations'],
+            'submitted_at': datetime.fromtimestamp(row[4]).isoformat()
+        }
+
+    @_guarded
+    def sheet(self, test_id):
+        """
+        A batch-graded session as (questions, answers, submitted_at), for
+        grading it again, or None
+        """
+        row = self._connect().execute(
+            'SELECT sheet, submitted_at FROM sessions WHERE test_id = ? AND sheet IS NOT NULL', (test_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        questions = self.questions(test_id)
+        answers = [
+            {'question_id': q['id'], 'selected_option': selected}
+            for q, selected in zip(questions, json.loads(row[0])) if selected is not None
+        ]
+        return questions, answers, row[1]
+
+    def save_batch(self, source_test_id, submissions, tally, submitted_at=None):
+        """
+        Record many graded submissions of source_test_id in one transaction,
+        each as its own session. submissions are dicts with test_id,
+        user_id, sheet (the option picked for each question in order, None
+        where unanswered), score, max_score, percentage and topics as
+        {topic: (correct, total)}; tally is their class_analytics.tally().
+        """
+        submitted_at = submitted_at or time.time()
+        with self._write(immediate=True) as conn:
+            row = conn.execute('SELECT document_id FROM sessions WHERE test_id = ?', (source_test_id,)).fetchone()
+            if row is None:
+                raise KeyError(f"Unknown test: {source_test_id}")
+            conn.executemany(
+                'INSERT INTO sessions (test_id, document_id, user_id, created_at, submitted_at, score, max_score, '
+                'percentage, source_test_id, sheet) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        sub['test_id'], row[0], sub['user_id'], submitted_at, submitted_at, sub['score'],
+                        sub['max_score'], sub['percentage'], source_test_id, json.dumps(sub['sheet'])
+                    )
+                    for sub in submissions
+                ]
+            )
+            self._aggregate_many(conn, [
+                (sub['user_id'], sub['test_id'], sub['percentage'], sub['topics']) for sub in submissions
+            ])
+            self._add_tally(conn, row[0], tally)
+
+    @staticmethod
+    def _scopes(user_id):
+        return [('all', '')] + ([('user', str(user_id))] if user_id is not None else [])
+
+    @staticmethod
+    def _topic_counts(rows):
+        """{topic: (correct, total)} of a submission's rows as _submission returns them"""
+        counts = {}
+        for _, topic, _, _, _, is_correct in rows:
+            correct, total = counts.get(topic, (0, 0))
+            counts[topic] = (correct + bool(is_correct), total + 1)
+        return counts
+
+    @staticmethod
+    def _aggregate(conn, scope, test_id, percentage, topics, previous=None):
+        """Fold one submission into a scope's running aggregates"""
+        row = conn.execute(
+            'SELECT tests_taken, percentage_sum, first_tests, recent_tests FROM performance '
+            'WHERE scope = ? AND scope_id = ?', scope
+        ).fetchone()
+        tests_taken, percentage_sum, first, recent = (0, 0.0, [], []) if row is None else \
+            (row[0], row[1], json.loads(row[2]), json.loads(row[3]))
+
+        if previous is None:
+            tests_taken += 1
+            if len(first) < TREND_WINDOW:
+                first.append([test_id, percentage])
+            recent = (recent + [[test_id, percentage]])[-TREND_WINDOW:]
+        else:
+            # A resubmission replaces the test's earlier result wherever it is counted
+            percentage_sum -= previous[0]
+            first = [[t, percentage if t == test_id else p] for t, p in first]
+            recent = [[t, percentage if t == test_id else p] for t, p in recent]
+        percentage_sum += percentage
+
+        conn.execute(
+            'INSERT OR REPLACE INTO performance VALUES (?, ?, ?, ?, ?, ?)',
+            scope + (tests_taken, percentage_sum, json.dumps(first), json.dumps(recent))
+        )
+
+        deltas = {topic: [1, correct, total] for topic, (correct, total) in topics.items()}
+        for topic, (correct, total) in (previous[1] if previous else {}).items():
+            delta = deltas.setdefault(topic, [0, 0, 0])
+            delta[0] -= 1
+            delta[1] -= correct
+            delta[2] -= total
+        conn.executemany(
+            'INSERT INTO topic_performance VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (scope, scope_id, topic) DO UPDATE SET '
+            'tests = tests + excluded.tests, correct = correct + excluded.correct, total = total + excluded.total',
+            [scope + (topic, *delta) for topic, delta in deltas.items()]
+        )
+
+    @classmethod
+    def _aggregate_many(cls, conn, submissions):
+        """
+        Fold new submissions, as (user_id, test_id, percentage, topics) in
+        submission order, into the running aggregates with one update per
+        scope rather than one per submission
+        """
+        by_scope = defaultdict(list)
+        for user_id, test_id, percentage, topics in submissions:
+            for scope in cls._scopes(user_id):
+                by_scope[scope].append((test_id, percentage, topics))
+
+        # Current rows, looked up by primary key in chunks of scope ids;
+        # rows are written back in key order, which keeps the B-tree writes local
+        scopes = sorted(by_scope)
+        current = {}
+        for start in range(0, len(scopes), 500):
+            chunk = scopes[start:start + 500]
+            for kind in {kind for kind, _ in chunk}:
+                ids = [scope_id for scope_kind, scope_id in chunk if scope_kind == kind]
+                current.update(((row[0], row[1]), row[2:]) for row in conn.execute(
+                    'SELECT scope, scope_id, tests_taken, percentage_sum, first_tests, recent_tests FROM performance '
+                    f'WHERE scope = ? AND scope_id IN ({", ".join("?" * len(ids))})', [kind] + ids
+                ))
+
+        performance = []
+        topic_rows = []
+        for scope in scopes:
+            entries = by_scope[scope]
+            row = current.get(scope)
+            tests_taken, percentage_sum, first, recent = (0, 0.0, [], []) if row is None else \
+                (row[0], row[1], json.loads(row[2]), json.loads(row[3]))
+            tests = [[test_id, percentage] for test_id, percentage, _ in entries]
+            first = (first + tests)[:TREND_WINDOW]
+            recent = (recent + tests)[-TREND_WINDOW:]
+            performance.append(scope + (
+                tests_taken + len(entries), percentage_sum + sum(p for _, p in tests),
+                json.dumps(first), json.dumps(recent)
+            ))
+            deltas = {}
+            for _, _, topics in entries:
+                for topic, (correct, total) in topics.items():
+                    tests_delta, correct_delta, total_delta = deltas.get(topic, (0, 0, 0))
+                    deltas[topic] = (tests_delta + 1, correct_delta + correct, total_delta + total)
+            topic_rows.extend(scope + (topic,) + delta for topic, delta in sorted(deltas.items()))
+
+        conn.executemany('INSERT OR REPLACE INTO performance VALUES (?, ?, ?, ?, ?, ?)', performance)
+        conn.executemany(
+            'INSERT INTO topic_performance VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (scope, scope_id, topic) DO UPDATE SET '
+            'tests = tests + excluded.tests, correct = correct + excluded.correct, total = total + excluded.total',
+            topic_rows
+        )
+
+    def _backfill(self, conn):
+        """Build the aggregates of a database created before they were kept"""
+        if conn.execute('SELECT 1 FROM performance LIMIT 1').fetchone():
+            return
+        submitted = conn.execute(
+            'SELECT test_id, user_id, percentage FROM sessions WHERE submitted_at IS NOT NULL ORDER BY submitted_at'
+        ).fetchall()
+        for test_id, user_id, percentage in submitted:
+            topics = {
+                topic: (correct, total) for topic, correct, total in conn.execute(
+                    'SELECT topic, SUM(is_correct), COUNT(*) FROM results WHERE test_id = ? GROUP BY topic',
+                    (test_id,)
+                )
+            }
+            for scope in self._scopes(user_id):
+                self._aggregate(conn, scope, test_id, percentage, topics)
+
+    @staticmethod
+    def _submission(conn, test_id):
+        """
+        The test's document and user, and its graded submission as
+        (percentage, rows of (question_id, topic, difficulty,
+        correct_answer, user_answer, is_correct)), or None if it was not
+        submitted
+        """
+        row = conn.execute(
+            'SELECT document_id, submitted_at, percentage, sheet, COALESCE(source_test_id, test_id), user_id '
+            'FROM sessions WHERE test_id = ?', (test_id,)
+        ).fetchone()
+        if row is None:
+            return None, None, None
+        if row[1] is None:
+            return row[0], row[5], None
+        if row[3] is None:
+            rows = conn.execute(
+                'SELECT r.question_id, r.topic, r.difficulty, q.correct_answer, r.user_answer, r.is_correct '
+                'FROM results r JOIN questions q ON q.test_id = ? AND q.position = r.position '
+                'WHERE r.test_id = ? ORDER BY r.position', (row[4], test_id)
+            ).fetchall()
+        else:
+            rows = [
+                (question_id, topic, difficulty, correct_answer, selected, selected == correct_answer)
+                for (question_id, topic, difficulty, correct_answer), selected in zip(conn.execute(
+                    'SELECT question_id, topic, difficulty, correct_answer FROM questions '
+                    'WHERE test_id = ? ORDER BY position', (row[4],)
+                ), json.loads(row[3]))
+            ]
+        return row[0], row[5], (row[2], rows)
+
+    @staticmethod
+    def _add_tally(conn, document_id, tally, sign=1):
+        """Add a class_analytics.tally() to the document's totals, or with sign=-1 take it away"""
+        conn.executemany(
+            'INSERT INTO item_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (document_id, question_id) DO UPDATE SET '
+            'topic = excluded.topic, difficulty = excluded.difficulty, correct_answer = excluded.correct_answer, '
+            'attempts = attempts + excluded.attempts, correct = correct + excluded.correct, '
+            'score_sum = score_sum + excluded.score_sum, score_squares = score_squares + excluded.score_squares, '
+            'correct_score_sum = correct_score_sum + excluded.correct_score_sum',
+            [
+                (document_id,) + row[:4] + tuple(sign * value for value in row[4:])
+                for row in tally['items']
+            ]
+        )
+        conn.executemany(
+            'INSERT INTO item_options VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (document_id, question_id, option) DO UPDATE SET chosen = chosen + excluded.chosen',
+            [(document_id, question_id, option, sign * chosen) for question_id, option, chosen in tally['options']]
+        )
+        conn.executemany(
+            'INSERT INTO topic_mastery VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (document_id, topic, band) DO UPDATE SET '
+            'submissions = submissions + excluded.submissions, percentage_sum = percentage_sum + excluded.percentage_sum',
+            [(document_id, topic, band, sign * n, sign * total) for topic, band, n, total in tally['bands']]
+        )
+        conn.execute(
+            'INSERT INTO class_stats VALUES (?, ?, 1) ON CONFLICT (document_id) DO UPDATE SET '
+            'submissions = submissions + excluded.submissions, version = version + 1',
+            (document_id, sign * tally['submissions'])
+        )
+
+    def _backfill_classes(self, conn):
+        """Build the class totals of a database created before they were kept"""
+        if conn.execute('SELECT 1 FROM class_stats LIMIT 1').fetchone():
+            return
+        submitted = defaultdict(list)
+        for document_id, test_id in conn.execute(
+            'SELECT document_id, test_id FROM sessions WHERE submitted_at IS NOT NULL'
+        ).fetchall():
+            submitted[document_id].append(test_id)
+        for document_id, test_ids in submitted.items():
+            self._add_tally(conn, document_id, tally_rows([self._submission(conn, t)[2] for t in test_ids]))
+
+    @_guarded
+    def class_version(self, document_id):
+        """The version of the document's class totals, or None if nothing was submitted on it"""
+        row = self._connect().execute(
+            'SELECT version FROM class_stats WHERE document_id = ? AND submissions > 0', (document_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @_guarded
+    def class_stats(self, document_id):
+        """
+        The document's class totals as {'submissions', 'version', 'items',
+        'options', 'bands'}, rows shaped as class_analytics.tally() returns
+        them, or None
+        """
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT submissions, version FROM class_stats WHERE document_id = ? AND submissions > 0', (document_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'submissions': row[0],
+            'version': row[1],
+            'items': conn.execute(
+                'SELECT question_id, topic, difficulty, correct_answer, attempts, correct, score_sum, score_squares, '
+                'correct_score_sum FROM item_stats WHERE document_id = ? AND attempts > 0', (document_id,)
+            ).fetchall(),
+            'options': conn.execute(
+                'SELECT question_id, option, chosen FROM item_options WHERE document_id = ? AND chosen > 0',
+                (document_id,)
+            ).fetchall(),
+            'bands': conn.execute(
+                'SELECT topic, band, submissions, percentage_sum FROM topic_mastery '
+                'WHERE document_id = ? AND submissions > 0', (document_id,)
+            ).fetchall()
+        }
+
+    @_guarded
+    def trends(self, user_id=None, top_topics=5):
+        """
+        Submitted-test statistics for one user, or everyone when user_id is
+        None: tests taken, average percentage, the average of the first and
+        of the most recent TREND_WINDOW tests, and the most tested topics
+        with how many tests covered each
+        """
+        conn = self._connect()
+        scope = self._scopes(user_id)[-1]
+        row = conn.execute(
+            'SELECT tests_taken, percentage_sum, first_tests, recent_tests FROM performance '
+            'WHERE scope = ? AND scope_id = ?', scope
+        ).fetchone()
+        if row is None or not row[0]:
+            return None
+
+        first, recent = json.loads(row[2]), json.loads(row[3])
+        topics = conn.execute(
+            'SELECT topic, tests, correct, total FROM topic_performance '
+            'WHERE scope = ? AND scope_id = ? AND tests > 0 ORDER BY tests DESC, topic LIMIT ?',
+            scope + (top_topics,)
+        ).fetchall()
+        return {
+            'tests_taken': row[0],
+            'average_score': row[1] / row[0],
+            'first_average': sum(p for _, p in first) / len(first),
+            'recent_average': sum(p for _, p in recent) / len(recent),
+            'topic_counts': {topic: tests for topic, tests, _, _ in topics},
+            'topic_accuracy': {topic: round(correct / total * 100, 2) for topic, _, correct, total in topics if total}
+        }
+
+    def purge_unsubmitted(self, older_than):
+        """
+        Delete tests created before older_than (a timestamp) and never
+        submitted, unless batch-graded sessions use their questions
+        """
+        stale = (
+            'SELECT test_id FROM sessions WHERE created_at < ? AND submitted_at IS NULL '
+            'AND test_id NOT IN (SELECT source_test_id FROM sessions WHERE source_test_id IS NOT NULL)'
+        )
+        with self._write() as conn:
+            conn.execute(f'DELETE FROM questions WHERE test_id IN ({stale})', (older_than,))
+            return conn.execute(f'DELETE FROM sessions WHERE test_id IN ({stale})', (older_than,)).rowcount
@@ -1,29 +1,68 @@
+import time
 import uuid
+import threading
 from datetime import datetime
 from collections import defaultdict
-import pandas as pd
 import numpy as np
+from metrics import get_metrics
+from session_store import SessionStore
+from class_analytics import ClassAnalytics, tally
 
 class TestAnalyzer:
-    def __init__(self):
-        self.test_sessions = {}  # Store test sessions and results
-        self.performance_db = []  # Store all test performances for analytics
-
-    def create_test_session(self, document_id, questions):
+    def __init__(self, db_path=None, cache_ttl=3600, retention_seconds=7 * 24 * 3600):
+        # Sessions, answers and graded results, shared by every worker using db_path
+        self.store = SessionStore(db_path)
+        self.class_analytics = ClassAnalytics(self.store)
+
+        # Questions of recently created, unsubmitted tests, so grading skips
+        # the database; entries expire after cache_ttl seconds
+        self.test_sessions = {}  # test_id -> (questions, expires_at)
+        self.cache_ttl = cache_ttl
+
+        # Tests never submitted are deleted from storage after this long
+        self.retention_seconds = retention_seconds
+        self._next_purge = 0.0
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        expired = [test_id for test_id, (_, expires_at) in self.test_sessions.items() if expires_at <= now]
+        for test_id in expired:
+            del self.test_sessions[test_id]
+
+        if now >= self._next_purge:
+            self._next_purge = now + min(self.cache_ttl, self.retention_seconds)
+            self.store.purge_unsubmitted(now - self.retention_seconds)
+
+    def get_session(self, test_id):
+        """
+        The session with its questions and, once submitted, its answers and
+        results. Read from storage, so a test graded by another worker is
+        seen as submitted.
+        """
+        session = self.store.get(test_id)
+        if session and session['submitted'] and session['results'] is None:
+            session['results'] = self.get_detailed_analysis(test_id)
+        return session
+
+    def _questions(self, test_id):
+        cached = self.test_sessions.get(test_id)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        questions = self.store.questions(test_id)
+        return questions or None
+
+    def create_test_session(self, document_id, questions, user_id=None):
         """
-        Create a new test session
+        Create a new test session. user_id, if known, groups the user's
+        tests for get_performance_trends.
         """
         test_id = str(uuid.uuid4())
+        now = time.time()
+        self.store.create(test_id, document_id, questions, user_id=user_id, created_at=now)
 
-        self.test_sessions[test_id] = {
-            'test_id': test_id,
-            'document_id': document_id,
-            'questions': questions,
-            'created_at': datetime.now().isoformat(),
-            'submitted': False,
-            'answers': None,
-            'results': None
-        }
+        with self._lock:
+            self._evict(now)
+            self.test_sessions[test_id] = (questions, now + self.cache_ttl)
 
         return test_id
 
@@ -32,12 +71,24 @@ class TestAnalyzer:
         Analyze test results and generate detailed feedback
         user_answers: list of {question_id, selected_option}
         """
-        if test_id not in self.test_sessions:
+        with get_metrics().timer('smartprep_analyze_test_seconds'):
+            return self._analyze_test(test_id, user_answers)
+
+    def _analyze_test(self, test_id, user_answers):
+        questions = self._questions(test_id)
+        if questions is None:
             raise ValueError("Test session not found")
 
-        session = self.test_sessions[test_id]
-        questions = session['questions']
+        submitted_at = time.time()
+        analysis = self._grade(test_id, questions, user_answers, submitted_at)
 
+        self.store.save_results(test_id, user_answers, analysis, submitted_at)
+        with self._lock:
+            self.test_sessions.pop(test_id, None)
+
+        return analysis
+
+    def _grade(self, test_id, questions, user_answers, submitted_at):
         # Create answer lookup
         answer_lookup = {ans['question_id']: ans['selected_option'] for ans in user_answers}
 
@@ -88,27 +139,18 @@ class TestAnalyzer:
         for topic, perf in topic_performance.items():
             percentage = (perf['correct'] / perf['total']) * 100
 
-            # Categorize performance level
-            if percentage >= 80:
-                level = 'Good'
-            elif percentage >= 50:
-                level = 'Moderate'
-            else:
-                level = 'Needs Improvement'
-
             topic_analysis[topic] = {
                 'correct': perf['correct'],
                 'total': perf['total'],
                 'percentage': round(percentage, 2),
-                'level': level,
+                'level': self._level(percentage),
                 'questions_detail': perf['questions']
             }
 
         # Overall performance
         overall_percentage = (total_score / max_score) * 100
 
-        # Store results
-        analysis = {
+        return {
             'test_id': test_id,
             'score': total_score,
             'max_score': max_score,
@@ -118,25 +160,174 @@ class TestAnalyzer:
             'detailed_results': results,
             'weak_areas': self._identify_weak_areas(topic_analysis),
             'recommendations': self._generate_recommendations(topic_analysis),
-            'submitted_at': datetime.now().isoformat()
+            'submitted_at': datetime.fromtimestamp(submitted_at).isoformat()
         }
 
-        # Update session
-        session['submitted'] = True
-        session['answers'] = user_answers
-        session['results'] = analysis
+    def grade_batch(self, test_id, submissions):
+        """
+        Grade many answer sheets for one test together, e.g. a whole class
+        at the end of an exam. submissions: list of {student_id, answers},
+        with answers as for analyze_test.
+
+        Every sheet is encoded into one (students x questions) matrix of
+        option codes and compared against the answer-key array at once;
+        per-topic and per-difficulty scores are matrix products with the
+        questions' topic and difficulty indicators. Each sheet is stored as
+        its own submitted test, all in one transaction, and its full
+        analysis is available from get_detailed_analysis with the test_id
+        returned for it. Returns each student's score, topic percentages
+        and weak areas, and a class summary by topic and difficulty.
+        """
+        with get_metrics().timer('smartprep_grade_batch_seconds'):
+            return self._grade_batch(test_id, submissions)
+
+    def _grade_batch(self, test_id, submissions):
+        questions = self._questions(test_id)
+        if questions is None:
+            raise KeyError("Test session not found")
+        if not submissions:
+            raise ValueError("No submissions")
+
+        # Options are coded as small ints; the key is each question's correct code
+        codes = {}
+        key = np.array([codes.setdefault(q['correct_answer'], len(codes)) for q in questions])
+        column = {q['id']: j for j, q in enumerate(questions)}
+        rows, columns, picks = [], [], []
+        for i, submission in enumerate(submissions):
+            for answer in submission.get('answers') or []:
+                j = column.get(answer.get('question_id'))
+                option = answer.get('selected_option')
+                if j is not None and option is not None:
+                    rows.append(i)
+                    columns.append(j)
+                    picks.append(codes.setdefault(option, len(codes)))
+        answers = np.full((len(submissions), len(questions)), -1, dtype=np.int32)
+        answers[rows, columns] = picks
+        correct = answers == key
+
+        # Topics and difficulties in order of first appearance, as analyze_test reports them
+        topics, topic_of = self._categories([q.get('topic', 'General') for q in questions])
+        difficulties, difficulty_of = self._categories([q.get('difficulty', 'medium') for q in questions])
+        topic_totals = np.bincount(topic_of, minlength=len(topics))
+        difficulty_totals = np.bincount(difficulty_of, minlength=len(difficulties))
+        topic_correct = correct.astype(np.int32) @ np.eye(len(topics), dtype=np.int32)[topic_of]
+        difficulty_correct = correct.astype(np.int32) @ np.eye(len(difficulties), dtype=np.int32)[difficulty_of]
+        topic_percent = topic_correct / topic_totals * 100
+        scores = correct.sum(axis=1)
+        max_score = len(questions)
+        percentages = scores / max_score * 100
+
+        # Weak areas as analyze_test finds them: below 50%, worst first
+        worst_first = np.argsort(topic_percent, axis=1, kind='stable')
+        weak = np.take_along_axis(topic_percent < 50, worst_first, axis=1)
+
+        # Plain lists from here on: per-element numpy access costs more than the grading
+        sheets = np.array(list(codes) + [None], dtype=object)[answers].tolist()  # -1 picks the trailing None
+        topic_correct_rows, topic_percent_rows = topic_correct.tolist(), topic_percent.tolist()
+        worst_first_rows, weak_rows = worst_first.tolist(), weak.tolist()
+        topic_total_list = topic_totals.tolist()
+        scores_list, percentages_list = scores.tolist(), percentages.tolist()
+
+        results = []
+        stored = []
+        for i, submission in enumerate(submissions):
+            student_id = submission.get('student_id', submission.get('user_id'))
+            result = {
+                'student_id': student_id,
+                'test_id': str(uuid.uuid4()),
+                'score': scores_list[i],
+                'max_score': max_score,
+                'percentage': round(percentages_list[i], 2),
+                'topic_scores': {topic: round(p, 2) for topic, p in zip(topics, topic_percent_rows[i])},
+                'weak_areas': [topics[t] for t, is_weak in zip(worst_first_rows[i], weak_rows[i]) if is_weak]
+            }
+            results.append(result)
+            stored.append({
+                'test_id': result['test_id'],
+                'user_id': student_id,
+                'sheet': sheets[i],
+                'score': result['score'],
+                'max_score': max_score,
+                'percentage': result['percentage'],
+                'topics': dict(zip(topics, zip(topic_correct_rows[i], topic_total_list)))
+            })
+
+        # The class totals of every sheet at once, straight from the matrices
+        students, count = len(submissions), len(questions)
+        class_tally = tally(
+            [(str(q['id']), q.get('topic', 'General'), q.get('difficulty', 'medium'), q['correct_answer'])
+             for q in questions],
+            list(codes), [result['percentage'] for result in results],
+            np.repeat(np.arange(students), count), np.tile(np.arange(count), students),
+            answers.ravel(), correct.ravel()
+        )
+
+        submitted_at = time.time()
+        self.store.save_batch(test_id, stored, class_tally, submitted_at)
 
-        # Store in performance database
-        self.performance_db.append({
+        return {
             'test_id': test_id,
-            'timestamp': datetime.now(),
-            'score': total_score,
-            'max_score': max_score,
-            'percentage': overall_percentage,
-            'topics': list(topic_analysis.keys())
-        })
+            'students': len(results),
+            'submitted_at': datetime.fromtimestamp(submitted_at).isoformat(),
+            'results': results,
+            'class_summary': self._class_summary(
+                percentages, topics, topic_correct, topic_totals, topic_percent,
+                difficulties, difficulty_correct, difficulty_totals
+            )
+        }
 
-        return analysis
+    def _class_summary(self, percentages, topics, topic_correct, topic_totals, topic_percent,
+                       difficulties, difficulty_correct, difficulty_totals):
+        """
+        Class-wide score statistics and topic and difficulty breakdowns
+        """
+        students = len(percentages)
+        topic_rates = topic_correct.sum(axis=0) / (topic_totals * students) * 100
+        difficulty_rates = difficulty_correct.sum(axis=0) / (difficulty_totals * students) * 100
+        distribution, _ = np.histogram(percentages, bins=10, range=(0, 100))
+        return {
+            'average_percentage': round(float(percentages.mean()), 2),
+            'median_percentage': round(float(np.median(percentages)), 2),
+            'min_percentage': round(float(percentages.min()), 2),
+            'max_percentage': round(float(percentages.max()), 2),
+            'std_percentage': round(float(percentages.std()), 2),
+            # Students per 10-point band: 0-10%, 10-20%, ... 90-100%
+            'score_distribution': distribution.tolist(),
+            'topics': {
+                topic: {
+                    'correct': int(topic_correct[:, t].sum()),
+                    'total': int(topic_totals[t] * students),
+                    'percentage': round(float(topic_rates[t]), 2),
+                    'level': self._level(topic_rates[t]),
+                    'students_needing_improvement': int((topic_percent[:, t] < 50).sum())
+                }
+                for t, topic in enumerate(topics)
+            },
+            'difficulty': {
+                difficulty: {
+                    'correct': int(difficulty_correct[:, d].sum()),
+                    'total': int(difficulty_totals[d] * students),
+                    'percentage': round(float(difficulty_rates[d]), 2)
+                }
+                for d, difficulty in enumerate(difficulties)
+            }
+        }
+
+    @staticmethod
+    def _categories(values):
+        """Distinct values in order of first appearance, and each value's index among them"""
+        index = {}
+        codes = np.array([index.setdefault(value, len(index)) for value in values])
+        return list(index), codes
+
+    @staticmethod
+    def _level(percentage):
+        """Categorize performance level"""
+        if percentage >= 80:
+            return 'Good'
+        if percentage >= 50:
+            return 'Moderate'
+        return 'Needs Improvement'
 
     def _identify_weak_areas(self, topic_analysis):
         """
@@ -195,51 +386,48 @@ class TestAnalyzer:
 
     def get_detailed_analysis(self, test_id):
         """
-        Retrieve detailed analysis for a test
+        Retrieve detailed analysis for a submitted test. A sheet graded by
+        grade_batch is graded again from its stored answers.
         """
-        if test_id not in self.test_sessions:
-            return None
+        analysis = self.store.analysis(test_id)
+        if analysis is None:
+            sheet = self.store.sheet(test_id)
+            if sheet is not None:
+                questions, answers, submitted_at = sheet
+                analysis = self._grade(test_id, questions, answers, submitted_at)
+        return analysis
 
-        session = self.test_sessions[test_id]
-        return session.get('results')
+    def get_class_analytics(self, document_id):
+        """
+        Item analysis over every submitted test on a document: difficulty
+        index, discrimination and option rates per question, and mastery
+        distribution per topic (see ClassAnalytics). None until a test on
+        the document is submitted.
+        """
+        return self.class_analytics.report(document_id)
 
     def get_performance_trends(self, user_id=None):
         """
-        Get performance trends over multiple tests
+        Get performance trends over multiple tests, for one user or everyone.
+        Read from running aggregates, so the cost doesn't grow with history.
         """
-        if not self.performance_db:
+        stats = self.store.trends(user_id)
+        if not stats:
             return None
 
-        df = pd.DataFrame(self.performance_db)
-
-        trends = {
-            'average_score': df['percentage'].mean(),
-            'tests_taken': len(df),
-            'improvement': self._calculate_improvement(df),
-            'common_topics': self._find_common_topics(df)
+        return {
+            'average_score': stats['average_score'],
+            'tests_taken': stats['tests_taken'],
+            'improvement': self._calculate_improvement(stats),
+            'common_topics': stats['topic_counts'],
+            'topic_accuracy': stats['topic_accuracy']
         }
 
-        return trends
-
-    def _calculate_improvement(self, df):
+    def _calculate_improvement(self, stats):
         """
-        Calculate improvement over time
+        Calculate improvement over time: the latest tests against the first ones
         """
-        if len(df) < 2:
+        if stats['tests_taken'] < 2:
             return 0
 
-        recent = df.tail(3)['percentage'].mean()
-        older = df.head(3)['percentage'].mean()
-
-        return round(recent - older, 2)
-
-    def _find_common_topics(self, df):
-        """
-        Find most frequently tested topics
-        """
-        all_topics = []
-        for topics in df['topics']:
-            all_topics.extend(topics)
-
-        topic_counts = pd.Series(all_topics).value_counts()
-        return topic_counts.head(5).to_dict()
\ No newline at end of file
+        return round(stats['recent_average'] - stats['first_average'], 2)
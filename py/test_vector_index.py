@@ -0,0 +1,41 @@
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from vector_index import VectorIndex
+
+CHUNKS = [
+    "Photosynthesis converts light energy into chemical energy in plants",
+    "Mitochondria produce energy for the cell through respiration",
+    "Plants absorb water through their roots and carbon dioxide through leaves",
+    "The cell membrane controls what enters and leaves the cell",
+]
+
+
+def refit_scores(chunks, query):
+    vectorizer = TfidfVectorizer(stop_words='english')
+    rows = vectorizer.fit_transform(chunks)
+    return (rows @ vectorizer.transform([query]).T).toarray().ravel()
+
+
+def test_scores_match_refit_with_unseen_query_terms():
+    index = VectorIndex()
+    index.add('biology-1', CHUNKS[:2])
+    index.add('biology-2', CHUNKS[2:])
+
+    # "quasar" and "nebula" appear in no chunk
+    query = "energy in plants quasar nebula"
+    row_ids, scores = index.similarities(query)
+
+    np.testing.assert_allclose(scores[np.argsort(row_ids)], refit_scores(CHUNKS, query), atol=1e-9)
+
+
+def test_scores_match_refit_for_one_document():
+    index = VectorIndex()
+    index.add('biology-1', CHUNKS[:2])
+    index.add('biology-2', CHUNKS[2:])
+
+    query = "cell leaves unseenword"
+    row_ids, scores = index.similarities(query, 'biology-2')
+
+    assert sorted(row_ids.tolist()) == [2, 3]
+    # Idf still comes from the whole corpus, only the rows are restricted
+    np.testing.assert_allclose(scores[np.argsort(row_ids)], refit_scores(CHUNKS, query)[2:], atol=1e-9)
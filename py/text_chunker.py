@@ -0,0 +1,304 @@
+import re
+import bisect
+from collections import deque
+
+CHUNK_UNITS = ('chars', 'tokens')
+
+_LINE = re.compile(r'[^\n]*\n?')
+_WORD = re.compile(r'\S+')
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+# Terminal punctuation plus any closing quotes/brackets, followed by whitespace
+_SENTENCE_END = re.compile(r'[.!?]+[\'")\]”’]*(?=\s|$)')
+_CLOSED_LINE = re.compile(r'[.!?:][\'")\]”’]*$')
+_HEADING = re.compile(
+    r'#{1,6}\s+\S.*'
+    r'|(?i:chapter|section|part|lesson|unit|appendix)\s+(?:\d+|[IVXLC]+)\b.*'
+    r'|[A-Z][A-Z0-9 ,:;\'&()\-–“”]{2,}'
+)
+# "2.1 Arrays" - only trusted where a new sentence could start anyway
+_NUMBERED_HEADING = re.compile(r'\d+(?:\.\d+)*\.?\s+[A-Z].*')
+
+
+class TextChunker:
+    """
+    Splits text into overlapping chunks in a single pass.
+
+    Text is segmented into sentences and headings (short standalone lines
+    such as "RULE THREE" or "2.1 Arrays"), which are packed greedily into
+    chunks of at most chunk_size units. unit is 'chars' or 'tokens', and
+    overlap is measured in the same unit: each chunk repeats the trailing
+    whole sentences of the previous one that fit in overlap. A heading
+    always starts a new chunk, with no overlap across the section break.
+    Sentences longer than a chunk are split at word boundaries.
+
+    Every chunk is a contiguous span of the source and comes back as a dict
+    with its text, its character offsets (start, end) and the pages it
+    spans, so it can be traced back to where it came from.
+    """
+
+    def __init__(self, chunk_size=1000, overlap=200, unit='chars', tokenizer=None):
+        if unit not in CHUNK_UNITS:
+            raise ValueError(f"Unknown chunk unit: {unit}")
+        if not 0 <= overlap < chunk_size:
+            raise ValueError("overlap must be smaller than chunk_size")
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.unit = unit
+        # tokenizer(text) -> token count, e.g. from the embedding model
+        self.tokenizer = tokenizer
+
+    def chunk(self, text):
+        """Chunk dicts for a single text"""
+        stream = self.stream()
+        return stream.add_page(text) + stream.close()
+
+    def split(self, text):
+        """Chunk texts only"""
+        return [chunk['text'] for chunk in self.chunk(text)]
+
+    def stream(self):
+        """
+        A ChunkStream for page-by-page input. Pages are joined with "\\n",
+        and the chunks are exactly those of chunk() on the joined text.
+        """
+        return ChunkStream(self)
+
+    def count_tokens(self, text, start=0, end=None):
+        if self.tokenizer:
+            return self.tokenizer(text[start:end])
+        return len(_TOKEN.findall(text, start, len(text) if end is None else end))
+
+    def measure(self, text, start, end):
+        """Size of text[start:end] in chunk units"""
+        if self.unit == 'chars':
+            return end - start
+        return self.count_tokens(text, start, end)
+
+    @staticmethod
+    def is_heading(line, after_break=True):
+        if len(line) > 80 or line.endswith((',', ';')) or _SENTENCE_END.search(line[-3:]):
+            return False
+        if _HEADING.fullmatch(line):
+            return True
+        return after_break and _NUMBERED_HEADING.fullmatch(line) is not None
+
+    def segments(self, text, start, at_line_start=True):
+        """
+        Yield (start, end, is_heading) for every sentence and heading of
+        text[start:]. A heading is a whole line: markdown, "Chapter 3",
+        ALL CAPS, or a numbered title right after a blank line, a heading
+        or the end of a sentence.
+        """
+        block_start = None
+        closed = True
+        for match in _LINE.finditer(text, start):
+            if match.start() == match.end():
+                break
+            line = match.group()
+            stripped = line.strip()
+            if not stripped:
+                if block_start is not None:
+                    yield from self._sentences(text, block_start, match.start())
+                    block_start = None
+                closed = True
+                continue
+
+            whole_line = at_line_start or match.start() > start
+            if whole_line and self.is_heading(stripped, closed):
+                if block_start is not None:
+                    yield from self._sentences(text, block_start, match.start())
+                    block_start = None
+                closed = True
+                line_start = match.start() + len(line) - len(line.lstrip())
+                yield line_start, line_start + len(stripped), True
+                continue
+
+            if block_start is None:
+                block_start = match.start()
+            closed = _CLOSED_LINE.search(stripped) is not None
+            if closed:
+                yield from self._sentences(text, block_start, match.end())
+                block_start = None
+
+        if block_start is not None:
+            yield from self._sentences(text, block_start, len(text))
+
+    @staticmethod
+    def _sentences(text, start, end):
+        pos = start
+        for match in _SENTENCE_END.finditer(text, start, end):
+            yield from _trimmed(text, pos, match.end())
+            pos = match.end()
+        yield from _trimmed(text, pos, end)
+
+    def pieces(self, text, start, end, is_heading):
+        """
+        Yield (start, end, is_heading, size) for a segment, split at word
+        boundaries if it is bigger than a chunk
+        """
+        size = self.measure(text, start, end)
+        if size <= self.chunk_size:
+            yield start, end, is_heading, size
+            return
+
+        piece_start, piece_end, piece_size = start, start, 0
+        for word in _WORD.finditer(text, start, end):
+            word_size = self.measure(text, word.start(), word.end())
+            grown = word.end() - piece_start if self.unit == 'chars' else piece_size + word_size
+            if grown > self.chunk_size and piece_end > piece_start:
+                yield piece_start, piece_end, is_heading, self.measure(text, piece_start, piece_end)
+                piece_start = word.start()
+                grown = word_size
+            while self.unit == 'chars' and grown > self.chunk_size:
+                # A single "word" longer than a chunk (e.g. a URL or a table row)
+                yield piece_start, piece_start + self.chunk_size, is_heading, self.chunk_size
+                piece_start += self.chunk_size
+                grown = word.end() - piece_start
+            piece_end, piece_size = word.end(), grown
+        if piece_end > piece_start:
+            yield piece_start, piece_end, is_heading, self.measure(text, piece_start, piece_end)
+
+
+class ChunkStream:
+    """
+    Incremental state of a TextChunker over one document. add_page()
+    returns the chunks that can no longer change; the last sentence of a
+    page is held back until the next page shows whether it continues.
+    """
+
+    def __init__(self, chunker):
+        self.chunker = chunker
+        self._buffer = ''
+        self._base = 0            # document offset of _buffer[0]
+        self._length = 0          # document length so far
+        self._scan_from = 0       # start of the held-back sentence
+        self._page_starts = []
+        self._page_numbers = []
+        self._current = deque()   # (start, end, size) of the chunk being built
+        self._tokens = 0          # total size of _current in tokens
+        self._fresh = 0           # segments in _current beyond the overlap
+
+    def add_page(self, text, page=None):
+        if self._page_starts:
+            self._append('\n')
+        self._page_starts.append(self._length)
+        self._page_numbers.append(len(self._page_numbers) + 1 if page is None else page)
+        self._append(text)
+        return self._scan(final=False)
+
+    def close(self):
+        chunks = self._scan(final=True)
+        if self._fresh:
+            chunks.append(self._emit())
+        self._current.clear()
+        self._tokens, self._fresh = 0, 0
+        return chunks
+
+    def page_table(self):
+        """(page number, start offset) of every page added so far"""
+        return list(zip(self._page_numbers, self._page_starts))
+
+    def _append(self, text):
+        self._buffer += text
+        self._length += len(text)
+
+    def _scan(self, final):
+        chunker = self.chunker
+        buffer, base = self._buffer, self._base
+        local = self._scan_from - base
+        line_start = buffer.rfind('\n', 0, local) + 1
+        at_line_start = not buffer[line_start:local].strip()
+
+        pieces = []
+        for start, end, is_heading in chunker.segments(buffer, local, at_line_start):
+            pieces.extend(chunker.pieces(buffer, start, end, is_heading))
+
+        if not final and pieces:
+            # The last sentence may continue on the next page
+            self._scan_from = pieces.pop()[0] + base
+        else:
+            self._scan_from = self._length
+
+        chunks = []
+        for start, end, is_heading, size in pieces:
+            chunks.extend(self._add(start + base, end + base, is_heading, size))
+
+        # Drop text no chunk can start in any more
+        keep = min(self._scan_from, self._current[0][0] if self._current else self._scan_from)
+        if keep - self._base > len(self._buffer) // 2:
+            self._buffer = self._buffer[keep - self._base:]
+            self._base = keep
+        return chunks
+
+    def _grown(self, segment):
+        """Size of the current chunk if segment were added to it"""
+        if self.chunker.unit == 'chars':
+            return segment[1] - (self._current[0][0] if self._current else segment[0])
+        return self._tokens + segment[2]
+
+    def _drop_first(self):
+        self._tokens -= self._current.popleft()[2]
+
+    def _add(self, start, end, is_heading, size):
+        chunks = []
+        segment = (start, end, size)
+        if is_heading and self._current:
+            if self._fresh:
+                chunks.append(self._emit())
+            self._current.clear()
+            self._tokens, self._fresh = 0, 0
+        elif self._fresh and self._grown(segment) > self.chunker.chunk_size:
+            chunks.append(self._emit())
+            self._overlap()
+
+        # The overlap gives way if it would push the new segment over the limit
+        while self._current and self._grown(segment) > self.chunker.chunk_size:
+            self._drop_first()
+
+        self._current.append(segment)
+        self._tokens += size
+        self._fresh += 1
+        return chunks
+
+    def _overlap(self):
+        """Keep the trailing whole segments that fit in the overlap"""
+        last_end = self._current[-1][1]
+        kept, size = 0, 0
+        while kept < len(self._current) - 1:
+            segment = self._current[-1 - kept]
+            grown = last_end - segment[0] if self.chunker.unit == 'chars' else size + segment[2]
+            if grown > self.chunker.overlap:
+                break
+            kept, size = kept + 1, grown
+        while len(self._current) > kept:
+            self._drop_first()
+        self._fresh = 0
+
+    def _emit(self):
+        start, end = self._current[0][0], self._current[-1][1]
+        return {
+            'text': self._buffer[start - self._base:end - self._base],
+            'start': start,
+            'end': end,
+            'page_start': self._page_at(start),
+            'page_end': self._page_at(end - 1)
+        }
+
+    def _page_at(self, offset):
+        return self._page_numbers[bisect.bisect_right(self._page_starts, offset) - 1]
+
+
+def page_label(page_start, page_end):
+    """Citation label for a page span: p. 12, or pp. 12-14 across pages"""
+    if page_start == page_end:
+        return f"p. {page_start}"
+    return f"pp. {page_start}-{page_end}"
+
+
+def _trimmed(text, start, end):
+    """The sentence span with surrounding whitespace removed, if anything is left"""
+    piece = text[start:end]
+    stripped = piece.strip()
+    if stripped:
+        start += len(piece) - len(piece.lstrip())
+        yield start, start + len(stripped), False
@@ -1,30 +1,91 @@
-import os
-import json
-import google.generativeai as genai
-from dotenv import load_dotenv
-
-load_dotenv()
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import get_llm_client
+from text_chunker import page_label
 
 class TutoringAgent:
-    def __init__(self, rag_agent):
+    def __init__(self, rag_agent, llm=None, max_workers=4):
         # We need the RAG agent to look up the original textbook content
         self.rag_agent = rag_agent
 
-        # Configure Gemini
-        genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-        self.model = genai.GenerativeModel('gemini-2.5-flash')
+        # Shared, cached Gemini client; identical (document, topic) prompts hit the cache
+        self.llm = llm or get_llm_client()
+
+        # Lessons for several topics are written concurrently
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
 
     def generate_lesson(self, document_id, weak_topic):
         """
         Creates a personalized lesson for a specific weak topic
         """
+        prompt = self._build_prompt(document_id, weak_topic)
+        return self._generate(prompt)
+
+    def generate_lessons(self, document_id, weak_topics):
+        """
+        Lessons for several weak topics at once. Source material for every
+        topic is retrieved in a single batched query, then the lessons are
+        generated concurrently. Returns [{'topic', 'lesson', 'pages'}] in
+        topic order, where pages lists the source pages the lesson drew on.
+        """
+        weak_topics = list(weak_topics)
+        chunk_lists = self.rag_agent.retrieve_many(weak_topics, document_id=document_id, top_k=4)
+        prompts = [
+            self._lesson_prompt(topic, chunks)
+            for topic, chunks in zip(weak_topics, chunk_lists)
+        ]
+
+        # Each call runs in a copy of this context, so a traced request sees its LLM calls
+        contexts = [contextvars.copy_context() for _ in prompts]
+        lessons = self._pool.map(lambda context, prompt: context.run(self._generate, prompt), contexts, prompts)
+        return [
+            {'topic': topic, 'lesson': lesson, 'pages': self.source_pages(chunks)}
+            for topic, lesson, chunks in zip(weak_topics, lessons, chunk_lists)
+        ]
+
+    @staticmethod
+    def source_pages(chunks):
+        """Sorted page numbers covered by the retrieved chunks"""
+        pages = set()
+        for chunk in chunks:
+            if 'page_start' in chunk:
+                pages.update(range(chunk['page_start'], chunk['page_end'] + 1))
+        return sorted(pages)
+
+    def _generate(self, prompt):
+        try:
+            return self.llm.generate(prompt)
+        except Exception as e:
+            return f"Error generating lesson: {str(e)}"
+
+    def stream_lesson(self, document_id, weak_topic):
+        """
+        Same lesson as generate_lesson, yielded in pieces as the model writes
+        it. The finished lesson lands in the same cache generate_lesson reads.
+        """
+        prompt = self._build_prompt(document_id, weak_topic)
+
+        try:
+            yield from self.llm.stream(prompt)
+        except Exception as e:
+            yield f"Error generating lesson: {str(e)}"
+
+    def _build_prompt(self, document_id, weak_topic):
         # 1. Retrieve relevant content from the uploaded document about this topic
-        relevant_chunks = self.rag_agent.retrieve_relevant_chunks(weak_topic, top_k=4)
+        relevant_chunks = self.rag_agent.retrieve_relevant_chunks(
+            weak_topic, top_k=4, document_id=document_id
+        )
+        return self._lesson_prompt(weak_topic, relevant_chunks)
 
+    def _lesson_prompt(self, weak_topic, relevant_chunks):
         if not relevant_chunks:
             context_text = "No specific context found in document. Using general knowledge."
         else:
-            context_text = "\n\n".join([c['text'] for c in relevant_chunks])
+            # Each excerpt is tagged with its pages so the lesson can cite them
+            context_text = "\n\n".join([
+                f"[{page_label(c['page_start'], c['page_end'])}]\n{c['text']}" if 'page_start' in c else c['text']
+                for c in relevant_chunks
+            ])
 
         # 2. Ask AI to teach it
         prompt = f"""
@@ -37,13 +98,9 @@ class TutoringAgent:
         2. **Key Points**: Bullet points of the most important facts.
         3. **Common Pitfalls**: What students usually get wrong about this.
         4. **Real World Analogy**: A simple analogy to help remember.
+        5. **Read More**: The pages of the source material to revisit, e.g. "p. 12" or "pp. 40-42", taken from the excerpt tags.
 
         Source Material:
         {context_text[:10000]}
         """
-
-        try:
-            response = self.model.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            return f"Error generating lesson: {str(e)}"
\ No newline at end of file
+        return prompt
\ No newline at end of file
@@ -0,0 +1,541 @@
+import bisect
+import threading
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+
+
+class IndexSnapshot:
+    """
+    The index as of one write. Snapshots are never modified once published:
+    writers build a new one and swap it in, so a query that holds a snapshot
+    sees matrices, document frequencies and row owners that all agree, no
+    matter what is being ingested meanwhile. Only the idf and row norm caches
+    are filled in lazily, and those are derived from the snapshot itself.
+    """
+
+    def __init__(self, hasher, n_features, doc_freq, doc_rows, doc_chunk_counts,
+                 document_ids, row_documents, row_chunks, segments, segment_starts, n_rows,
+                 idf=None, dense=None, dense_state=None, n_dead=0):
+        self.hasher = hasher
+        self.n_features = n_features
+        self.doc_freq = doc_freq
+        self.doc_rows = doc_rows  # document_id -> ((start, stop), ...)
+        self.doc_chunk_counts = doc_chunk_counts
+        # Chunk table: for every row, the position of its document in
+        # document_ids and its chunk index within that document. Only the
+        # first n_rows entries belong to this snapshot.
+        self.document_ids = document_ids
+        self.row_documents = row_documents
+        self.row_chunks = row_chunks
+        # Count matrices in row order; segment_starts[i] is the first row of segments[i]
+        self.segments = segments
+        self.segment_starts = segment_starts
+        self.n_rows = n_rows
+        # Rows retired by replace_chunks(): still stored, never scored
+        self.n_dead = n_dead
+        self._idf = idf
+        self._norms = {}  # segment position -> row norms under this snapshot's idf
+        # Optional DenseIndex and its embeddings for the same rows
+        self.dense = dense
+        self.dense_state = dense_state
+
+    def locate(self, row):
+        """Map a global row id back to (document_id, chunk_index)"""
+        return self.document_ids[self.row_documents[row]], int(self.row_chunks[row])
+
+    def idf(self):
+        """Smoothed inverse document frequency, as in TfidfVectorizer"""
+        if self._idf is None:
+            n_live = self.n_rows - self.n_dead
+            self._idf = np.log((1 + n_live) / (1 + self.doc_freq)) + 1.0
+        return self._idf
+
+    @staticmethod
+    def _row_slice(matrix, start, stop):
+        """Zero-copy view of rows [start, stop) of a CSR matrix"""
+        if start == 0 and stop == matrix.shape[0]:
+            return matrix
+        lo, hi = matrix.indptr[start], matrix.indptr[stop]
+        return sp.csr_matrix(
+            (matrix.data[lo:hi], matrix.indices[lo:hi], matrix.indptr[start:stop + 1] - lo),
+            shape=(stop - start, matrix.shape[1])
+        )
+
+    def _segment_norms(self, pos, lo, hi, rows, idf_sq):
+        """Row norms in idf-weighted space, cached per segment when computed in full"""
+        cached = self._norms.get(pos)
+        if cached is not None:
+            return cached[lo:hi]
+        norms = np.sqrt(rows.multiply(rows) @ idf_sq)
+        if (lo, hi) == (0, self.segments[pos].shape[0]):
+            self._norms[pos] = norms
+        return norms
+
+    def row_ranges(self, document_ids=None):
+        """
+        Row ranges to score for a document filter. None means the whole index;
+        a single id or a list of ids restricts it to those documents.
+        """
+        if document_ids is None:
+            if not self.n_dead:
+                return [(0, self.n_rows)] if self.n_rows else []
+            document_ids = list(self.doc_rows)
+        if isinstance(document_ids, str):
+            document_ids = [document_ids]
+
+        ranges = [r for d in document_ids for r in self.doc_rows.get(d, ())]
+        return sorted(ranges)
+
+    def _range_slices(self, start, stop):
+        """
+        Split a global row range into (segment position, local start, local stop)
+        pieces, since a range can span several segments after compaction.
+        """
+        pos = bisect.bisect_right(self.segment_starts, start) - 1
+        while start < stop:
+            seg_start = self.segment_starts[pos]
+            seg_stop = seg_start + self.segments[pos].shape[0]
+            piece_stop = min(stop, seg_stop)
+            yield pos, start - seg_start, piece_stop - seg_start
+            start = piece_stop
+            pos += 1
+
+    def similarities(self, query, document_ids=None):
+        """
+        Cosine similarity between a query string and the indexed rows.
+        Returns (row_ids, scores) restricted to the requested documents.
+        """
+        ranges = self.row_ranges(document_ids)
+        if not ranges:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        idf = self.idf()
+        query_weights, query_norms = self._query_weights([query], idf)
+        # A dense query makes each segment a plain CSR mat-vec
+        query_vector = query_weights.toarray().ravel()
+
+        def score(rows):
+            return rows @ query_vector
+
+        row_ids, scores = self._score_ranges(ranges, score, query_norms, idf * idf)
+        return row_ids, scores.ravel()
+
+    def similarities_many(self, queries, document_ids=None):
+        """
+        Cosine similarity for several queries at once: one sparse
+        matrix-matrix product per segment instead of one mat-vec per query.
+        Returns (row_ids, scores) with one score column per query.
+        """
+        ranges = self.row_ranges(document_ids)
+        if not ranges or not queries:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(queries)))
+
+        idf = self.idf()
+        query_weights, query_norms = self._query_weights(queries, idf)
+        query_matrix = query_weights.T.tocsc()
+
+        def score(rows):
+            return (rows @ query_matrix).toarray()
+
+        return self._score_ranges(ranges, score, query_norms, idf * idf)
+
+    def _query_weights(self, queries, idf):
+        """
+        Queries as idf-weighted rows plus their norms. Index rows carry raw
+        counts, so the idf weight is applied once more on the query side.
+        Terms no live chunk contains are dropped, as a refit vocabulary
+        would drop them, so they don't inflate the query norm.
+        """
+        weights = self.hasher.transform(queries).multiply(self.doc_freq > 0).multiply(idf).tocsr()
+        norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+        return weights.multiply(idf).tocsr(), norms
+
+    def _score_ranges(self, ranges, score, query_norms, idf_sq):
+        """
+        Cosine scores over the given row ranges; score(rows) returns the dot
+        products with every query, one column per query.
+        """
+        row_ids = []
+        scores = []
+        for start, stop in ranges:
+            for pos, lo, hi in self._range_slices(start, stop):
+                rows = self._row_slice(self.segments[pos], lo, hi)
+                dots = score(rows).reshape(hi - lo, len(query_norms))
+                norms = self._segment_norms(pos, lo, hi, rows, idf_sq)
+
+                denom = np.outer(norms, query_norms)
+                row_ids.append(np.arange(lo, hi) + self.segment_starts[pos])
+                scores.append(np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 0))
+
+        return np.concatenate(row_ids), np.concatenate(scores)
+
+    def top_k(self, query, k, document_ids=None):
+        """
+        The k best (row_ids, scores) for a query, best first. Selection is
+        an O(n) argpartition; only the k winners are sorted.
+        """
+        row_ids, scores = self.similarities(query, document_ids)
+        best = self._best(scores, k)
+        return row_ids[best], scores[best]
+
+    def top_k_many(self, queries, k, document_ids=None):
+        """
+        top_k for several queries from a single similarities_many pass.
+        Returns one (row_ids, scores) pair per query, best first.
+        """
+        row_ids, scores = self.similarities_many(queries, document_ids)
+        results = []
+        for column in scores.T:
+            best = self._best(column, k)
+            results.append((row_ids[best], column[best]))
+        return results
+
+    def dense_top_k(self, query, k, document_ids=None):
+        """
+        The k best (row_ids, scores) by embedding similarity, found through
+        the dense index's approximate search
+        """
+        ranges = self.row_ranges(document_ids)
+        if not ranges:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        row_ids, scores = self.dense.search(self.dense_state, self.dense.embed_query(query), ranges, k)
+        best = self._best(scores, k)
+        return row_ids[best], scores[best]
+
+    def hybrid_top_k(self, query, k, document_ids=None, dense_weight=0.5, candidates=4):
+        """
+        Blend of TF-IDF and embedding similarity. The k * candidates best rows
+        of each method are pooled, both scores are computed exactly for the
+        pool, and the pool is ranked by the weighted sum.
+        """
+        ranges = self.row_ranges(document_ids)
+        if not ranges:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        query_vector = self.dense.embed_query(query)
+        tfidf_rows, tfidf_scores = self.similarities(query, document_ids)
+        dense_rows, dense_scores = self.dense.search(self.dense_state, query_vector, ranges, k * candidates)
+
+        pool = np.union1d(
+            tfidf_rows[self._best(tfidf_scores, k * candidates)],
+            dense_rows[self._best(dense_scores, k * candidates)]
+        )
+        # tfidf_rows is sorted, so pool rows can be looked up by bisection
+        pool_tfidf = tfidf_scores[np.searchsorted(tfidf_rows, pool)]
+        pool_dense = self.dense.score_rows(self.dense_state, query_vector, pool)
+
+        scores = dense_weight * pool_dense + (1 - dense_weight) * pool_tfidf
+        best = self._best(scores, k)
+        return pool[best], scores[best]
+
+    @staticmethod
+    def _best(scores, k):
+        """Positions of the k highest scores, best first"""
+        if len(scores) > k:
+            best = np.argpartition(scores, -k)[-k:]
+        else:
+            best = np.arange(len(scores))
+        return best[np.argsort(scores[best], kind='stable')[::-1]]
+
+
+class VectorIndex:
+    """
+    Incremental TF-IDF index.
+
+    Term counts come from a stateless HashingVectorizer, so adding a document
+    never refits anything: we only hash the new chunks and bump the document
+    frequency table. IDF weights and row norms are derived from that table at
+    query time, which gives the same scores as a TfidfVectorizer refit over
+    the whole corpus (smooth idf, l2 norm).
+
+    Rows are grouped by document: each document owns one or more contiguous
+    row ranges (several when it was indexed page by page while other uploads
+    were running), so a scoped query only touches that document's rows.
+
+    Writes are copy-on-write: they are serialized by a lock and publish a new
+    IndexSnapshot, while queries run lock-free against whichever snapshot was
+    current when they started. Callers that need several lookups to agree
+    (scores, then row owners) should take snapshot() once and use it throughout.
+    """
+
+    def __init__(self, n_features=2 ** 18, dense=None):
+        self.n_features = n_features
+        self.dense = dense
+        self.hasher = HashingVectorizer(
+            n_features=n_features,
+            stop_words='english',
+            alternate_sign=False,
+            norm=None
+        )
+        self._write_lock = threading.Lock()
+        # Append-only chunk table buffers shared by every snapshot. Writers
+        # only fill rows past the newest snapshot's n_rows, which older
+        # snapshots never read, and growing reallocates instead of resizing.
+        self._document_ids = []
+        self._document_positions = {}
+        self._row_documents = np.zeros(0, dtype=np.int32)
+        self._row_chunks = np.zeros(0, dtype=np.int32)
+        self._snapshot = IndexSnapshot(
+            self.hasher, n_features, np.zeros(n_features, dtype=np.int64),
+            {}, {}, self._document_ids, self._row_documents, self._row_chunks, [], [], 0,
+            dense=dense, dense_state=dense.empty_state() if dense else None
+        )
+
+    def snapshot(self):
+        """The current, consistent view of the index"""
+        return self._snapshot
+
+    @property
+    def n_rows(self):
+        return self._snapshot.n_rows
+
+    def vectorize(self, texts):
+        """Raw term counts for a list of chunks, one CSR row per chunk"""
+        if not texts:
+            return sp.csr_matrix((0, self.n_features))
+        counts = self.hasher.transform(texts).tocsr()
+        counts.sum_duplicates()
+        return counts
+
+    def add(self, document_id, texts):
+        """
+        Hash a batch of a document's chunks into a new segment and update
+        document frequencies. Returns the (start, stop) row range assigned
+        to it. Calling it again for the same document appends more chunks.
+        """
+        return self.add_counts(document_id, self.vectorize(texts))
+
+    def add_counts(self, document_id, counts, embeddings=None):
+        """
+        Append an already vectorized batch of chunks, e.g. a memory-mapped
+        segment loaded from an IndexStore. The matrix is used as-is, never copied.
+        With a dense index, embeddings is the batch's (codes, scales) from
+        DenseIndex.encode() and is required.
+        """
+        if self.dense and embeddings is None:
+            raise ValueError("Dense index enabled but no embeddings given")
+
+        # Count outside the lock; only the cheap bookkeeping is serialized
+        batch_freq = np.bincount(counts.indices, minlength=self.n_features) if counts.shape[0] else None
+
+        with self._write_lock:
+            old = self._snapshot
+            start = old.n_rows
+            if batch_freq is None:
+                if document_id not in old.doc_rows:
+                    doc_rows = dict(old.doc_rows)
+                    doc_rows[document_id] = ()
+                    doc_chunk_counts = dict(old.doc_chunk_counts)
+                    doc_chunk_counts[document_id] = 0
+                    self._snapshot = self._copy(old, doc_rows=doc_rows, doc_chunk_counts=doc_chunk_counts)
+                return start, start
+
+            stop = start + counts.shape[0]
+            first_chunk = old.doc_chunk_counts.get(document_id, 0)
+            doc_rows = dict(old.doc_rows)
+            doc_rows[document_id] = doc_rows.get(document_id, ()) + ((start, stop),)
+            doc_chunk_counts = dict(old.doc_chunk_counts)
+            doc_chunk_counts[document_id] = first_chunk + counts.shape[0]
+            self._append_rows(document_id, start, stop, first_chunk)
+            dense_state = old.dense_state
+            if self.dense:
+                dense_state = self.dense.append(dense_state, start, *embeddings)
+
+            # Each chunk counts once per term it contains
+            self._snapshot = IndexSnapshot(
+                self.hasher, self.n_features,
+                old.doc_freq + batch_freq,
+                doc_rows,
+                doc_chunk_counts,
+                self._document_ids,
+                self._row_documents,
+                self._row_chunks,
+                old.segments + [counts],
+                old.segment_starts + [start],
+                stop,
+                dense=self.dense,
+                dense_state=dense_state,
+                n_dead=old.n_dead
+            )
+            return start, stop
+
+    def replace_chunks(self, document_id, removed_chunks, counts, embeddings=None):
+        """
+        Retire some of a document's chunks and append their replacements,
+        e.g. after a few pages were re-extracted. Replacement chunks get new
+        chunk indices after the document's last one, so no other row moves.
+        Retired rows stay in their segments but leave the document's row
+        ranges and the document frequencies, so they are never scored again.
+        Returns the (start, stop) row range of the new chunks.
+        """
+        if self.dense and embeddings is None:
+            raise ValueError("Dense index enabled but no embeddings given")
+
+        removed_chunks = np.asarray(removed_chunks, dtype=np.int64)
+        batch_freq = np.bincount(counts.indices, minlength=self.n_features)
+
+        with self._write_lock:
+            old = self._snapshot
+            live_ranges = []
+            dead_freq = np.zeros(self.n_features, dtype=np.int64)
+            n_dead = 0
+            for start, stop in old.doc_rows.get(document_id, ()):
+                dead = np.isin(self._row_chunks[start:stop], removed_chunks)
+                if dead.any():
+                    for pos, lo, hi in old._range_slices(start, stop):
+                        offset = old.segment_starts[pos] + lo - start
+                        mask = dead[offset:offset + hi - lo]
+                        rows = old._row_slice(old.segments[pos], lo, hi)[mask]
+                        dead_freq += np.bincount(rows.indices, minlength=self.n_features)
+                    n_dead += int(dead.sum())
+
+                # The surviving runs of the range
+                edges = np.flatnonzero(np.diff(np.concatenate(([0], ~dead, [0])).astype(np.int8)))
+                live_ranges.extend((start + int(a), start + int(b)) for a, b in zip(edges[::2], edges[1::2]))
+
+            start = old.n_rows
+            stop = start + counts.shape[0]
+            first_chunk = old.doc_chunk_counts.get(document_id, 0)
+            doc_rows = dict(old.doc_rows)
+            doc_rows[document_id] = tuple(live_ranges) + (((start, stop),) if stop > start else ())
+            doc_chunk_counts = dict(old.doc_chunk_counts)
+            doc_chunk_counts[document_id] = first_chunk + counts.shape[0]
+
+            segments, segment_starts = old.segments, old.segment_starts
+            dense_state = old.dense_state
+            if stop > start:
+                self._append_rows(document_id, start, stop, first_chunk)
+                segments, segment_starts = segments + [counts], segment_starts + [start]
+                if self.dense:
+                    dense_state = self.dense.append(dense_state, start, *embeddings)
+
+            self._snapshot = self._copy(
+                old,
+                doc_freq=old.doc_freq - dead_freq + batch_freq,
+                doc_rows=doc_rows,
+                doc_chunk_counts=doc_chunk_counts,
+                row_documents=self._row_documents,
+                row_chunks=self._row_chunks,
+                segments=segments,
+                segment_starts=segment_starts,
+                n_rows=stop,
+                n_dead=old.n_dead + n_dead,
+                idf=None,
+                dense_state=dense_state
+            )
+            return start, stop
+
+    def _append_rows(self, document_id, start, stop, first_chunk):
+        """Fill chunk table rows [start, stop), growing the buffers geometrically"""
+        if document_id not in self._document_positions:
+            self._document_positions[document_id] = len(self._document_ids)
+            self._document_ids.append(document_id)
+
+        if stop > len(self._row_documents):
+            capacity = max(stop, 2 * len(self._row_documents), 1024)
+            for name in ('_row_documents', '_row_chunks'):
+                grown = np.zeros(capacity, dtype=np.int32)
+                grown[:start] = getattr(self, name)[:start]
+                setattr(self, name, grown)
+
+        self._row_documents[start:stop] = self._document_positions[document_id]
+        self._row_chunks[start:stop] = np.arange(first_chunk, first_chunk + stop - start)
+
+    def _copy(self, old, **changes):
+        """New snapshot sharing everything but the given fields with old"""
+        fields = {
+            'doc_freq': old.doc_freq,
+            'doc_rows': old.doc_rows,
+            'doc_chunk_counts': old.doc_chunk_counts,
+            'document_ids': old.document_ids,
+            'row_documents': old.row_documents,
+            'row_chunks': old.row_chunks,
+            'segments': old.segments,
+            'segment_starts': old.segment_starts,
+            'n_rows': old.n_rows,
+            'n_dead': old.n_dead,
+            # Same rows and frequencies, so the idf carries over
+            'idf': old._idf,
+            'dense': self.dense,
+            'dense_state': old.dense_state
+        }
+        fields.update(changes)
+        return IndexSnapshot(self.hasher, self.n_features, **fields)
+
+    def merge_document(self, document_id):
+        """
+        Fold a streamed document's page batches into a single segment once it
+        is fully ingested. Skipped if another upload's rows landed in between.
+        """
+        with self._write_lock:
+            old = self._snapshot
+            ranges = old.doc_rows.get(document_id, ())
+            if len(ranges) < 2 or any(a[1] != b[0] for a, b in zip(ranges, ranges[1:])):
+                return
+
+            start, stop = ranges[0][0], ranges[-1][1]
+            first = bisect.bisect_left(old.segment_starts, start)
+            last = bisect.bisect_left(old.segment_starts, stop)
+            aligned = (
+                first < len(old.segments) and old.segment_starts[first] == start
+                and old.segment_starts[last - 1] + old.segments[last - 1].shape[0] == stop
+            )
+            if not aligned:
+                return
+
+            doc_rows = dict(old.doc_rows)
+            doc_rows[document_id] = ((start, stop),)
+            merged = sp.vstack(old.segments[first:last], format='csr')
+            self._snapshot = self._copy(
+                old,
+                segments=old.segments[:first] + [merged] + old.segments[last:],
+                segment_starts=old.segment_starts[:first] + [start] + old.segment_starts[last:],
+                doc_rows=doc_rows,
+                dense_state=self.dense.merge_range(old.dense_state, start, stop) if self.dense else None
+            )
+
+    def compact(self):
+        """
+        Merge all segments into one matrix so whole-corpus queries are a
+        single mat-vec. Safe to call from a background task between uploads.
+        """
+        with self._write_lock:
+            old = self._snapshot
+            if len(old.segments) > 1:
+                self._snapshot = self._copy(
+                    old,
+                    segments=[sp.vstack(old.segments, format='csr')],
+                    segment_starts=[0],
+                    dense_state=self.dense.compact(old.dense_state) if self.dense else None
+                )
+
+    # Single-call conveniences; each one reads the snapshot current at call time
+
+    def locate(self, row):
+        return self._snapshot.locate(row)
+
+    def idf(self):
+        return self._snapshot.idf()
+
+    def row_ranges(self, document_ids=None):
+        return self._snapshot.row_ranges(document_ids)
+
+    def similarities(self, query, document_ids=None):
+        return self._snapshot.similarities(query, document_ids)
+
+    def top_k(self, query, k, document_ids=None):
+        return self._snapshot.top_k(query, k, document_ids)
+
+    def similarities_many(self, queries, document_ids=None):
+        return self._snapshot.similarities_many(queries, document_ids)
+
+    def top_k_many(self, queries, k, document_ids=None):
+        return self._snapshot.top_k_many(queries, k, document_ids)
+
+    def dense_top_k(self, query, k, document_ids=None):
+        return self._snapshot.dense_top_k(query, k, document_ids)
+
+    def hybrid_top_k(self, query, k, document_ids=None, dense_weight=0.5):
+        return self._snapshot.hybrid_top_k(query, k, document_ids, dense_weight)
@@ -0,0 +1,21 @@
+"""
+Production entry point:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Each worker process builds its own services once at startup. Jobs and the
+LLM response cache default to SQLite files under the index folder so every
+worker sees the same job status and shares cached responses, and workers
+publish their metrics there so /metrics covers all of them.
+"""
+import os
+
+index_folder = os.environ.get('SMARTPREP_INDEX_DIR', 'index')
+os.makedirs(index_folder, exist_ok=True)
+os.environ.setdefault('JOB_QUEUE_DB', os.path.join(index_folder, 'jobs.db'))
+os.environ.setdefault('LLM_CACHE_DB', os.path.join(index_folder, 'llm_cache.db'))
+os.environ.setdefault('METRICS_DIR', os.path.join(index_folder, 'metrics'))
+
+from flask_backend import create_app
+
+app = create_app()